@@ -0,0 +1,157 @@
+import atexit
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, models
+from django.db.models import Case, Value, When
+from django.utils import timezone
+from .sharding import get_user_db
+
+
+class ActivityBuffer:
+    """
+    Per-worker buffer of user activity timestamps.
+
+    Activity is recorded in memory and written to `User.last_seen` in a single
+    bulk UPDATE per shard once per flush interval. A user that was written within the
+    last interval is not written again until the interval has passed, so each
+    user costs at most one write per interval regardless of request volume.
+    """
+
+    def __init__(self, interval=None, clock=time.monotonic):
+        self._interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.written = {}
+        self.last_flush = clock()
+        self.recorded = 0
+        self.coalesced = 0
+        self.rows_written = 0
+        self.flushes = 0
+
+    @property
+    def interval(self):
+        if self._interval is None:
+            return settings.ACCOUNTS_ACTIVITY_FLUSH_INTERVAL
+        return self._interval
+
+    def record(self, user_id, seen_at=None, using=DEFAULT_DB_ALIAS):
+        """
+        Record activity for a user on the `using` shard and flush if the
+        interval has elapsed.
+        """
+        now = self.clock()
+        with self.lock:
+            self.recorded += 1
+            last_written = self.written.get(user_id)
+            if (
+                user_id in self.pending
+                or (last_written is not None and now - last_written < self.interval)
+            ):
+                self.coalesced += 1
+            else:
+                self.pending[user_id] = (using, seen_at or timezone.now())
+            due = now - self.last_flush >= self.interval
+
+        if due:
+            # Activity is best effort: a failed flush keeps its timestamps
+            # pending for the next one instead of failing the request
+            try:
+                self.flush()
+            except Exception as exc:
+                print(f'Unable to flush user activity: {exc}')
+
+    def flush(self):
+        """
+        Write all pending timestamps in one UPDATE statement per shard.
+
+        If a write fails, the timestamps not yet written are put back to be
+        written by the next flush, and the error is raised.
+        """
+        now = self.clock()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = now
+            # Forget users whose coalescing window has already closed
+            self.written = {
+                user_id: written_at
+                for user_id, written_at in self.written.items()
+                if now - written_at < self.interval
+            }
+            for user_id in pending:
+                self.written[user_id] = now
+
+        if not pending:
+            return 0
+
+        written = 0
+        shards = defaultdict(dict)
+        for user_id, (using, seen_at) in pending.items():
+            shards[using][user_id] = seen_at
+
+        User = get_user_model()
+        for using, seen in shards.items():
+            try:
+                User.objects.using(using).filter(pk__in=seen.keys()).update(
+                    last_seen=Case(
+                        *[
+                            When(pk=user_id, then=Value(seen_at))
+                            for user_id, seen_at in seen.items()
+                        ],
+                        output_field=models.DateTimeField(),
+                    ),
+                )
+            except Exception:
+                self.requeue(pending)
+                raise
+            for user_id in seen:
+                del pending[user_id]
+            written += len(seen)
+
+        with self.lock:
+            self.flushes += 1
+            self.rows_written += written
+        return written
+
+    def requeue(self, pending):
+        """
+        Put back timestamps a failed flush did not write, keeping any
+        recorded since.
+        """
+        with self.lock:
+            for user_id, entry in pending.items():
+                self.pending.setdefault(user_id, entry)
+                self.written.pop(user_id, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'recorded': self.recorded,
+                'coalesced': self.coalesced,
+                'rows_written': self.rows_written,
+                'flushes': self.flushes,
+                'pending': len(self.pending),
+            }
+
+
+activity_buffer = ActivityBuffer()
+
+
+def record_activity(user):
+    activity_buffer.record(user.pk, using=get_user_db(user))
+
+
+def flush_activity():
+    """
+    Flush pending activity on worker shutdown.
+    """
+    try:
+        activity_buffer.flush()
+    except Exception as exc:
+        print(f'Unable to flush user activity: {exc}')
+
+
+atexit.register(flush_activity)
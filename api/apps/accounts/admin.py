@@ -1,6 +1,12 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DefaultUserAdmin
-from .models import User, VerificationToken
+from .models import (
+    AccountCounter,
+    AccountDeletion,
+    DeadLetterEvent,
+    User,
+    VerificationToken,
+)
 
 
 class UserAdmin(DefaultUserAdmin):
@@ -14,3 +20,6 @@ class UserAdmin(DefaultUserAdmin):
 
 admin.site.register(User, UserAdmin)
 admin.site.register(VerificationToken)
+admin.site.register(DeadLetterEvent)
+admin.site.register(AccountDeletion)
+admin.site.register(AccountCounter)
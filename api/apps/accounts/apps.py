@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api.apps.accounts'
+
+    def ready(self):
+        # Register project-level system checks
+        from ... import middleware  # noqa: F401
+        # Connect the user directory signal receivers
+        from . import sharding  # noqa: F401
+        # Build the PostgreSQL-only indexes after migrating
+        from ...operations import build_postgres_indexes
+        post_migrate.connect(build_postgres_indexes, sender=self)
@@ -0,0 +1,271 @@
+import statistics
+import time
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import serializers
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from .models import ArchivedUser, UserDirectoryEntry, VerificationToken
+from .sharding import atomic_with_directory
+
+
+def get_cold_users(using, now=None):
+    """
+    Return the users on a shard that are cold enough to archive.
+
+    Users are cold when they never verified their email and have not been
+    seen for ACCOUNTS_ARCHIVE_UNVERIFIED_AFTER seconds since joining, or
+    have not been seen at all for ACCOUNTS_ARCHIVE_INACTIVE_AFTER seconds.
+    Staff users are never archived.
+    """
+    now = now or timezone.now()
+    unverified_cutoff = now - timedelta(
+        seconds=settings.ACCOUNTS_ARCHIVE_UNVERIFIED_AFTER,
+    )
+    inactive_cutoff = now - timedelta(
+        seconds=settings.ACCOUNTS_ARCHIVE_INACTIVE_AFTER,
+    )
+
+    User = get_user_model()
+    return (
+        User.objects.using(using)
+        .alias(last_active=Coalesce('last_seen', 'last_login', 'date_joined'))
+        .filter(
+            Q(is_verified=False, last_active__lt=unverified_cutoff)
+            | Q(last_active__lt=inactive_cutoff)
+        )
+        .filter(is_staff=False, is_superuser=False)
+    )
+
+
+def archive_users(user_ids, using, now=None):
+    """
+    Move the users that are still cold, with their tokens, to the archive
+    and return how many were archived.
+    """
+    User = get_user_model()
+    with atomic_with_directory(using):
+        users = list(
+            get_cold_users(using, now)
+            .select_for_update()
+            .filter(pk__in=user_ids)
+            .prefetch_related('groups', 'user_permissions')
+        )
+        if not users:
+            return 0
+        user_ids = [user.pk for user in users]
+
+        rows = {user.pk: [user] for user in users}
+        for model in (Token, VerificationToken):
+            for instance in model.objects.using(using).filter(
+                user_id__in=user_ids,
+            ):
+                rows[instance.user_id].append(instance)
+
+        ArchivedUser.objects.using(using).bulk_create([
+            ArchivedUser(
+                id=user.pk,
+                email=user.email,
+                data=serializers.serialize('python', rows[user.pk]),
+            )
+            for user in users
+        ])
+        # Keep the directory entries so the email stays taken and the user
+        # can be found for restoring
+        UserDirectoryEntry.objects.filter(user_id__in=user_ids).update(
+            is_archived=True,
+            token_key=None,
+        )
+        # Tokens are deleted with the users by the cascade
+        User.objects.using(using).filter(pk__in=user_ids).delete()
+        return len(users)
+
+
+def load_archived_user(archived):
+    """
+    Return the unsaved user an ArchivedUser holds.
+    """
+    return next(serializers.deserialize('python', archived.data)).object
+
+
+def get_archive_shard(email):
+    """
+    Return the shard holding the archived user with an email, or None if no
+    user with that email is archived.
+    """
+    return (
+        UserDirectoryEntry.objects.filter(email=email, is_archived=True)
+        .values_list('shard', flat=True)
+        .first()
+    )
+
+
+def get_archived_verification_token(objects):
+    """
+    Return the verification token among the objects of an archived user, or
+    None if they have none.
+    """
+    for instance in objects:
+        if isinstance(instance, VerificationToken):
+            return instance
+    return None
+
+
+def check_archived_verification_token(submitted_token, objects):
+    """
+    Return whether a submitted token matches the active verification token
+    among the objects of an archived user.
+    """
+    verification_token = get_archived_verification_token(objects)
+    return (
+        verification_token is not None
+        and verification_token.token == uuid.UUID(submitted_token)
+        and verification_token.is_valid()
+    )
+
+
+def update_archived_verification_token(email, using):
+    """
+    Store a new verification token with an archived user without restoring
+    them, and return it, or None if no user with that email is archived.
+
+    The user is restored once the token is used, so requests for any email
+    leave archived users where they are.
+    """
+    with transaction.atomic(using=using):
+        try:
+            archived = (
+                ArchivedUser.objects.using(using)
+                .select_for_update()
+                .get(email=email)
+            )
+        except ArchivedUser.DoesNotExist:
+            return None
+
+        objects = [
+            deserialized.object
+            for deserialized in serializers.deserialize(
+                'python',
+                archived.data,
+            )
+        ]
+        user = objects[0]
+        verification_token = get_archived_verification_token(objects)
+        if verification_token is None:
+            verification_token = VerificationToken(user=user)
+            objects.append(verification_token)
+        verification_token.user = user
+        verification_token.token = uuid.uuid4()
+        verification_token.is_active = True
+        verification_token.date_created = timezone.now()
+
+        archived.data = serializers.serialize('python', objects)
+        archived.save(update_fields=['data'])
+        return verification_token
+
+
+def restore_user(email, using, check=None):
+    """
+    Restore an archived user and their tokens, returning the user or None
+    if no user with that email is archived.
+
+    `check` is called with the archived objects, the user first, and the
+    user is only restored if it returns true. A user restored meanwhile by
+    another request is returned as they are, without calling `check`, so
+    callers check the returned user's credentials again.
+    """
+    User = get_user_model()
+    with atomic_with_directory(using):
+        try:
+            archived = (
+                ArchivedUser.objects.using(using)
+                .select_for_update()
+                .get(email=email)
+            )
+        except ArchivedUser.DoesNotExist:
+            return User.objects.using(using).filter(email=email).first()
+
+        objects = list(serializers.deserialize(
+            'python',
+            archived.data,
+            using=using,
+        ))
+        if check is not None and not check([
+            deserialized.object for deserialized in objects
+        ]):
+            return None
+
+        for deserialized in objects:
+            deserialized.save(using=using)
+        ArchivedUser.objects.using(using).filter(pk=archived.pk).delete()
+        return User.objects.using(using).get(pk=archived.pk)
+
+
+def get_index_sizes(using):
+    """
+    Return the total size in bytes of the indexes of the user, auth token and
+    verification token tables, or None if the database can't report it.
+    """
+    tables = [
+        get_user_model()._meta.db_table,
+        Token._meta.db_table,
+        VerificationToken._meta.db_table,
+    ]
+    connection = connections[using]
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'SELECT SUM(pg_indexes_size(t::regclass)) '
+                    'FROM unnest(%s) AS t',
+                    [tables],
+                )
+            elif connection.vendor == 'sqlite':
+                placeholders = ', '.join(['%s'] * len(tables))
+                cursor.execute(
+                    'SELECT SUM(pgsize) FROM dbstat WHERE name IN ('
+                    'SELECT name FROM sqlite_master WHERE type = %s '
+                    f'AND tbl_name IN ({placeholders}))',
+                    ['index', *tables],
+                )
+            else:
+                return None
+            return cursor.fetchone()[0]
+    except DatabaseError:
+        return None
+
+
+def measure_lookups(using, emails, token_keys):
+    """
+    Time the email and token key lookups of login and token authentication
+    and return the median of each in milliseconds.
+    """
+    User = get_user_model()
+
+    def median_ms(lookups):
+        durations = []
+        for lookup in lookups:
+            start = time.perf_counter()
+            lookup()
+            durations.append(time.perf_counter() - start)
+        return statistics.median(durations) * 1000 if durations else None
+
+    return {
+        'email': median_ms([
+            lambda email=email: User.objects.using(using).filter(
+                email=email,
+            ).first()
+            for email in emails
+        ]),
+        'token': median_ms([
+            lambda key=key: Token.objects.using(using).select_related(
+                'user',
+            ).filter(key=key).first()
+            for key in token_keys
+        ]),
+    }
@@ -0,0 +1,87 @@
+import hmac
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import authentication, exceptions
+from .activity import record_activity
+from .models import UserDirectoryEntry
+
+
+def get_token_expiration_date(created, last_seen=None):
+    """
+    Get the expiration date of a token created at `created` for a user last
+    seen at `last_seen`.
+
+    Tokens expire ACCOUNTS_TOKEN_TTL seconds after creation, or after
+    ACCOUNTS_TOKEN_IDLE_TTL seconds without activity, whichever is first.
+    Activity is read from User.last_seen, which the activity buffer writes at
+    most once per flush interval, so the sliding refresh adds no writes.
+    """
+    expiration_dates = []
+    if settings.ACCOUNTS_TOKEN_TTL is not None:
+        expiration_dates.append(
+            created + timedelta(seconds=settings.ACCOUNTS_TOKEN_TTL)
+        )
+    if settings.ACCOUNTS_TOKEN_IDLE_TTL is not None:
+        last_active = max(created, last_seen) if last_seen else created
+        expiration_dates.append(
+            last_active + timedelta(seconds=settings.ACCOUNTS_TOKEN_IDLE_TTL)
+        )
+    return min(expiration_dates, default=None)
+
+
+def is_token_expired(created, last_seen=None, now=None):
+    expiration_date = get_token_expiration_date(created, last_seen)
+    if expiration_date is None:
+        return False
+    return (now or timezone.now()) >= expiration_date
+
+
+class TokenAuthentication(authentication.TokenAuthentication):
+    """
+    Token authentication with expiry that records user activity.
+
+    Tokens are looked up on the shard the user directory locates them on.
+    """
+
+    def authenticate_credentials(self, key):
+        # api.exceptions imports rest_framework.views, which loads this class
+        from ...exceptions import TokenExpired
+
+        shard = UserDirectoryEntry.objects.get_shard(token_key=key)
+        if shard is None:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        model = self.get_model()
+        try:
+            token = model.objects.using(shard).select_related('user').get(
+                key=key,
+            )
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        user = token.user
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        if is_token_expired(token.created, user.last_seen):
+            raise TokenExpired
+        record_activity(user)
+        return user, token
+
+
+class ServiceAuthentication(authentication.TokenAuthentication):
+    """
+    Authentication of internal services by a shared key.
+
+    Clients authenticate with an "Authorization: Service <key>" header
+    carrying one of ACCOUNTS_SERVICE_KEYS. Services act as no user.
+    """
+    keyword = 'Service'
+
+    def authenticate_credentials(self, key):
+        for service_key in settings.ACCOUNTS_SERVICE_KEYS:
+            if hmac.compare_digest(key.encode(), service_key.encode()):
+                return AnonymousUser(), key
+        raise exceptions.AuthenticationFailed(_('Invalid service key.'))
@@ -0,0 +1,147 @@
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import models
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from . import events, stats
+from .archive import load_archived_user
+from .models import AccountDeletion, ArchivedUser, UserDirectoryEntry
+from .sharding import atomic_with_directory, get_user_db
+
+
+def request_account_deletion(user):
+    """
+    Deactivate a user, revoke their token and queue their account for
+    deletion.
+    """
+    using = get_user_db(user)
+    with atomic_with_directory(using):
+        user.is_active = False
+        user.save(update_fields=['is_active'])
+        Token.objects.using(using).filter(user=user).delete()
+        UserDirectoryEntry.objects.filter(user_id=user.pk).update(
+            token_key=None,
+        )
+        events.record_event(events.USER_DELETED, user)
+        deletion, _ = AccountDeletion.objects.get_or_create(
+            user_id=user.pk,
+            defaults={'shard': using},
+        )
+    return deletion
+
+
+def get_user_relations():
+    """
+    Return (model, user field) pairs for the rows that are deleted with a
+    user: reverse cascading foreign keys and many-to-many links.
+    """
+    User = get_user_model()
+    relations = [
+        (relation.related_model, relation.field.attname)
+        for relation in User._meta.related_objects
+        if not relation.many_to_many
+        and relation.on_delete is models.CASCADE
+    ]
+    for field in User._meta.many_to_many:
+        through = field.remote_field.through
+        relations.append((through, f'{field.m2m_field_name()}_id'))
+    return relations
+
+
+class AccountDeleter:
+    """
+    Delete queued accounts, removing related rows in bounded batches.
+
+    Every batch is a separate statement that commits on its own, so no lock
+    is held for longer than one batch takes regardless of how much data a
+    user has. The user row is deleted last, once nothing cascades from it.
+    Deleting is idempotent, so an interrupted deletion is simply run again.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings.ACCOUNTS_DELETION_BATCH_SIZE
+
+    def delete_pending(self):
+        """
+        Complete every queued deletion that is due and return how many were
+        completed.
+
+        A deletion that fails is logged and retried later with exponential
+        backoff, so it doesn't hold up the deletions queued behind it.
+        """
+        completed = 0
+        pending = AccountDeletion.objects.filter(
+            date_completed__isnull=True,
+            next_attempt_at__lte=timezone.now(),
+        ).order_by('id')
+        for deletion in pending:
+            try:
+                self.delete(deletion)
+            except Exception as exc:
+                print(f'Unable to delete account {deletion.user_id}: {exc}')
+                self.handle_failure(deletion, exc)
+            else:
+                completed += 1
+        return completed
+
+    def get_retry_delay(self, attempts):
+        return min(
+            settings.ACCOUNTS_DELETION_RETRY_DELAY * 2 ** (attempts - 1),
+            settings.ACCOUNTS_DELETION_MAX_RETRY_DELAY,
+        )
+
+    def handle_failure(self, deletion, error):
+        deletion.attempts += 1
+        deletion.last_error = str(error)
+        deletion.next_attempt_at = timezone.now() + timedelta(
+            seconds=self.get_retry_delay(deletion.attempts),
+        )
+        deletion.save(
+            update_fields=['attempts', 'last_error', 'next_attempt_at'],
+        )
+
+    def delete_in_batches(self, queryset):
+        deleted = 0
+        while True:
+            pks = list(queryset.values_list('pk', flat=True)[:self.batch_size])
+            if not pks:
+                return deleted
+            count, _ = queryset.model.objects.using(queryset.db).filter(
+                pk__in=pks,
+            ).delete()
+            deleted += count
+
+    def delete(self, deletion):
+        User = get_user_model()
+        using = deletion.shard
+        for model, field in get_user_relations():
+            deletion.rows_deleted += self.delete_in_batches(
+                model.objects.using(using).filter(**{field: deletion.user_id}),
+            )
+
+        with atomic_with_directory(using):
+            users = list(
+                User.objects.using(using)
+                .select_for_update()
+                .filter(pk=deletion.user_id)
+                .only('is_verified', 'date_joined')
+            )
+            count, _ = User.objects.using(using).filter(
+                pk=deletion.user_id,
+            ).delete()
+            deletion.rows_deleted += count
+            # The user may have been archived since deactivation
+            for archived in ArchivedUser.objects.using(using).filter(
+                pk=deletion.user_id,
+            ):
+                users.append(load_archived_user(archived))
+                archived.delete()
+                deletion.rows_deleted += 1
+            stats.record_users_deleted(users)
+            UserDirectoryEntry.objects.filter(
+                user_id=deletion.user_id,
+            ).delete()
+
+            deletion.date_completed = timezone.now()
+            deletion.save(update_fields=['rows_deleted', 'date_completed'])
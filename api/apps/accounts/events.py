@@ -0,0 +1,224 @@
+import http.client
+import json
+from datetime import timedelta
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from .models import DeadLetterEvent, OutboxEvent
+from .sharding import get_user_db
+
+
+USER_CREATED = 'user.created'
+USER_VERIFIED = 'user.verified'
+USER_EMAIL_CHANGED = 'user.email_changed'
+USER_PASSWORD_RESET = 'user.password_reset'
+USER_DELETED = 'user.deleted'
+
+
+def record_event(event_type, user, data=None):
+    """
+    Add an event for a user to the outbox of every webhook endpoint.
+
+    Call inside the transaction that makes the change so that the event is
+    committed if and only if the change is. Events are stored on the user's
+    shard.
+    """
+    payload = {
+        'type': event_type,
+        'user_id': user.pk,
+        'data': data or {},
+        'date_created': timezone.now(),
+    }
+    OutboxEvent.objects.using(get_user_db(user)).bulk_create([
+        OutboxEvent(
+            endpoint=endpoint,
+            event_type=event_type,
+            user_id=user.pk,
+            payload=payload,
+        )
+        for endpoint in settings.ACCOUNTS_EVENT_WEBHOOKS
+    ])
+
+
+class WebhookError(Exception):
+    pass
+
+
+class WebhookClient:
+    """
+    HTTP client that keeps one keep-alive connection open to an endpoint.
+    """
+
+    def __init__(self, url, timeout=None):
+        self.url = urlsplit(url)
+        self.timeout = timeout or settings.ACCOUNTS_EVENT_TIMEOUT
+        self.connection = None
+
+    def connect(self):
+        if self.url.scheme == 'https':
+            connection_class = http.client.HTTPSConnection
+        else:
+            connection_class = http.client.HTTPConnection
+        return connection_class(self.url.netloc, timeout=self.timeout)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def post(self, data):
+        body = json.dumps(data, cls=DjangoJSONEncoder).encode()
+        path = self.url.path or '/'
+        if self.url.query:
+            path = f'{path}?{self.url.query}'
+
+        if self.connection is None:
+            self.connection = self.connect()
+        try:
+            self.connection.request('POST', path, body=body, headers={
+                'Content-Type': 'application/json',
+                'Connection': 'keep-alive',
+            })
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException) as exc:
+            self.close()
+            raise WebhookError(str(exc) or exc.__class__.__name__)
+
+        if response.will_close:
+            self.close()
+        if not 200 <= response.status < 300:
+            raise WebhookError(f'Endpoint responded with {response.status}.')
+
+
+class EventDispatcher:
+    """
+    Deliver outbox events to their endpoints in batches.
+
+    Each endpoint gets a batch of its due events from each shard, oldest
+    first, in a single request. A failed batch is retried with exponential backoff, and every
+    later event of the same users is held back with it so that events for a
+    user are always delivered in order. Events that fail
+    ACCOUNTS_EVENT_MAX_ATTEMPTS times are moved to the dead-letter table.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings.ACCOUNTS_EVENT_BATCH_SIZE
+        self.clients = {}
+
+    def get_client(self, endpoint):
+        if endpoint not in self.clients:
+            self.clients[endpoint] = WebhookClient(endpoint)
+        return self.clients[endpoint]
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+
+    def dispatch(self):
+        """
+        Deliver one batch per endpoint and shard and return the number
+        delivered.
+        """
+        delivered = 0
+        for shard in settings.ACCOUNTS_SHARDS:
+            endpoints = (
+                OutboxEvent.objects
+                .using(shard)
+                .filter(next_attempt_at__lte=timezone.now())
+                .values_list('endpoint', flat=True)
+                .distinct()
+            )
+            for endpoint in endpoints:
+                delivered += self.dispatch_endpoint(endpoint, shard)
+        return delivered
+
+    def dispatch_endpoint(self, endpoint, using=DEFAULT_DB_ALIAS):
+        with transaction.atomic(using=using):
+            return self.dispatch_batch(endpoint, using)
+
+    def dispatch_batch(self, endpoint, using):
+        now = timezone.now()
+        # Events wait for earlier events of the same user that are waiting to
+        # be retried, so that each user's events are delivered in order
+        earlier_retrying = OutboxEvent.objects.using(using).filter(
+            endpoint=endpoint,
+            user_id=OuterRef('user_id'),
+            id__lt=OuterRef('id'),
+            next_attempt_at__gt=now,
+        )
+        # A second dispatcher waits for the batch instead of skipping ahead,
+        # which would also break per-user ordering
+        events = list(
+            OutboxEvent.objects
+            .using(using)
+            .select_for_update()
+            .filter(endpoint=endpoint, next_attempt_at__lte=now)
+            .exclude(Exists(earlier_retrying))
+            .order_by('id')[:self.batch_size]
+        )
+        if not events:
+            return 0
+
+        try:
+            self.get_client(endpoint).post({
+                'events': [
+                    {'id': event.id, **event.payload} for event in events
+                ],
+            })
+        except WebhookError as exc:
+            self.handle_failure(endpoint, events, str(exc), using)
+            return 0
+        else:
+            OutboxEvent.objects.using(using).filter(
+                pk__in=[event.pk for event in events],
+            ).delete()
+            return len(events)
+
+    def get_retry_delay(self, attempts):
+        return min(
+            settings.ACCOUNTS_EVENT_RETRY_DELAY * 2 ** (attempts - 1),
+            settings.ACCOUNTS_EVENT_MAX_RETRY_DELAY,
+        )
+
+    def handle_failure(self, endpoint, events, error, using=DEFAULT_DB_ALIAS):
+        dead = []
+        for event in events:
+            event.attempts += 1
+            event.last_error = error
+            if event.attempts >= settings.ACCOUNTS_EVENT_MAX_ATTEMPTS:
+                dead.append(event)
+
+        DeadLetterEvent.objects.using(using).bulk_create([
+            DeadLetterEvent(
+                endpoint=event.endpoint,
+                event_type=event.event_type,
+                user_id=event.user_id,
+                payload=event.payload,
+                date_created=event.date_created,
+                attempts=event.attempts,
+                last_error=event.last_error,
+            )
+            for event in dead
+        ])
+        OutboxEvent.objects.using(using).filter(
+            pk__in=[event.pk for event in dead],
+        ).delete()
+
+        retrying = [event for event in events if event not in dead]
+        if not retrying:
+            return
+
+        attempts = max(event.attempts for event in retrying)
+        next_attempt_at = timezone.now() + timedelta(
+            seconds=self.get_retry_delay(attempts),
+        )
+        for event in retrying:
+            event.next_attempt_at = next_attempt_at
+        OutboxEvent.objects.using(using).bulk_update(
+            retrying,
+            ['attempts', 'last_error', 'next_attempt_at'],
+        )
@@ -0,0 +1,178 @@
+import csv
+import time
+import zlib
+from itertools import chain
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Value
+from rest_framework.authtoken.models import Token
+from .archive import get_archived_verification_token
+from .models import ArchivedUser
+
+
+EXPORT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+EXPORT_FIELDS = [
+    ('id', 'id'),
+    ('email', 'email'),
+    ('first_name', 'first_name'),
+    ('last_name', 'last_name'),
+    ('is_verified', 'is_verified'),
+    ('is_active', 'is_active'),
+    ('is_staff', 'is_staff'),
+    ('date_joined', 'date_joined'),
+    ('last_login', 'last_login'),
+    ('last_seen', 'last_seen'),
+    ('verification_token_is_active', 'verificationtoken__is_active'),
+    ('verification_token_date_created', 'verificationtoken__date_created'),
+    ('auth_token_created', 'auth_token__created'),
+    ('is_archived', 'is_archived'),
+]
+
+
+class Echo:
+    """
+    File-like object that returns what is written to it, for csv.writer.
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_user_rows(chunk_size=2000):
+    """
+    Iterate over every user as a tuple of EXPORT_FIELDS values, one shard
+    after the other, followed on each shard by its archived users.
+
+    Rows are fetched in chunks through a server-side cursor on PostgreSQL and
+    no model instances are built for live users, so memory use does not grow
+    with the number of users.
+    """
+    User = get_user_model()
+    return chain.from_iterable(
+        chain(
+            User.objects.using(shard).order_by()
+            .annotate(is_archived=Value(False))
+            .values_list(*[lookup for _, lookup in EXPORT_FIELDS])
+            .iterator(chunk_size=chunk_size),
+            (
+                get_archived_user_row(archived)
+                for archived in ArchivedUser.objects.using(shard)
+                .order_by().only('data').iterator(chunk_size=chunk_size)
+            ),
+        )
+        for shard in settings.ACCOUNTS_SHARDS
+    )
+
+
+def get_archived_user_row(archived):
+    """
+    Return an archived user as a tuple of EXPORT_FIELDS values.
+    """
+    objects = [
+        deserialized.object
+        for deserialized in serializers.deserialize('python', archived.data)
+    ]
+    related = {
+        'verificationtoken': get_archived_verification_token(objects),
+        'auth_token': next(
+            (instance for instance in objects if isinstance(instance, Token)),
+            None,
+        ),
+    }
+
+    row = []
+    for name, lookup in EXPORT_FIELDS:
+        if name == 'is_archived':
+            row.append(True)
+        elif '__' in lookup:
+            relation, field = lookup.split('__')
+            instance = related[relation]
+            row.append(None if instance is None else getattr(instance, field))
+        else:
+            row.append(getattr(objects[0], lookup))
+    return tuple(row)
+
+
+def iter_ndjson(rows):
+    names = [name for name, _ in EXPORT_FIELDS]
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(dict(zip(names, row))) + '\n'
+
+
+def iter_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow([name for name, _ in EXPORT_FIELDS])
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class UserExport:
+    """
+    Iterable of all users encoded as bytes in the given export type.
+
+    Encoded rows are joined into blocks of chunk_size rows before they are
+    yielded and optionally gzip compressed. The number of rows exported and
+    the elapsed time are available once iteration has finished.
+    """
+
+    def __init__(self, export_type='ndjson', compress=False, chunk_size=2000):
+        self.export_type = export_type
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.rows = 0
+        self.elapsed = 0
+
+    @property
+    def filename(self):
+        filename = f'users.{self.export_type}'
+        return f'{filename}.gz' if self.compress else filename
+
+    @property
+    def content_type(self):
+        if self.compress:
+            return 'application/gzip'
+        return EXPORT_TYPES[self.export_type]
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0
+
+    def iter_blocks(self):
+        encode = iter_ndjson if self.export_type == 'ndjson' else iter_csv
+        rows = iter_user_rows(self.chunk_size)
+
+        def count_rows():
+            for row in rows:
+                self.rows += 1
+                yield row
+
+        start = time.perf_counter()
+        block = []
+        for line in encode(count_rows()):
+            block.append(line)
+            if len(block) >= self.chunk_size:
+                yield ''.join(block).encode()
+                block = []
+        if block:
+            yield ''.join(block).encode()
+        self.elapsed = time.perf_counter() - start
+
+    def __iter__(self):
+        blocks = self.iter_blocks()
+        return iter_gzip(blocks) if self.compress else blocks
@@ -0,0 +1,187 @@
+import json
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+from rest_framework import status
+from rest_framework.response import Response
+from ...exceptions import (
+    IdempotencyConflict,
+    IdempotencyKeyMismatch,
+    ValidationError,
+)
+from .models import IdempotencyKey
+
+
+class IdempotentReplay(Exception):
+    """
+    Raised to short-circuit a view with a stored response.
+    """
+
+    def __init__(self, record):
+        super().__init__(record.key)
+        self.record = record
+
+
+def get_request_fingerprint(request):
+    """
+    Fingerprint a request by method, path, credentials and body.
+
+    The fingerprint is an HMAC so that the passwords in the bodies of these
+    requests are not stored in a recoverable form.
+    """
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+
+    message = json.dumps(
+        [
+            request.method,
+            request.path,
+            request.headers.get('Authorization', ''),
+            data,
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return salted_hmac(__name__, message, algorithm='sha256').hexdigest()
+
+
+def get_lock_expiry(now):
+    return now + timedelta(seconds=settings.ACCOUNTS_IDEMPOTENCY_LOCK_TIMEOUT)
+
+
+def claim_idempotency_key(scope, key, fingerprint):
+    """
+    Claim a key for a new request, or raise for a repeated one.
+
+    The unique (scope, key) row acts as the lock: of several concurrent
+    requests with the same key only one can insert it, the others get
+    IdempotencyConflict until the first one has stored its response. The
+    lock is a lease: once locked_until has passed without a response, the
+    request that held it is taken to have died and a retry takes it over.
+    """
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(
+                scope=scope,
+                key=key,
+                fingerprint=fingerprint,
+                locked_until=get_lock_expiry(now),
+                expires_at=now + timedelta(
+                    seconds=settings.ACCOUNTS_IDEMPOTENCY_KEY_TTL,
+                ),
+            )
+    except IntegrityError:
+        pass
+
+    try:
+        record = IdempotencyKey.objects.get(scope=scope, key=key)
+    except IdempotencyKey.DoesNotExist:
+        # Released by the request that held it
+        raise IdempotencyConflict
+
+    if record.expires_at <= now:
+        record.delete()
+        return claim_idempotency_key(scope, key, fingerprint)
+    elif not constant_time_compare(record.fingerprint, fingerprint):
+        raise IdempotencyKeyMismatch
+    elif record.status_code is not None:
+        raise IdempotentReplay(record)
+    elif record.locked_until is not None and record.locked_until <= now:
+        # Of several retries taking over the same lease only one updates it
+        locked_until = get_lock_expiry(now)
+        if IdempotencyKey.objects.filter(
+            pk=record.pk,
+            status_code__isnull=True,
+            locked_until=record.locked_until,
+        ).update(locked_until=locked_until):
+            record.locked_until = locked_until
+            return record
+    raise IdempotencyConflict
+
+
+def get_held_record(record):
+    """
+    Return a queryset of a claimed key's row, empty once the request lost
+    its lease to a retry.
+    """
+    return IdempotencyKey.objects.filter(
+        pk=record.pk,
+        locked_until=record.locked_until,
+    )
+
+
+class IdempotentMixin:
+    """
+    Support the Idempotency-Key header on a view.
+
+    The first request with a key runs normally and a successful response is
+    stored. Repeats of that request within ACCOUNTS_IDEMPOTENCY_KEY_TTL get
+    the stored response without running the view again. Keys are checked
+    before authentication so that a retry still succeeds after the first
+    attempt rotated the caller's auth token; the fingerprint includes the
+    credentials, so only the original caller can replay a response.
+    """
+    idempotent_methods = ('POST', 'PATCH')
+
+    def get_idempotency_scope(self):
+        return self.__class__.__name__
+
+    def initial(self, request, *args, **kwargs):
+        self.idempotency_record = None
+        key = request.headers.get('Idempotency-Key', '').strip()
+
+        if key and request.method in self.idempotent_methods:
+            if len(key) > 255:
+                raise ValidationError(errors={
+                    'Idempotency-Key': [
+                        'Ensure this field has no more than 255 characters.'
+                    ],
+                })
+            self.idempotency_record = claim_idempotency_key(
+                self.get_idempotency_scope(),
+                key,
+                get_request_fingerprint(request),
+            )
+
+        super().initial(request, *args, **kwargs)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, IdempotentReplay):
+            response = Response(
+                exc.record.response_data,
+                status=exc.record.status_code,
+            )
+            response['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            return super().handle_exception(exc)
+        except Exception:
+            self.release_idempotency_key()
+            raise
+
+    def release_idempotency_key(self):
+        record = getattr(self, 'idempotency_record', None)
+        if record is not None:
+            get_held_record(record).delete()
+            self.idempotency_record = None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        record = getattr(self, 'idempotency_record', None)
+        if record is not None:
+            if status.is_success(response.status_code):
+                get_held_record(record).update(
+                    status_code=response.status_code,
+                    response_data=response.data,
+                    locked_until=None,
+                )
+                self.idempotency_record = None
+            else:
+                # Let the client retry requests that did not succeed
+                self.release_idempotency_key()
+
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -0,0 +1,99 @@
+import hashlib
+import uuid
+from collections import defaultdict
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Q
+from .models import UserDirectoryEntry
+from .serializers import UserSerializer
+
+
+def get_id_cache_key(user_id):
+    return f'accounts:lookup:id:{user_id}'
+
+
+def get_email_cache_key(email):
+    # Hashed, as emails may be longer or contain more than cache keys can
+    digest = hashlib.sha1(email.encode()).hexdigest()
+    return f'accounts:lookup:email:{digest}'
+
+
+def get_users(ids, emails):
+    """
+    Return the active users with any of the ids or emails, with one query
+    per shard holding any of them.
+    """
+    User = get_user_model()
+    shards = settings.ACCOUNTS_SHARDS
+    if len(shards) == 1:
+        lookups = {shards[0]: Q(pk__in=ids) | Q(email__in=emails)}
+    else:
+        user_ids = defaultdict(list)
+        for user_id, shard in UserDirectoryEntry.objects.filter(
+            Q(user_id__in=ids) | Q(email__in=emails),
+            is_archived=False,
+        ).values_list('user_id', 'shard'):
+            user_ids[shard].append(user_id)
+        lookups = {
+            shard: Q(pk__in=shard_user_ids)
+            for shard, shard_user_ids in user_ids.items()
+        }
+
+    users = []
+    for shard, lookup in lookups.items():
+        users.extend(
+            User.objects.using(shard).filter(lookup, is_active=True)
+        )
+    return users
+
+
+def lookup_users(ids=(), emails=()):
+    """
+    Look up users by id and by email, returning serialized users keyed by
+    the given ids and by the given emails, or None for those not found.
+
+    Ids must be valid UUIDs. Emails are matched case-insensitively.
+
+    With ACCOUNTS_USER_LOOKUP_CACHE_TTL set, found users are cached for that
+    many seconds and only the ones not in the cache are queried, so changes
+    to a user can take that long to show. Users not found are not cached.
+    """
+    ids = {user_id: str(uuid.UUID(str(user_id))) for user_id in ids}
+    emails = {email: email.strip().lower() for email in emails}
+    id_keys = {user_id: get_id_cache_key(user_id) for user_id in ids.values()}
+    email_keys = {
+        email: get_email_cache_key(email) for email in emails.values()
+    }
+
+    ttl = settings.ACCOUNTS_USER_LOOKUP_CACHE_TTL
+    found = {}
+    if ttl:
+        found = cache.get_many([*id_keys.values(), *email_keys.values()])
+
+    missing_ids = {
+        user_id for user_id, key in id_keys.items() if key not in found
+    }
+    missing_emails = {
+        email for email, key in email_keys.items() if key not in found
+    }
+    if missing_ids or missing_emails:
+        users = get_users(missing_ids, missing_emails)
+        fetched = {}
+        for data in UserSerializer(users, many=True).data:
+            fetched[get_id_cache_key(data['id'])] = data
+            fetched[get_email_cache_key(data['email'])] = data
+        if ttl and fetched:
+            cache.set_many(fetched, ttl)
+        found.update(fetched)
+
+    return {
+        'ids': {
+            user_id: found.get(id_keys[normalized])
+            for user_id, normalized in ids.items()
+        },
+        'emails': {
+            email: found.get(email_keys[normalized])
+            for email, normalized in emails.items()
+        },
+    }
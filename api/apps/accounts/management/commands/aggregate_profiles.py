@@ -0,0 +1,94 @@
+import glob
+import io
+import os
+import pstats
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        'Aggregate request profiles per view name. Sampled stacks are '
+        'merged into one flamegraph-ready folded file per view; cProfile '
+        'files are merged and summarized.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None)
+        parser.add_argument('--view', help='Only aggregate this view name.')
+        parser.add_argument(
+            '--output',
+            help='Directory for aggregated folded files. Defaults to --dir.',
+        )
+        parser.add_argument('--top', type=int, default=10)
+
+    def get_profiles(self, directory, extension):
+        profiles = defaultdict(list)
+        for path in glob.glob(os.path.join(directory, f'*.{extension}')):
+            filename = os.path.basename(path)
+            if '__' not in filename:
+                continue
+            view_name = filename.split('__', 1)[0]
+            profiles[view_name].append(path)
+        return profiles
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or settings.PROFILING_DIR
+        output = options['output'] or directory
+        os.makedirs(output, exist_ok=True)
+
+        samples = self.get_profiles(directory, 'folded')
+        cprofiles = self.get_profiles(directory, 'prof')
+        view_names = sorted(set(samples) | set(cprofiles))
+        if options['view']:
+            view_names = [name for name in view_names if name == options['view']]
+
+        for view_name in view_names:
+            if view_name in samples:
+                self.aggregate_samples(
+                    view_name,
+                    samples[view_name],
+                    output,
+                    options['top'],
+                )
+            if view_name in cprofiles:
+                self.aggregate_cprofiles(
+                    view_name,
+                    cprofiles[view_name],
+                    options['top'],
+                )
+
+    def aggregate_samples(self, view_name, paths, output, top):
+        stacks = Counter()
+        for path in paths:
+            with open(path) as profile:
+                for line in profile:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    if stack:
+                        stacks[stack] += int(count)
+
+        aggregate_path = os.path.join(output, f'{view_name}.folded')
+        with open(aggregate_path, 'w') as aggregate:
+            for stack, count in stacks.most_common():
+                aggregate.write(f'{stack} {count}\n')
+
+        total = sum(stacks.values())
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+
+        self.stdout.write(
+            f'{view_name}: {len(paths)} sampled requests, {total} samples '
+            f'-> {aggregate_path}'
+        )
+        for frame, count in leaves.most_common(top):
+            self.stdout.write(f'  {count / total:6.1%}  {frame}')
+
+    def aggregate_cprofiles(self, view_name, paths, top):
+        stream = io.StringIO()
+        stats = pstats.Stats(*paths, stream=stream)
+        stats.sort_stats('cumulative').print_stats(top)
+
+        self.stdout.write(f'{view_name}: {len(paths)} cProfile requests')
+        self.stdout.write(stream.getvalue())
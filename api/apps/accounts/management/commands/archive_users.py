@@ -0,0 +1,144 @@
+import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from ...archive import (
+    archive_users,
+    get_cold_users,
+    get_index_sizes,
+    measure_lookups,
+)
+from ...models import VerificationToken
+
+
+def format_size(size):
+    if size is None:
+        return 'n/a'
+    return f'{size / 1024 / 1024:.1f} MB'
+
+
+def format_ms(value):
+    if value is None:
+        return 'n/a'
+    return f'{value:.3f} ms'
+
+
+class Command(BaseCommand):
+    help = (
+        'Move cold users, with their auth and verification tokens, to the '
+        'archive in batches, and report index size and lookup latency '
+        'before and after. Archived users are restored when they log in or '
+        'reset their password.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count the cold users without archiving them.',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0,
+            help='Seconds to pause between batches.',
+        )
+        parser.add_argument(
+            '--samples',
+            type=int,
+            default=200,
+            help='Number of remaining users to time lookups for.',
+        )
+        parser.add_argument(
+            '--reindex',
+            action='store_true',
+            help=(
+                'Rebuild the indexes afterwards. PostgreSQL only releases '
+                'the space of deleted index entries when they are rebuilt.'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        now = timezone.now()
+        for shard in settings.ACCOUNTS_SHARDS:
+            self.archive_shard(shard, now)
+
+    def archive_shard(self, using, now):
+        User = get_user_model()
+        cold = get_cold_users(using, now)
+        sample = (
+            User.objects.using(using)
+            .exclude(pk__in=cold.values('pk'))
+            .filter(auth_token__isnull=False)
+            .values_list('email', 'auth_token__key')
+            [:self.options['samples']]
+        )
+        emails = [email for email, _ in sample]
+        token_keys = [key for _, key in sample]
+
+        if self.options['dry_run']:
+            self.stdout.write(f'{using}: {cold.count()} cold users.')
+            return
+
+        size_before = get_index_sizes(using)
+        latency_before = measure_lookups(using, emails, token_keys)
+
+        start = time.perf_counter()
+        archived = 0
+        last_pk = None
+        while True:
+            batch = cold.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            user_ids = list(
+                batch.values_list('pk', flat=True)[:self.options['batch_size']]
+            )
+            if not user_ids:
+                break
+            last_pk = user_ids[-1]
+            archived += archive_users(user_ids, using, now)
+
+            if self.options['sleep']:
+                time.sleep(self.options['sleep'])
+        elapsed = time.perf_counter() - start
+
+        if self.options['reindex']:
+            self.reindex(using)
+        size_after = get_index_sizes(using)
+        latency_after = measure_lookups(using, emails, token_keys)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{using}: archived {archived} users in {elapsed:.1f}s.'
+        ))
+        self.stdout.write(
+            f'  index size: {format_size(size_before)} -> '
+            f'{format_size(size_after)}'
+        )
+        for lookup in ('email', 'token'):
+            self.stdout.write(
+                f'  {lookup} lookup: '
+                f'{format_ms(latency_before[lookup])} -> '
+                f'{format_ms(latency_after[lookup])}'
+            )
+
+    def reindex(self, using):
+        connection = connections[using]
+        tables = [
+            get_user_model()._meta.db_table,
+            Token._meta.db_table,
+            VerificationToken._meta.db_table,
+        ]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                for table in tables:
+                    cursor.execute(
+                        'REINDEX TABLE CONCURRENTLY '
+                        f'{connection.ops.quote_name(table)}'
+                    )
+            elif connection.vendor == 'sqlite':
+                cursor.execute('VACUUM')
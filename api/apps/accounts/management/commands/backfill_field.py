@@ -0,0 +1,78 @@
+import json
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import FieldDoesNotExist
+from django.db import router
+from django.db.models import F
+from .....operations import backfill
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill a field of existing rows on every shard in throttled batches, '
+        'each committed on its own, reporting progress. By default only '
+        'rows where the field is null are filled.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', metavar='app_label.Model')
+        parser.add_argument('field')
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--value', help='Value to set, as JSON.')
+        source.add_argument('--copy-from', help='Field to copy the value of.')
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Fill every row, not only those where the field is null.',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.1,
+            help='Seconds to pause between batches.',
+        )
+        parser.add_argument(
+            '--database',
+            action='append',
+            dest='databases',
+            help='Database to fill on. Defaults to every shard.',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+            model._meta.get_field(options['field'])
+            if options['copy_from']:
+                model._meta.get_field(options['copy_from'])
+        except (LookupError, ValueError, FieldDoesNotExist) as exc:
+            raise CommandError(exc)
+
+        if options['copy_from']:
+            value = F(options['copy_from'])
+        else:
+            try:
+                value = json.loads(options['value'])
+            except ValueError as exc:
+                raise CommandError(f'Invalid JSON value: {exc}')
+
+        total = 0
+        for using in options['databases'] or settings.ACCOUNTS_SHARDS:
+            if not router.allow_migrate_model(using, model):
+                continue
+            queryset = model._base_manager.using(using)
+            if not options['all']:
+                queryset = queryset.filter(
+                    **{f'{options["field"]}__isnull': True},
+                )
+            self.stdout.write(f'{using}:')
+            total += backfill(
+                queryset,
+                {options['field']: value},
+                batch_size=options['batch_size'],
+                sleep=options['sleep'],
+                stdout=self.stdout,
+            )
+
+        self.stdout.write(self.style.SUCCESS(f'Filled {total} rows.'))
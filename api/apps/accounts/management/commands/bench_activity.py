@@ -0,0 +1,70 @@
+import random
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from ...activity import ActivityBuffer
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate authenticated traffic against the activity buffer and '
+        'report how many last_seen writes are saved by coalescing.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--requests', type=int, default=10000)
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=200,
+            help='Simulated requests per second.',
+        )
+        parser.add_argument('--interval', type=float, default=None)
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        user_ids = list(
+            User.objects.values_list('pk', flat=True)[:options['users']]
+        )
+        if not user_ids:
+            raise CommandError('No users to simulate activity for.')
+
+        clock = SimulatedClock()
+        buffer = ActivityBuffer(interval=options['interval'], clock=clock)
+        step = 1 / options['rate']
+
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                for _ in range(options['requests']):
+                    clock.now += step
+                    buffer.record(random.choice(user_ids))
+                buffer.flush()
+            transaction.set_rollback(True)
+
+        stats = buffer.get_stats()
+        updates = sum(
+            1 for query in queries.captured_queries
+            if query['sql'].startswith('UPDATE')
+        )
+        saved = 1 - stats['rows_written'] / stats['recorded']
+
+        self.stdout.write(
+            f'users={len(user_ids)} requests={stats["recorded"]} '
+            f'simulated_seconds={clock.now:.1f} interval={buffer.interval}s'
+        )
+        self.stdout.write(
+            f'naive writes={stats["recorded"]} '
+            f'buffered rows={stats["rows_written"]} '
+            f'update statements={updates} '
+            f'writes saved={saved:.1%}'
+        )
@@ -0,0 +1,94 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework import serializers
+from .....fields import ChoiceField
+from ...serializers import UserSerializer
+
+
+def linear_to_internal_value(field, data):
+    """
+    ChoiceField conversion as it was before the reverse index.
+    """
+    for key, val in field._choices.items():
+        if val == data:
+            return key
+    field.fail('invalid_choice', input=data)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark validation of bulk user payloads and ChoiceField '
+        'conversion.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=10000)
+        parser.add_argument('--choices', type=int, default=200)
+
+    def time_call(self, function):
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+        return elapsed * 1000, len(queries)
+
+    def handle(self, *args, **options):
+        payload = [
+            {
+                'email': f'bulkuser{i}@example.com',
+                'password': 'bulkpassword',
+                'first_name': 'Bulk',
+                'last_name': f'User{i}',
+            }
+            for i in range(options['items'])
+        ]
+
+        def validate_per_item():
+            serializer = serializers.ListSerializer(
+                child=UserSerializer(),
+                data=payload,
+            )
+            serializer.is_valid()
+
+        def validate_batch():
+            serializer = UserSerializer(data=payload, many=True)
+            serializer.is_valid()
+
+        for name, function in [
+            ('per-item validation', validate_per_item),
+            ('batch validation', validate_batch),
+        ]:
+            elapsed, queries = self.time_call(function)
+            self.stdout.write(
+                f'{name}: {options["items"]} items in {elapsed:.0f} ms, '
+                f'{queries} queries'
+            )
+
+        field = ChoiceField(choices=[
+            (i, f'Choice {i}') for i in range(options['choices'])
+        ])
+        inputs = [
+            f'Choice {i % options["choices"]}' for i in range(options['items'])
+        ]
+
+        elapsed, _ = self.time_call(
+            lambda: [linear_to_internal_value(field, data) for data in inputs]
+        )
+        self.stdout.write(
+            f'ChoiceField linear scan: {elapsed:.1f} ms for '
+            f'{options["items"]} conversions over {options["choices"]} choices'
+        )
+        elapsed, _ = self.time_call(
+            lambda: [field.to_internal_value(data) for data in inputs]
+        )
+        self.stdout.write(
+            f'ChoiceField indexed lookup: {elapsed:.1f} ms for '
+            f'{options["items"]} conversions over {options["choices"]} choices'
+        )
@@ -0,0 +1,71 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare per-request latency of the route-scoped middleware stack '
+        'with a flat stack that runs the default profile on every request '
+        'along with the middleware of the benchmarked route.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/accounts/retrieve/')
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--token', help='Auth token to send.')
+
+    def time_requests(self, options):
+        headers = {}
+        if options['token']:
+            headers['HTTP_AUTHORIZATION'] = f'Token {options["token"]}'
+
+        client = Client()
+        client.get(options['path'], **headers)
+
+        start = time.perf_counter()
+        for _ in range(options['requests']):
+            client.get(options['path'], **headers)
+        elapsed = time.perf_counter() - start
+        return elapsed / options['requests'] * 1e6
+
+    def get_route_profile(self, path):
+        # Longest prefix first, as RouteScopedMiddleware matches routes
+        for prefix, name in sorted(
+            settings.MIDDLEWARE_ROUTES.items(),
+            key=lambda route: len(route[0]),
+            reverse=True,
+        ):
+            if path.startswith(prefix):
+                return name
+        return 'default'
+
+    def handle(self, *args, **options):
+        # The flat stack runs the default profile and the profile of the
+        # benchmarked route, so both stacks run the route's middleware
+        route_profile = self.get_route_profile(options['path'])
+        flat_middleware = [
+            *[
+                path for path in settings.MIDDLEWARE
+                if path != 'api.middleware.RouteScopedMiddleware'
+            ],
+            *settings.MIDDLEWARE_PROFILES['default'],
+        ]
+        if route_profile != 'default':
+            flat_middleware.extend(settings.MIDDLEWARE_PROFILES[route_profile])
+        allowed_hosts = [*settings.ALLOWED_HOSTS, 'testserver']
+
+        with override_settings(ALLOWED_HOSTS=allowed_hosts):
+            scoped = self.time_requests(options)
+            with override_settings(MIDDLEWARE=flat_middleware):
+                flat = self.time_requests(options)
+
+        self.stdout.write(
+            f'path={options["path"]} profile={route_profile} '
+            f'requests={options["requests"]}'
+        )
+        self.stdout.write(f'flat stack:   {flat:.1f} us/request')
+        self.stdout.write(f'route-scoped: {scoped:.1f} us/request')
+        self.stdout.write(f'saved:        {flat - scoped:.1f} us/request')
@@ -0,0 +1,45 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework import authentication
+from rest_framework.authtoken.models import Token
+from ...authentication import TokenAuthentication, is_token_expired
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare authentication latency of the project token authentication '
+        '(expiry and activity tracking) with plain DRF token authentication.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000)
+
+    def time_authentication(self, backend, keys, requests):
+        start = time.perf_counter()
+        for i in range(requests):
+            backend.authenticate_credentials(keys[i % len(keys)])
+        return (time.perf_counter() - start) / requests * 1e6
+
+    def handle(self, *args, **options):
+        tokens = Token.objects.values_list('key', 'created', 'user__last_seen')
+        keys = [
+            key for key, created, last_seen in tokens[:1000]
+            if not is_token_expired(created, last_seen)
+        ]
+        if not keys:
+            raise CommandError('No unexpired auth tokens to authenticate with.')
+
+        plain = self.time_authentication(
+            authentication.TokenAuthentication(),
+            keys,
+            options['requests'],
+        )
+        project = self.time_authentication(
+            TokenAuthentication(),
+            keys,
+            options['requests'],
+        )
+
+        self.stdout.write(f'drf token auth:     {plain:.1f} us/request')
+        self.stdout.write(f'project token auth: {project:.1f} us/request')
+        self.stdout.write(f'difference:         {project - plain:.1f} us/request')
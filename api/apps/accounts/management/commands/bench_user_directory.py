@@ -0,0 +1,43 @@
+import time
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from ...pagination import encode_cursor, get_keyset_page
+
+
+class Command(BaseCommand):
+    help = (
+        'Walk the user directory page by page and report query latency at '
+        'increasing page depths.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=10000)
+        parser.add_argument('--page-size', type=int, default=50)
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        queryset = User.objects.only(
+            'id',
+            'date_joined',
+            'email',
+            'first_name',
+            'last_name',
+            'is_verified',
+        )
+        checkpoints = {1, 10, 100, 1000, 10000, options['pages']}
+
+        cursor = None
+        for page_number in range(1, options['pages'] + 1):
+            start = time.perf_counter()
+            page, has_next = get_keyset_page(
+                queryset,
+                cursor,
+                options['page_size'],
+            )
+            elapsed = (time.perf_counter() - start) * 1000
+
+            if page_number in checkpoints or not has_next:
+                self.stdout.write(f'page {page_number}: {elapsed:.2f} ms')
+            if not has_next:
+                break
+            cursor = encode_cursor(page[-1])
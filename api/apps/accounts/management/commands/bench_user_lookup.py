@@ -0,0 +1,94 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+from ...authentication import is_token_expired
+from ...lookup import get_email_cache_key, get_id_cache_key
+
+SERVICE_KEY = 'bench-user-lookup'
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare resolving a batch of users one RetrieveUserView request per '
+        'user with one bulk lookup request, uncached and cached.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--rounds', type=int, default=5)
+
+    def get_tokens(self, count):
+        tokens = []
+        for shard in settings.ACCOUNTS_SHARDS:
+            rows = Token.objects.using(shard).values_list(
+                'key', 'user_id', 'user__email', 'created', 'user__last_seen',
+            )[:count * 2]
+            tokens.extend(
+                (key, str(user_id), email)
+                for key, user_id, email, created, last_seen in rows
+                if not is_token_expired(created, last_seen)
+            )
+        return tokens[:count]
+
+    def time_rounds(self, rounds, run):
+        run()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            run()
+        return (time.perf_counter() - start) / rounds * 1000
+
+    def handle(self, *args, **options):
+        tokens = self.get_tokens(options['users'])
+        if not tokens:
+            raise CommandError('No unexpired auth tokens to look users up by.')
+        client = Client()
+        user_ids = [user_id for _, user_id, _ in tokens]
+        # Only the benchmarked users' lookup entries, cached by id and by
+        # email, are dropped, leaving the rest of a shared cache alone
+        cache_keys = [
+            key
+            for _, user_id, email in tokens
+            for key in (get_id_cache_key(user_id), get_email_cache_key(email))
+        ]
+
+        def retrieve_each():
+            for key, _, _ in tokens:
+                client.get(
+                    '/accounts/retrieve/',
+                    HTTP_AUTHORIZATION=f'Token {key}',
+                )
+
+        def lookup():
+            cache.delete_many(cache_keys)
+            post_lookup()
+
+        def post_lookup():
+            response = client.post(
+                '/accounts/users/lookup/',
+                {'ids': user_ids},
+                content_type='application/json',
+                HTTP_AUTHORIZATION=f'Service {SERVICE_KEY}',
+            )
+            if response.status_code != 200:
+                raise CommandError(f'Lookup failed: {response.content}')
+
+        with override_settings(
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            ACCOUNTS_SERVICE_KEYS=[SERVICE_KEY],
+            ACCOUNTS_USER_LOOKUP_MAX=max(len(user_ids), 1),
+        ):
+            rounds = options['rounds']
+            per_request = self.time_rounds(rounds, retrieve_each)
+            with override_settings(ACCOUNTS_USER_LOOKUP_CACHE_TTL=60):
+                bulk = self.time_rounds(rounds, lookup)
+                cached = self.time_rounds(rounds, post_lookup)
+            cache.delete_many(cache_keys)
+
+        self.stdout.write(f'users={len(tokens)} rounds={rounds}')
+        self.stdout.write(f'one request per user: {per_request:.1f} ms/batch')
+        self.stdout.write(f'bulk lookup:          {bulk:.1f} ms/batch')
+        self.stdout.write(f'bulk lookup, cached:  {cached:.1f} ms/batch')
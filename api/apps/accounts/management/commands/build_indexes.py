@@ -0,0 +1,109 @@
+import time
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+from .....operations import (
+    INDEX_BUILDING,
+    INDEX_VALID,
+    add_index_concurrently,
+    drop_index_concurrently,
+    get_index_state,
+    get_model_indexes,
+    get_invalid_indexes,
+)
+
+
+DEFAULT_MODELS = [
+    'accounts.User',
+    'authtoken.Token',
+    'accounts.VerificationToken',
+]
+
+
+class Command(BaseCommand):
+    help = (
+        'Build the indexes declared on models, in Meta.indexes or, on '
+        'PostgreSQL, postgres_indexes, that are missing from the database '
+        'without blocking writes, using CREATE INDEX CONCURRENTLY on '
+        'PostgreSQL. Indexes left invalid by failed builds are rebuilt. '
+        'Migrations using api.operations.AddIndexConcurrently skip indexes '
+        'built this way, so they can be built ahead of a deploy.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'models',
+            nargs='*',
+            metavar='app_label.Model',
+            help=(
+                'Models to build indexes for. Defaults to users, auth '
+                'tokens and verification tokens.'
+            ),
+        )
+        parser.add_argument(
+            '--database',
+            action='append',
+            dest='databases',
+            help='Database to build on. Defaults to every shard.',
+        )
+        parser.add_argument(
+            '--clean-invalid',
+            action='store_true',
+            help=(
+                'First drop every invalid index left by failed concurrent '
+                'builds or reindexes, declared or not.'
+            ),
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would be dropped and built without doing it.',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            models = [
+                apps.get_model(label)
+                for label in options['models'] or DEFAULT_MODELS
+            ]
+        except (LookupError, ValueError) as exc:
+            raise CommandError(exc)
+
+        for using in options['databases'] or settings.ACCOUNTS_SHARDS:
+            if options['clean_invalid']:
+                self.clean_invalid(using, options['dry_run'])
+            for model in models:
+                if router.allow_migrate_model(using, model):
+                    self.build(using, model, options['dry_run'])
+
+    def clean_invalid(self, using, dry_run):
+        connection = connections[using]
+        for table, name in get_invalid_indexes(connection):
+            self.stdout.write(f'{using}: dropping invalid index {name} on {table}')
+            if not dry_run:
+                drop_index_concurrently(connection, name)
+
+    def build(self, using, model, dry_run):
+        connection = connections[using]
+        table = model._meta.db_table
+        for index in get_model_indexes(model, connection):
+            state = get_index_state(connection, table, index.name)
+            if state == INDEX_VALID:
+                continue
+            if state == INDEX_BUILDING:
+                self.stdout.write(self.style.WARNING(
+                    f'{using}: skipping {index.name} on {table}, which '
+                    'another session is building'
+                ))
+                continue
+
+            self.stdout.write(f'{using}: building {index.name} on {table}')
+            if dry_run:
+                continue
+            start = time.perf_counter()
+            with connection.schema_editor(atomic=False) as schema_editor:
+                add_index_concurrently(schema_editor, model, index)
+            self.stdout.write(self.style.SUCCESS(
+                f'  built in {time.perf_counter() - start:.1f}s'
+            ))
@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from ...deletion import AccountDeleter
+
+
+class Command(BaseCommand):
+    help = 'Delete the data of accounts queued for deletion, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit when no deletions are pending instead of polling.',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=5,
+            help='Seconds to wait when no deletions are pending.',
+        )
+
+    def handle(self, *args, **options):
+        deleter = AccountDeleter(batch_size=options['batch_size'])
+        try:
+            while True:
+                completed = deleter.delete_pending()
+                if completed:
+                    self.stdout.write(f'Deleted {completed} accounts.')
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,37 @@
+import time
+from django.core.management.base import BaseCommand
+from ...events import EventDispatcher
+
+
+class Command(BaseCommand):
+    help = 'Deliver outbox events to the configured webhook endpoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit when no events are due instead of polling.',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1,
+            help='Seconds to wait when no events are due.',
+        )
+
+    def handle(self, *args, **options):
+        dispatcher = EventDispatcher(batch_size=options['batch_size'])
+        try:
+            while True:
+                delivered = dispatcher.dispatch()
+                if delivered:
+                    self.stdout.write(f'Delivered {delivered} events.')
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            dispatcher.close()
@@ -0,0 +1,44 @@
+import sys
+from django.core.management.base import BaseCommand
+from ...export import EXPORT_TYPES, UserExport
+
+
+class Command(BaseCommand):
+    help = (
+        'Export all users, archived users included, as NDJSON or CSV with '
+        'constant memory use.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--type',
+            choices=list(EXPORT_TYPES),
+            default='ndjson',
+        )
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument(
+            '--output',
+            help='File to write to. Defaults to stdout.',
+        )
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        export = UserExport(
+            options['type'],
+            compress=options['gzip'],
+            chunk_size=options['chunk_size'],
+        )
+
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                for block in export:
+                    output.write(block)
+        else:
+            for block in export:
+                sys.stdout.buffer.write(block)
+            sys.stdout.buffer.flush()
+
+        self.stderr.write(
+            f'Exported {export.rows} users in {export.elapsed:.2f}s '
+            f'({export.rows_per_second:.0f} rows/sec)'
+        )
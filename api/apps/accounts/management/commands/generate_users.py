@@ -0,0 +1,217 @@
+import binascii
+import csv
+import io
+import os
+import random
+import time
+import uuid
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connection, transaction
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from ... import stats
+from ...models import UserDirectoryEntry, VerificationToken
+
+
+FIRST_NAMES = [
+    'James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael',
+    'Linda', 'David', 'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan',
+    'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Wei', 'Priya', 'Mohammed',
+    'Sofia', 'Hiroshi', 'Amara', 'Mateo', 'Olga', 'Kwame', 'Ines',
+]
+
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller',
+    'Davis', 'Rodriguez', 'Martinez', 'Hernandez', 'Lopez', 'Wilson',
+    'Anderson', 'Taylor', 'Thomas', 'Moore', 'Nguyen', 'Kim', 'Patel',
+    'Chen', 'Okafor', 'Ivanova', 'Tanaka', 'Silva', 'Mensah', 'Novak',
+]
+
+EMAIL_DOMAINS = ['gmail.com', 'yahoo.com', 'outlook.com', 'example.com']
+
+
+def copy_instances(model, instances):
+    """
+    Load unsaved instances into the model's table with PostgreSQL COPY.
+
+    Field values are written as they are on the instances; auto_now fields
+    are not refreshed.
+    """
+    fields = model._meta.concrete_fields
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for instance in instances:
+        writer.writerow([field.value_from_object(instance) for field in fields])
+    buffer.seek(0)
+
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ', '.join(
+        connection.ops.quote_name(field.column) for field in fields
+    )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)',
+            buffer,
+        )
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate synthetic users with auth and verification tokens for '
+        'performance testing.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=10000)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument(
+            '--verified-ratio',
+            type=float,
+            default=0.6,
+            help='Share of users that are verified.',
+        )
+        parser.add_argument(
+            '--expired-ratio',
+            type=float,
+            default=0.5,
+            help='Share of unverified users whose verification token expired.',
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=730,
+            help='Spread date_joined over this many past days.',
+        )
+        parser.add_argument(
+            '--password',
+            default='password',
+            help='Password set on every generated user.',
+        )
+        parser.add_argument('--seed', type=int)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.options = options
+        self.now = timezone.now()
+        # Hash once and share it; hashing per user would dominate run time
+        self.password = make_password(options['password'])
+        self.run_id = uuid.uuid4().hex[:8]
+        self.use_copy = connection.vendor == 'postgresql'
+
+        start = time.perf_counter()
+        created = 0
+        while created < options['count']:
+            size = min(options['batch_size'], options['count'] - created)
+            self.create_batch(created, size)
+            created += size
+
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                f'{created}/{options["count"]} users '
+                f'({created / elapsed:.0f} users/sec)'
+            )
+
+        method = 'COPY' if self.use_copy else 'bulk_create'
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {created} users in {time.perf_counter() - start:.1f}s '
+            f'using {method}.'
+        ))
+
+    def build_user(self, number):
+        User = get_user_model()
+        first_name = self.random.choice(FIRST_NAMES)
+        last_name = self.random.choice(LAST_NAMES)
+        email = (
+            f'{first_name}.{last_name}.{self.run_id}{number}'
+            f'@{self.random.choice(EMAIL_DOMAINS)}'
+        ).lower()
+        date_joined = self.now - timedelta(
+            seconds=self.random.randint(2 * 86400, self.options['days'] * 86400),
+        )
+
+        return User(
+            id=uuid.uuid4(),
+            password=self.password,
+            username=email,
+            email=email,
+            first_name=first_name,
+            last_name=last_name,
+            is_verified=self.random.random() < self.options['verified_ratio'],
+            date_joined=date_joined,
+        )
+
+    def build_verification_token(self, user):
+        if user.is_verified:
+            is_active = False
+            date_created = user.date_joined
+        elif self.random.random() < self.options['expired_ratio']:
+            is_active = True
+            date_created = user.date_joined
+        else:
+            is_active = True
+            date_created = self.now - timedelta(
+                seconds=self.random.randint(0, 20 * 3600),
+            )
+
+        return VerificationToken(
+            id=uuid.uuid4(),
+            user_id=user.id,
+            token=uuid.uuid4(),
+            is_active=is_active,
+            date_created=date_created,
+        )
+
+    def build_auth_token(self, user):
+        return Token(
+            key=binascii.hexlify(os.urandom(20)).decode(),
+            user_id=user.id,
+            created=user.date_joined,
+        )
+
+    @transaction.atomic
+    def create_batch(self, offset, size):
+        User = get_user_model()
+        users = [self.build_user(offset + i) for i in range(size)]
+        verification_tokens = [
+            self.build_verification_token(user) for user in users
+        ]
+        auth_tokens = [self.build_auth_token(user) for user in users]
+        # Users are created on the default database; rebalance_users moves
+        # them to their shards
+        directory_entries = [
+            UserDirectoryEntry(
+                user_id=user.id,
+                email=user.email,
+                token_key=token.key,
+                shard=DEFAULT_DB_ALIAS,
+            )
+            for user, token in zip(users, auth_tokens)
+        ]
+
+        stats.record_users_created(users)
+
+        if self.use_copy:
+            copy_instances(User, users)
+            copy_instances(VerificationToken, verification_tokens)
+            copy_instances(Token, auth_tokens)
+            copy_instances(UserDirectoryEntry, directory_entries)
+            return
+
+        # bulk_create applies auto_now to date_created, so backdate the
+        # tokens created more than a day ago afterwards
+        cutoff = self.now - timedelta(days=1)
+        backdated_ids = [
+            token.id for token in verification_tokens
+            if token.date_created < cutoff
+        ]
+        User.objects.bulk_create(users)
+        Token.objects.bulk_create(auth_tokens)
+        VerificationToken.objects.bulk_create(verification_tokens)
+        UserDirectoryEntry.objects.bulk_create(directory_entries)
+        for i in range(0, len(backdated_ids), 500):
+            VerificationToken.objects.filter(
+                pk__in=backdated_ids[i:i + 500],
+            ).update(date_created=cutoff - timedelta(days=1))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from .....profiling import PROFILE_HEADER, PROFILE_MODES, make_profile_header
+
+
+class Command(BaseCommand):
+    help = (
+        'Print a signed X-Profile header that profiles a request made with '
+        'a staff user token.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=PROFILE_MODES, default='sample')
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f'{PROFILE_HEADER}: {make_profile_header(options["mode"])}'
+        )
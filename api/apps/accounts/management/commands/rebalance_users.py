@@ -0,0 +1,226 @@
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from rest_framework.authtoken.models import Token
+from ...models import OutboxEvent, UserDirectoryEntry, VerificationToken
+from ...sharding import atomic_with_directory, get_shard_for_user_id
+
+
+def copy_rows(model, instances, using, preserve=()):
+    """
+    Insert instances loaded from another database into `using`.
+
+    bulk_create applies auto_now and auto_now_add, so the `preserve` fields
+    are written back afterwards.
+    """
+    values = [
+        [getattr(instance, field) for field in preserve]
+        for instance in instances
+    ]
+    model.objects.using(using).bulk_create(instances)
+    if preserve and instances:
+        for instance, row in zip(instances, values):
+            for field, value in zip(preserve, row):
+                setattr(instance, field, value)
+        model.objects.using(using).bulk_update(instances, list(preserve))
+
+
+class Command(BaseCommand):
+    help = (
+        'Move users, with their tokens and pending events, to the shard '
+        'their id hashes to, and bring the user directory up to date, '
+        'repairing entries left missing or stale by failed commits. Staff, '
+        'superusers and users with groups or permissions stay where they are.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count the users that would move without moving them.',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0,
+            help='Seconds to pause between batches.',
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        start = time.perf_counter()
+        scanned = moved = 0
+        for shard in settings.ACCOUNTS_SHARDS:
+            shard_scanned, shard_moved = self.rebalance(shard)
+            scanned += shard_scanned
+            moved += shard_moved
+            self.stdout.write(
+                f'{shard}: scanned {shard_scanned} users, '
+                f'moved {shard_moved}.'
+            )
+
+        action = 'Would move' if options['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {moved} of {scanned} users in '
+            f'{time.perf_counter() - start:.1f}s.'
+        ))
+
+    def rebalance(self, source):
+        User = get_user_model()
+        scanned = moved = 0
+        last_pk = None
+
+        while True:
+            users = User.objects.using(source).order_by('pk')
+            if last_pk is not None:
+                users = users.filter(pk__gt=last_pk)
+            user_ids = list(
+                users.values_list('pk', flat=True)[:self.options['batch_size']]
+            )
+            if not user_ids:
+                break
+            last_pk = user_ids[-1]
+            scanned += len(user_ids)
+
+            pinned = self.get_pinned_ids(user_ids, source)
+            targets = defaultdict(list)
+            for user_id in user_ids:
+                target = get_shard_for_user_id(user_id)
+                targets[source if user_id in pinned else target].append(
+                    user_id,
+                )
+            staying = targets.pop(source, [])
+            moved += sum(len(batch) for batch in targets.values())
+
+            if not self.options['dry_run']:
+                with atomic_with_directory(source):
+                    self.sync_directory(
+                        self.lock_users(staying, source),
+                        source,
+                    )
+                for target, batch in targets.items():
+                    self.move(batch, source, target)
+
+            if self.options['sleep']:
+                time.sleep(self.options['sleep'])
+
+        return scanned, moved
+
+    def get_pinned_ids(self, user_ids, using):
+        """
+        Return the ids of users that stay on their shard: staff, superusers
+        and users with groups or permissions. Groups, permissions and admin
+        log entries are rows of their database, with ids that differ from
+        one database to another, so they can't be copied along.
+        """
+        User = get_user_model()
+        return set(
+            User.objects.using(using)
+            .filter(pk__in=user_ids)
+            .filter(
+                Q(is_staff=True)
+                | Q(is_superuser=True)
+                | Q(groups__isnull=False)
+                | Q(user_permissions__isnull=False)
+            )
+            .values_list('pk', flat=True)
+        )
+
+    def lock_users(self, user_ids, using):
+        """
+        Load users, locking their rows until the transaction ends so that
+        they can't change while they are copied or their entries written.
+        """
+        User = get_user_model()
+        return list(
+            User.objects.using(using)
+            .select_for_update()
+            .filter(pk__in=user_ids)
+            .order_by('pk')
+        )
+
+    def sync_directory(self, users, shard):
+        """
+        Create or correct the directory entries of users on a shard.
+        """
+        entries = UserDirectoryEntry.objects.in_bulk([user.pk for user in users])
+        tokens = dict(
+            Token.objects.using(shard)
+            .filter(user_id__in=[user.pk for user in users])
+            .values_list('user_id', 'key')
+        )
+
+        missing = []
+        stale = []
+        for user in users:
+            expected = UserDirectoryEntry(
+                user_id=user.pk,
+                email=user.email,
+                token_key=tokens.get(user.pk),
+                shard=shard,
+            )
+            entry = entries.get(user.pk)
+            if entry is None:
+                missing.append(expected)
+            elif (
+                (entry.email, entry.token_key, entry.shard)
+                != (expected.email, expected.token_key, expected.shard)
+            ):
+                stale.append(expected)
+
+        UserDirectoryEntry.objects.bulk_create(missing)
+        UserDirectoryEntry.objects.bulk_update(
+            stale,
+            ['email', 'token_key', 'shard'],
+        )
+
+    def move(self, user_ids, source, target):
+        User = get_user_model()
+        with transaction.atomic(using=source), atomic_with_directory(target):
+            # Read everything under the user row locks: changes to a user
+            # and the events they record wait until the move commits. Users
+            # loaded before the move are saved with update_fields, which
+            # fails once they are gone instead of inserting them again.
+            pinned = self.get_pinned_ids(user_ids, source)
+            users = [
+                user for user in self.lock_users(user_ids, source)
+                if user.pk not in pinned
+            ]
+            user_ids = [user.pk for user in users]
+            tokens = list(
+                Token.objects.using(source).filter(user_id__in=user_ids)
+            )
+            verification_tokens = list(
+                VerificationToken.objects.using(source)
+                .filter(user_id__in=user_ids)
+            )
+            events = list(
+                OutboxEvent.objects.using(source)
+                .select_for_update()
+                .filter(user_id__in=user_ids)
+                .order_by('id')
+            )
+            event_ids = [event.pk for event in events]
+            for event in events:
+                # Event ids are per shard; insertion order keeps them in order
+                event.pk = None
+
+            copy_rows(User, users, target)
+            copy_rows(Token, tokens, target, preserve=['created'])
+            copy_rows(
+                VerificationToken,
+                verification_tokens,
+                target,
+                preserve=['date_created'],
+            )
+            copy_rows(OutboxEvent, events, target, preserve=['date_created'])
+            self.sync_directory(users, target)
+
+            # Tokens are deleted with the users by the cascade
+            OutboxEvent.objects.using(source).filter(pk__in=event_ids).delete()
+            User.objects.using(source).filter(pk__in=user_ids).delete()
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from ...stats import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        'Recount users on every shard and correct the account statistics '
+        'counters that drifted, such as after users were changed outside '
+        'the API. Accounts are counted without locking the counters, and '
+        'counters that change while counting are left for the next run.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report the corrections without making them.',
+        )
+
+    def handle(self, *args, **options):
+        corrections, changed = reconcile(dry_run=options['dry_run'])
+        for (name, day), amount in sorted(
+            corrections.items(),
+            key=lambda item: (item[0][0], str(item[0][1] or '')),
+        ):
+            day = f' on {day}' if day else ''
+            self.stdout.write(f'{name}{day}: {amount:+d}')
+
+        verb = 'Found' if options['dry_run'] else 'Made'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {len(corrections)} corrections.'
+        ))
+        if changed:
+            self.stdout.write(self.style.WARNING(
+                f'Skipped {len(changed)} counters that changed while '
+                'counting; run again to check them.'
+            ))
@@ -2,10 +2,53 @@ import uuid
 from datetime import timedelta
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.contrib.auth.models import UserManager as DjangoUserManager
+from django.contrib.postgres.indexes import OpClass
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, models
+from django.db.models.functions import Upper
 from django.utils import timezone
 
 
+class UserManager(DjangoUserManager):
+    """
+    User manager that finds users on their shard through the directory.
+    """
+
+    def get_by_email(self, email, restore_if=None):
+        """
+        Get a user by email on their shard.
+
+        Archived users are not found, unless `restore_if` is given: it is
+        called with the archived objects, the user first, and the user is
+        restored if it returns true.
+        """
+        shard = UserDirectoryEntry.objects.get_shard(email=email)
+        if shard is None:
+            raise self.model.DoesNotExist
+        try:
+            return self.db_manager(shard).get(email=email)
+        except self.model.DoesNotExist:
+            if restore_if is None:
+                raise
+
+        from .archive import restore_user
+        user = restore_user(email, shard, check=restore_if)
+        if user is None:
+            raise self.model.DoesNotExist
+        return user
+
+    def get_by_natural_key(self, username):
+        if self._db is None:
+            # The username is the email, except for users created with
+            # createsuperuser, which live on the default database
+            shard = UserDirectoryEntry.objects.get_shard(email=username)
+            return self.db_manager(shard or DEFAULT_DB_ALIAS).get(
+                **{self.model.USERNAME_FIELD: username},
+            )
+        return super().get_by_natural_key(username)
+
+
 class User(AbstractUser):
     """
     Extend Django's default user class to include custom fields.
@@ -15,6 +58,31 @@ class User(AbstractUser):
     first_name = models.CharField(max_length=150)
     last_name = models.CharField(max_length=150)
     is_verified = models.BooleanField(default=False)
+    last_seen = models.DateTimeField(blank=True, null=True)
+
+    objects = UserManager()
+
+    # Case-insensitive prefix search on names. Email prefix search uses the
+    # varchar_pattern_ops index Django creates for the unique email column.
+    # Operator classes only render on PostgreSQL, so these are built there
+    # after migrate and by build_indexes rather than declared in Meta.
+    postgres_indexes = [
+        models.Index(
+            OpClass(Upper('first_name'), name='text_pattern_ops'),
+            name='accounts_user_first_name_idx',
+        ),
+        models.Index(
+            OpClass(Upper('last_name'), name='text_pattern_ops'),
+            name='accounts_user_last_name_idx',
+        ),
+    ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Compared on save to skip directory writes when neither changed
+        instance._directory_state = (instance.__dict__.get('email'), db)
+        return instance
 
     def __str__(self):
         return self.get_full_name()
@@ -25,6 +93,45 @@ class User(AbstractUser):
     class Meta:
         verbose_name = 'User'
         verbose_name_plural = 'Users'
+        indexes = [
+            # Keyset pagination of the user directory
+            models.Index(
+                fields=['date_joined', 'id'],
+                name='accounts_user_joined_idx',
+            ),
+        ]
+
+
+class UserDirectoryManager(models.Manager):
+    def get_shard(self, **lookup):
+        """
+        Return the shard of the user matching an email or token_key lookup,
+        or None if there is no such user.
+        """
+        shards = settings.ACCOUNTS_SHARDS
+        if len(shards) == 1:
+            return shards[0]
+        return self.filter(**lookup).values_list('shard', flat=True).first()
+
+
+class UserDirectoryEntry(models.Model):
+    """
+    Global index of users by email and auth token, kept on the default
+    database, that locates the shard holding each user.
+    """
+    user_id = models.UUIDField(primary_key=True)
+    email = models.EmailField(unique=True)
+    token_key = models.CharField(max_length=40, unique=True, null=True)
+    shard = models.CharField(max_length=100)
+    is_archived = models.BooleanField(default=False)
+
+    objects = UserDirectoryManager()
+
+    def __str__(self):
+        return f'{self.email} on {self.shard}'
+
+    class Meta:
+        verbose_name_plural = 'User directory entries'
 
 
 class VerificationToken(models.Model):
@@ -48,3 +155,153 @@ class VerificationToken(models.Model):
 
     def is_valid(self):
         return self.is_active and timezone.now() < self.get_expiration_date()
+
+
+class IdempotencyKey(models.Model):
+    """
+    Stored response for a request made with an Idempotency-Key header.
+
+    A row without a status code marks a request that is still in progress,
+    until locked_until, after which a retry may take the key over from a
+    request whose worker died.
+    """
+    scope = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(blank=True, null=True)
+    response_data = models.JSONField(
+        blank=True,
+        null=True,
+        encoder=DjangoJSONEncoder,
+    )
+    date_created = models.DateTimeField(auto_now_add=True)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'Idempotency Key for {self.scope}: {self.key}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['scope', 'key'],
+                name='accounts_idempotencykey_scope_key',
+            ),
+        ]
+
+
+class OutboxEvent(models.Model):
+    """
+    Domain event waiting to be delivered to a webhook endpoint.
+
+    Events are written in the same transaction as the change they describe,
+    one row per configured endpoint, and deleted once delivered.
+    """
+    endpoint = models.URLField()
+    event_type = models.CharField(max_length=50)
+    user_id = models.UUIDField()
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    date_created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'{self.event_type} for {self.user_id} to {self.endpoint}'
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['endpoint', 'next_attempt_at', 'id'],
+                name='accounts_outbox_due_idx',
+            ),
+            models.Index(
+                fields=['endpoint', 'user_id', 'id'],
+                name='accounts_outbox_user_idx',
+            ),
+        ]
+
+
+class DeadLetterEvent(models.Model):
+    """
+    Domain event that could not be delivered within the retry limit.
+    """
+    endpoint = models.URLField()
+    event_type = models.CharField(max_length=50)
+    user_id = models.UUIDField()
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    date_created = models.DateTimeField()
+    date_failed = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField()
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'{self.event_type} for {self.user_id} to {self.endpoint}'
+
+
+class ArchivedUser(models.Model):
+    """
+    Cold user moved out of the users table, with their tokens.
+
+    `data` holds the user, auth token and verification token rows in
+    Django's serialization format, ready to be restored as they were.
+    """
+    id = models.UUIDField(primary_key=True)
+    email = models.EmailField(unique=True)
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+    date_archived = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'Archived user {self.email}'
+
+
+class AccountDeletion(models.Model):
+    """
+    Deletion of a deactivated user's account, carried out in the background.
+
+    A deletion that fails is retried from next_attempt_at, with the error of
+    the last attempt kept for inspection.
+    """
+    user_id = models.UUIDField(unique=True)
+    shard = models.CharField(max_length=100)
+    date_requested = models.DateTimeField(auto_now_add=True)
+    date_completed = models.DateTimeField(blank=True, null=True, db_index=True)
+    rows_deleted = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Deletion of {self.user_id}'
+
+
+class AccountCounter(models.Model):
+    """
+    One slot of an account statistics counter, kept on the default database.
+
+    A counter is the sum of its slots and every update goes to a random
+    slot, so concurrent updates rarely wait on the same row. Daily counters
+    have a day, totals don't.
+    """
+    name = models.CharField(max_length=50)
+    day = models.DateField(blank=True, null=True)
+    slot = models.PositiveSmallIntegerField()
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        day = f' on {self.day}' if self.day else ''
+        return f'{self.name}{day} (slot {self.slot}): {self.value}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['name', 'slot'],
+                condition=models.Q(day__isnull=True),
+                name='accounts_accountcounter_total_slot',
+            ),
+            models.UniqueConstraint(
+                fields=['name', 'day', 'slot'],
+                condition=models.Q(day__isnull=False),
+                name='accounts_accountcounter_day_slot',
+            ),
+        ]
@@ -0,0 +1,118 @@
+import base64
+import uuid
+from datetime import datetime
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from ...exceptions import ValidationError
+
+
+def encode_cursor(user):
+    """
+    Encode the keyset position of a user as an opaque cursor.
+    """
+    position = f'{user.date_joined.isoformat()}|{user.pk}'
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode()).decode()
+        date_joined, pk = position.split('|')
+        return datetime.fromisoformat(date_joined), uuid.UUID(pk)
+    except (TypeError, ValueError):
+        raise ValidationError(errors={'cursor': ['Invalid cursor.']})
+
+
+def get_keyset_page(queryset, cursor, page_size):
+    """
+    Return the page of users after the cursor, newest first, and whether
+    there is a next page.
+
+    Pages are located with a range condition on the (date_joined, id) index
+    rather than an OFFSET, so every page costs the same to fetch.
+    """
+    queryset = queryset.order_by('-date_joined', '-id')
+    if cursor is not None:
+        date_joined, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(date_joined__lte=date_joined)
+            & (Q(date_joined__lt=date_joined) | Q(id__lt=pk))
+        )
+
+    page = list(queryset[:page_size + 1])
+    return page[:page_size], len(page) > page_size
+
+
+def get_sharded_keyset_page(queryset, cursor, page_size):
+    """
+    Return the page of users after the cursor across all shards.
+
+    Every shard returns its own page after the cursor and the pages are
+    merged, so a page costs one indexed range query per shard.
+    """
+    users = []
+    has_next = False
+    for shard in settings.ACCOUNTS_SHARDS:
+        page, shard_has_next = get_keyset_page(
+            queryset.using(shard),
+            cursor,
+            page_size,
+        )
+        users.extend(page)
+        has_next = has_next or shard_has_next
+
+    users.sort(key=lambda user: (user.date_joined, user.pk), reverse=True)
+    return users[:page_size], has_next or len(users) > page_size
+
+
+class UserKeysetPagination(BasePagination):
+    """
+    Keyset pagination for users ordered by (date_joined, id).
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    page_size = 50
+    max_page_size = 200
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except KeyError:
+            return self.page_size
+        except ValueError:
+            page_size = 0
+
+        if page_size < 1:
+            raise ValidationError(errors={
+                self.page_size_query_param: ['Must be a positive integer.'],
+            })
+        return min(page_size, self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        cursor = request.query_params.get(self.cursor_query_param)
+        page, self.has_next = get_sharded_keyset_page(
+            queryset,
+            cursor,
+            self.get_page_size(request),
+        )
+        self.next_cursor = encode_cursor(page[-1]) if self.has_next else None
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.next_cursor,
+        )
+
+    def get_paginated_response(self, data):
+        return Response({
+            'users': data,
+            'next': self.get_next_link(),
+        })
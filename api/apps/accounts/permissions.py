@@ -0,0 +1,14 @@
+from rest_framework import permissions
+from .authentication import ServiceAuthentication
+
+
+class IsService(permissions.BasePermission):
+    """
+    Allow access only to internal services.
+    """
+
+    def has_permission(self, request, view):
+        return isinstance(
+            request.successful_authenticator,
+            ServiceAuthentication,
+        )
@@ -1,5 +1,109 @@
+import uuid
+from collections import Counter
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
+from rest_framework.exceptions import ErrorDetail
+from rest_framework.validators import UniqueValidator
+from .models import UserDirectoryEntry
+
+
+class UniqueEmailValidator(UniqueValidator):
+    """
+    Check that an email is not taken by another user.
+
+    Emails are unique across shards and stay taken by archived users, so
+    they are checked in the user directory. With a single shard the users
+    are checked too: users created before the directory existed have no
+    entry until rebalance_users fills it in.
+    """
+
+    def __init__(self, message=None):
+        super().__init__(
+            queryset=UserDirectoryEntry.objects.all(),
+            message=message,
+        )
+
+    def __call__(self, value, serializer_field):
+        instance = getattr(serializer_field.parent, 'instance', None)
+        if self.get_taken_emails([value], exclude=instance).exists():
+            raise serializers.ValidationError(self.message, code='unique')
+
+    def get_taken_emails(self, emails, exclude=None):
+        """
+        Return a query of the given emails that are taken, in one query.
+        """
+        querysets = [self.queryset]
+        if len(settings.ACCOUNTS_SHARDS) == 1:
+            querysets.append(get_user_model().objects.all())
+
+        taken = []
+        for queryset in querysets:
+            queryset = queryset.filter(email__in=emails)
+            if exclude is not None:
+                queryset = queryset.exclude(pk=exclude.pk)
+            taken.append(queryset.values_list('email', flat=True))
+        return taken[0].union(*taken[1:])
+
+
+class UserListSerializer(serializers.ListSerializer):
+    """
+    Serializer for many users that checks email uniqueness for the whole
+    batch in one query instead of one query per item.
+    """
+
+    def to_internal_value(self, data):
+        email_field = self.child.fields.get('email')
+        if email_field is None:
+            return super().to_internal_value(data)
+
+        validators = email_field.validators
+        unique_validators = [
+            validator for validator in validators
+            if isinstance(validator, UniqueEmailValidator)
+        ]
+        email_field.validators = [
+            validator for validator in validators
+            if not isinstance(validator, UniqueEmailValidator)
+        ]
+        try:
+            validated_data = super().to_internal_value(data)
+            errors = [{} for _ in validated_data]
+        except serializers.ValidationError as exc:
+            if not isinstance(exc.detail, list):
+                raise
+            validated_data = None
+            errors = exc.detail
+        finally:
+            email_field.validators = validators
+
+        if unique_validators:
+            self.validate_unique_emails(data, errors, unique_validators[0])
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return validated_data
+
+    def validate_unique_emails(self, data, errors, unique_validator):
+        emails = [
+            str(item.get('email', '')).strip() if isinstance(item, dict) else ''
+            for item in data
+        ]
+        existing = set(unique_validator.get_taken_emails(
+            {email for email in emails if email},
+        ))
+
+        seen = Counter()
+        for i, email in enumerate(emails):
+            if not email or 'email' in errors[i]:
+                continue
+            seen[email] += 1
+            if email in existing or seen[email] > 1:
+                errors[i] = {
+                    **errors[i],
+                    'email': [
+                        ErrorDetail(unique_validator.message, code='unique'),
+                    ],
+                }
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -22,7 +126,22 @@ class UserSerializer(serializers.ModelSerializer):
         ]
         extra_kwargs = {
             'password': {'write_only': True},
+            # Set by verifying the email, which also updates the statistics
+            'is_verified': {'read_only': True},
+            'email': {'validators': [UniqueEmailValidator(
+                message='User with this email already exists.',
+            )]},
         }
+        list_serializer_class = UserListSerializer
+
+    def __init__(self, *args, **kwargs):
+        # Optionally restrict the serialized fields to a subset
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
 
     def create(self, validated_data):
         User = get_user_model()
@@ -35,7 +154,45 @@ class UserSerializer(serializers.ModelSerializer):
         # Ensure that the email and password never get updated this way
         validated_data.pop('email', None)
         validated_data.pop('password', None)
-        return super().update(instance, validated_data)
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        # Save only the changed fields, so a user moved to another shard
+        # since they were loaded is not inserted again on the old one
+        instance.save(update_fields=list(validated_data))
+        return instance
 
     def get_full_name(self, obj):
         return obj.get_full_name()
+
+
+class UserLookupSerializer(serializers.Serializer):
+    """
+    Serializer for a bulk lookup of users by ids and emails.
+    """
+    ids = serializers.ListField(child=serializers.CharField(), default=list)
+    # Results are keyed by the emails as given
+    emails = serializers.ListField(
+        child=serializers.CharField(trim_whitespace=False),
+        default=list,
+    )
+
+    def validate_ids(self, value):
+        invalid = []
+        for user_id in value:
+            try:
+                uuid.UUID(user_id)
+            except ValueError:
+                invalid.append(user_id)
+        if invalid:
+            raise serializers.ValidationError(
+                [f'Invalid id: {user_id}.' for user_id in invalid],
+            )
+        return value
+
+    def validate(self, data):
+        limit = settings.ACCOUNTS_USER_LOOKUP_MAX
+        if len(data['ids']) + len(data['emails']) > limit:
+            raise serializers.ValidationError(
+                f'At most {limit} ids and emails can be looked up at once.',
+            )
+        return data
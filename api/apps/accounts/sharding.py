@@ -0,0 +1,214 @@
+import hashlib
+import uuid
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import check_password
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from .models import UserDirectoryEntry
+
+
+# Models stored on the shard of the user they belong to
+SHARDED_MODELS = {
+    'accounts.archiveduser',
+    'accounts.user',
+    'accounts.verificationtoken',
+    'accounts.outboxevent',
+    'authtoken.token',
+}
+
+
+def get_shard_for_user_id(user_id):
+    """
+    Return the shard a user belongs on.
+
+    Shards are chosen by rendezvous hashing: every shard scores the user id
+    and the highest score wins. Adding a shard only moves the users that now
+    score highest on it, about 1 / N of them.
+    """
+    shards = settings.ACCOUNTS_SHARDS
+    if len(shards) == 1:
+        return shards[0]
+
+    user_id = uuid.UUID(str(user_id)).bytes
+    return max(shards, key=lambda shard: hashlib.blake2b(
+        user_id,
+        key=shard.encode(),
+        digest_size=8,
+    ).digest())
+
+
+def get_user_db(user):
+    """
+    Return the database holding a user, or the one a new user belongs on.
+    """
+    return user._state.db or get_shard_for_user_id(user.pk)
+
+
+@contextmanager
+def atomic_with_directory(using):
+    """
+    Run a block in a transaction on a user's shard nested in one on the
+    default database, which holds the user directory.
+
+    These are two transactions, not one distributed transaction: the shard
+    commits first, then the default database. If that second commit fails,
+    the shard keeps its changes without the matching directory changes, and
+    the user is missing from the directory or has a stale email or token
+    there. rebalance_users repairs the entries of every user it scans, so
+    run it after such failures. With a single shard both are the same
+    transaction.
+    """
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        with transaction.atomic(using=using):
+            yield
+
+
+def get_instance_db(instance):
+    if instance._state.db:
+        return instance._state.db
+    if instance._meta.label_lower == 'accounts.user':
+        return get_shard_for_user_id(instance.pk)
+
+    user = instance._state.fields_cache.get('user')
+    if user is not None:
+        return get_user_db(user)
+    if getattr(instance, 'user_id', None) is not None:
+        return get_shard_for_user_id(instance.user_id)
+    return None
+
+
+class ShardRouter:
+    """
+    Route users, their tokens and their events to the user's shard.
+
+    Queries without an instance to route by go to the default database, so
+    code that looks users up by something other than a related instance
+    picks the shard explicitly with using(), after finding it through
+    UserDirectoryEntry. The directory itself only exists on the default
+    database.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model is UserDirectoryEntry:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is None or model._meta.label_lower not in SHARDED_MODELS:
+            return None
+        return get_instance_db(instance)
+
+    db_for_write = db_for_read
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'accounts' and model_name == 'userdirectoryentry':
+            return db == DEFAULT_DB_ALIAS
+        return None
+
+
+class ShardedModelBackend(ModelBackend):
+    """
+    Model backend that loads session users from their shard and restores
+    archived users once their password checks out.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        user = super().authenticate(
+            request,
+            username=username,
+            password=password,
+            **kwargs,
+        )
+        if user is None and username is not None and password is not None:
+            user = self.restore_archived_user(username, password)
+        return user
+
+    def restore_archived_user(self, email, password):
+        from .archive import get_archive_shard, restore_user
+
+        shard = get_archive_shard(email)
+        if shard is None:
+            return None
+        # The archived user is unsaved, so check the hash without
+        # User.check_password, which saves upgraded hashes
+        user = restore_user(email, shard, check=lambda objects: (
+            check_password(password, objects[0].password)
+            and self.user_can_authenticate(objects[0])
+        ))
+        if (
+            user is not None
+            and user.check_password(password)
+            and self.user_can_authenticate(user)
+        ):
+            return user
+        return None
+
+    def get_user(self, user_id):
+        shard = UserDirectoryEntry.objects.get_shard(user_id=user_id)
+        User = get_user_model()
+        try:
+            user = User._default_manager.db_manager(
+                shard or DEFAULT_DB_ALIAS,
+            ).get(pk=user_id)
+        except User.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def update_directory_for_user(
+    sender, instance, created, raw, using, update_fields, **kwargs
+):
+    if update_fields is not None and 'email' not in update_fields:
+        return
+
+    # Restored users already have an entry
+    if created and not raw:
+        UserDirectoryEntry.objects.create(
+            user_id=instance.pk,
+            email=instance.email,
+            shard=using,
+        )
+        instance._directory_state = (instance.email, using)
+        return
+    # Skip users whose email and shard are as loaded. Restored users are
+    # saved raw and always update their entry, which is marked archived.
+    if not raw and getattr(instance, '_directory_state', None) == (
+        instance.email,
+        using,
+    ):
+        return
+
+    updated = UserDirectoryEntry.objects.filter(user_id=instance.pk).update(
+        email=instance.email,
+        shard=using,
+        is_archived=False,
+    )
+    if not updated:
+        UserDirectoryEntry.objects.create(
+            user_id=instance.pk,
+            email=instance.email,
+            shard=using,
+        )
+    instance._directory_state = (instance.email, using)
+
+
+@receiver(post_save, sender=Token)
+def update_directory_for_token(sender, instance, created, **kwargs):
+    if created:
+        UserDirectoryEntry.objects.filter(user_id=instance.user_id).update(
+            token_key=instance.key,
+        )
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def delete_directory_for_user(sender, instance, using, **kwargs):
+    # Users moved to another shard or archived keep their entry
+    UserDirectoryEntry.objects.filter(
+        user_id=instance.pk,
+        shard=using,
+        is_archived=False,
+    ).delete()
@@ -0,0 +1,213 @@
+import random
+from collections import Counter
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .archive import load_archived_user
+from .models import AccountCounter, ArchivedUser
+from .sharding import get_user_db
+
+
+USERS = 'users'
+VERIFIED_USERS = 'verified_users'
+SIGNUPS = 'signups'
+
+
+def count_users(users):
+    """
+    Return what users add to the counters, as {(name, day): amount}.
+
+    Signups are counted on the day the user joined, so a deleted user is
+    taken off the day they signed up.
+    """
+    counts = Counter()
+    for user in users:
+        counts[USERS, None] += 1
+        counts[VERIFIED_USERS, None] += int(user.is_verified)
+        counts[SIGNUPS, timezone.localdate(user.date_joined)] += 1
+    return counts
+
+
+def increment(counts):
+    """
+    Add amounts, given as {(name, day): amount}, to the counters.
+
+    Call inside the transaction making the change counted, so the counters
+    change if and only if it commits. All counters are updated in the same
+    slot and in the same order to keep transactions from deadlocking.
+    """
+    slot = random.randrange(settings.ACCOUNTS_STATISTICS_SLOTS)
+    for (name, day), amount in sorted(
+        counts.items(),
+        key=lambda item: (item[0][0], str(item[0][1] or '')),
+    ):
+        if not amount:
+            continue
+        counters = AccountCounter.objects.filter(name=name, day=day, slot=slot)
+        if counters.update(value=F('value') + amount):
+            continue
+        try:
+            with transaction.atomic():
+                AccountCounter.objects.create(
+                    name=name,
+                    day=day,
+                    slot=slot,
+                    value=amount,
+                )
+        except IntegrityError:
+            # Created by a concurrent transaction
+            counters.update(value=F('value') + amount)
+
+
+def lock_is_verified(user):
+    """
+    Return whether a user is verified as stored, locking their row until the
+    transaction ends so that concurrent changes are counted once.
+    """
+    return (
+        type(user).objects.using(get_user_db(user))
+        .select_for_update()
+        .values_list('is_verified', flat=True)
+        .get(pk=user.pk)
+    )
+
+
+def record_users_created(users):
+    increment(count_users(users))
+
+
+def record_users_deleted(users):
+    increment({key: -amount for key, amount in count_users(users).items()})
+
+
+def record_verification_changed(is_verified):
+    increment({(VERIFIED_USERS, None): 1 if is_verified else -1})
+
+
+def get_statistics(days=None):
+    """
+    Return the total and verified users and the signups of each of the last
+    `days` days, in one query over a bounded number of counter rows.
+    """
+    days = days or settings.ACCOUNTS_STATISTICS_DAYS
+    today = timezone.localdate()
+    start = today - timedelta(days=days - 1)
+
+    totals = Counter()
+    signups = Counter()
+    for name, day, total in (
+        AccountCounter.objects
+        .filter(
+            Q(name__in=[USERS, VERIFIED_USERS], day__isnull=True)
+            | Q(name=SIGNUPS, day__range=(start, today))
+        )
+        .values('name', 'day')
+        .annotate(total=Sum('value'))
+        .values_list('name', 'day', 'total')
+    ):
+        if day is None:
+            totals[name] = total
+        else:
+            signups[day] = total
+
+    return {
+        'total_users': totals[USERS],
+        'verified_users': totals[VERIFIED_USERS],
+        'verified_ratio': (
+            totals[VERIFIED_USERS] / totals[USERS] if totals[USERS] else 0
+        ),
+        'signups_per_day': [
+            {'date': day, 'count': signups[day]}
+            for day in (start + timedelta(days=i) for i in range(days))
+        ],
+    }
+
+
+def count_accounts():
+    """
+    Count the users and archived users on every shard, returning what the
+    counters should hold as {(name, day): amount}. Scans every user.
+    """
+    User = get_user_model()
+    counts = Counter()
+    for shard in settings.ACCOUNTS_SHARDS:
+        users = User.objects.using(shard)
+        counts[USERS, None] += users.count()
+        counts[VERIFIED_USERS, None] += users.filter(is_verified=True).count()
+        for day, count in (
+            users.annotate(day=TruncDate('date_joined'))
+            .values('day')
+            .annotate(count=Count('pk'))
+            .values_list('day', 'count')
+        ):
+            counts[SIGNUPS, day] += count
+
+        archived_users = ArchivedUser.objects.using(shard).only('data')
+        counts.update(count_users(
+            load_archived_user(archived)
+            for archived in archived_users.iterator()
+        ))
+    return counts
+
+
+def get_counter_values(keys=None, lock=False):
+    """
+    Return the counter totals as {(name, day): value}, of every counter or
+    of the given keys, optionally locking their rows until the transaction
+    ends.
+    """
+    counters = AccountCounter.objects.all()
+    if keys is not None:
+        counters = counters.filter(reduce(
+            or_,
+            (Q(name=name, day=day) for name, day in keys),
+            Q(pk__in=[]),
+        ))
+    if lock:
+        counters = counters.select_for_update().order_by('name', 'day', 'slot')
+
+    values = Counter()
+    for name, day, value in counters.values_list('name', 'day', 'value'):
+        values[name, day] += value
+    return values
+
+
+def reconcile(dry_run=False):
+    """
+    Correct the counters to the stored accounts. Return the corrections
+    made, as {(name, day): amount}, and the keys left for a later run
+    because their counters changed meanwhile.
+
+    Accounts are counted without locks while the API keeps changing them
+    and the counters. A counter that changed during the count may or may
+    not have that change in the count, so it is left alone. The others are
+    corrected in a short transaction, if they still hold the values read
+    after the count.
+    """
+    before = get_counter_values()
+    actual = count_accounts()
+    after = get_counter_values()
+
+    changed = {key for key in {*before, *after} if before[key] != after[key]}
+    corrections = {
+        key: actual[key] - after[key]
+        for key in {*actual, *after} - changed
+        if actual[key] != after[key]
+    }
+    if dry_run or not corrections:
+        return corrections, changed
+
+    with transaction.atomic():
+        current = get_counter_values(corrections, lock=True)
+        for key in list(corrections):
+            if current[key] != after[key]:
+                del corrections[key]
+                changed.add(key)
+        increment(corrections)
+    return corrections, changed
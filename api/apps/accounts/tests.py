@@ -1,13 +1,85 @@
-from django.contrib.auth import authenticate
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock, skipUnless
+from django.apps import apps
+from django.conf import settings
+from django.contrib.admin.models import ADDITION, LogEntry
+from django.contrib.auth import authenticate, get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models
+from django.db.migrations.state import ProjectState
+from django.db.models import F, QuerySet
+from django.test import (
+    Client,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.urls import resolve
-from rest_framework import status
+from django.utils import timezone
+from rest_framework import serializers, status
+from rest_framework.authtoken.models import Token
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase
+from ...budgets import TimeBudget
+from ...concurrency import (
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+    AdaptiveConcurrencyLimiter,
+    ConcurrencyLimitMiddleware,
+)
+from ...exceptions import TimeBudgetExceeded
+from ...fields import ChoiceField
+from ...operations import (
+    INDEX_VALID,
+    AddIndexConcurrently,
+    BackfillField,
+    get_index_state,
+)
+from ...profiling import make_profile_header
+from . import stats
+from .activity import ActivityBuffer, activity_buffer
+from .archive import get_archive_shard, restore_user
+from .events import EventDispatcher
+from .idempotency import IdempotentMixin
+from .models import (
+    AccountCounter,
+    AccountDeletion,
+    ArchivedUser,
+    DeadLetterEvent,
+    IdempotencyKey,
+    OutboxEvent,
+    UserDirectoryEntry,
+    VerificationToken,
+)
+from .serializers import UserSerializer
+from .sharding import get_shard_for_user_id
+from .stats import get_statistics, reconcile
 from .utils import (
     create_user,
     get_auth_token,
+    update_or_create_auth_token,
     update_or_create_verification_token,
 )
+from .views import RetrieveUserView
+
+
+def tearDownModule():
+    # Write activity recorded by API tests while the test database exists,
+    # instead of at exit
+    activity_buffer.flush()
 
 
 class AccountTests(APITestCase):
@@ -34,6 +106,22 @@ class AccountTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(response.data.get('user').get('email'), data['email'])
 
+    def test_email_of_user_without_directory_entry_is_taken(self):
+        # Users created before the directory existed have no entry
+        UserDirectoryEntry.objects.filter(user_id=self.user.pk).delete()
+        response = self.client.post(reverse('accounts:user-create'), {
+            'email': 'testuser@gmail.com',
+            'password': 'newpassword',
+            'first_name': 'New',
+            'last_name': 'User',
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        call_command('rebalance_users', stdout=StringIO())
+        self.assertTrue(
+            UserDirectoryEntry.objects.filter(user_id=self.user.pk).exists(),
+        )
+
     def test_can_log_in(self):
         url = reverse('accounts:login')
         data = {'email': self.user.email, 'password': self.password}
@@ -107,3 +195,1575 @@ class AccountTests(APITestCase):
             response.data.get('user').get('first_name'),
             data['first_name'],
         )
+
+    def test_cannot_update_is_verified(self):
+        url = reverse('accounts:user-update')
+        response = self.client.patch(url, {'is_verified': True})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data.get('user').get('is_verified'))
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_verified)
+        self.assertEqual(get_statistics()['verified_users'], 0)
+
+
+class ActivityTests(APITestCase):
+    def setUp(self):
+        self.user = create_user({
+            'email': 'activeuser@gmail.com',
+            'password': 'testpassword',
+            'first_name': 'Active',
+            'last_name': 'User',
+        })
+        self.token = get_auth_token(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def tearDown(self):
+        activity_buffer.flush()
+
+    def test_authenticated_request_updates_last_seen(self):
+        self.client.get(reverse('accounts:user-retrieve'))
+        activity_buffer.flush()
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_seen)
+
+    def test_activity_is_coalesced_per_interval(self):
+        now = [0.0]
+        buffer = ActivityBuffer(interval=60, clock=lambda: now[0])
+        User = get_user_model()
+
+        for _ in range(10):
+            now[0] += 1
+            buffer.record(self.user.pk)
+        with self.assertNumQueries(1):
+            buffer.flush()
+        for _ in range(10):
+            now[0] += 1
+            buffer.record(self.user.pk)
+        with self.assertNumQueries(0):
+            buffer.flush()
+
+        now[0] += 60
+        buffer.record(self.user.pk)
+        buffer.flush()
+
+        stats = buffer.get_stats()
+        self.assertEqual(stats['recorded'], 21)
+        self.assertEqual(stats['rows_written'], 2)
+        self.assertIsNotNone(User.objects.get(pk=self.user.pk).last_seen)
+
+    def test_failed_flush_keeps_activity_pending(self):
+        now = [0.0]
+        buffer = ActivityBuffer(interval=60, clock=lambda: now[0])
+        User = get_user_model()
+        now[0] += 60
+
+        with mock.patch.object(
+            QuerySet,
+            'update',
+            side_effect=TimeBudgetExceeded,
+        ):
+            with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+                buffer.record(self.user.pk)
+        self.assertIn('Unable to flush user activity', stdout.getvalue())
+        self.assertEqual(buffer.get_stats()['pending'], 1)
+        self.assertEqual(buffer.written, {})
+
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.get_stats()['rows_written'], 1)
+        self.assertIsNotNone(User.objects.get(pk=self.user.pk).last_seen)
+
+
+class MiddlewareProfileTests(TestCase):
+    def setUp(self):
+        self.password = 'adminpassword'
+        User = get_user_model()
+        self.admin = User.objects.create_superuser(
+            username='admin@gmail.com',
+            email='admin@gmail.com',
+            password=self.password,
+        )
+
+    def test_admin_keeps_full_middleware_stack(self):
+        response = self.client.get(reverse('admin:login'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+        self.assertIn('csrftoken', response.cookies)
+
+    def test_admin_enforces_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        response = client.post(reverse('admin:login'), {
+            'username': self.admin.username,
+            'password': self.password,
+        })
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_admin_session_login(self):
+        response = self.client.post(reverse('admin:login'), {
+            'username': self.admin.username,
+            'password': self.password,
+            'next': reverse('admin:index'),
+        })
+        self.assertRedirects(response, reverse('admin:index'))
+        response = self.client.get(reverse('admin:index'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_api_skips_admin_middleware(self):
+        token = update_or_create_auth_token(self.admin)
+        response = self.client.get(
+            reverse('accounts:user-retrieve'),
+            HTTP_AUTHORIZATION=f'Token {token}',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Frame-Options', response)
+        self.assertNotIn('Cookie', response.get('Vary', ''))
+        self.assertEqual(len(response.cookies), 0)
+
+
+class ListUsersTests(APITestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.admin = User.objects.create_superuser(
+            username='admin@gmail.com',
+            email='admin@gmail.com',
+            password='adminpassword',
+        )
+        for i in range(5):
+            create_user({
+                'email': f'listuser{i}@gmail.com',
+                'password': 'testpassword',
+                'first_name': f'List{i}',
+                'last_name': 'User',
+            })
+        self.url = reverse('accounts:user-list')
+        self.client.force_authenticate(self.admin)
+
+    def test_requires_admin(self):
+        user = get_user_model().objects.get(email='listuser0@gmail.com')
+        self.client.force_authenticate(user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_can_page_through_users(self):
+        emails = []
+        url = f'{self.url}?limit=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['users']), 2)
+            emails += [user['email'] for user in response.data['users']]
+            url = response.data['next']
+
+        self.assertEqual(len(emails), 6)
+        self.assertEqual(len(set(emails)), 6)
+
+    def test_can_search_users(self):
+        response = self.client.get(self.url, {'search': 'list3'})
+        self.assertEqual(
+            [user['email'] for user in response.data['users']],
+            ['listuser3@gmail.com'],
+        )
+
+    def test_can_select_fields(self):
+        response = self.client.get(self.url, {'fields': 'id,full_name'})
+        self.assertEqual(
+            set(response.data['users'][0]),
+            {'id', 'full_name'},
+        )
+
+    def test_rejects_invalid_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ExportUsersTests(APITestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.admin = User.objects.create_superuser(
+            username='admin@gmail.com',
+            email='admin@gmail.com',
+            password='adminpassword',
+        )
+        for i in range(3):
+            create_user({
+                'email': f'exportuser{i}@gmail.com',
+                'password': 'testpassword',
+                'first_name': f'Export{i}',
+                'last_name': 'User',
+            })
+        self.url = reverse('accounts:user-export')
+        self.client.force_authenticate(self.admin)
+
+    def get_content(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_can_export_ndjson(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = [
+            json.loads(line)
+            for line in self.get_content(response).decode().splitlines()
+        ]
+        self.assertEqual(len(rows), 4)
+        row = next(row for row in rows if row['email'] == 'exportuser0@gmail.com')
+        self.assertTrue(row['verification_token_is_active'])
+        self.assertIsNotNone(row['auth_token_created'])
+        self.assertFalse(row['is_archived'])
+
+    def test_export_includes_archived_users(self):
+        User = get_user_model()
+        User.objects.filter(email='exportuser0@gmail.com').update(
+            date_joined=timezone.now() - timedelta(days=60),
+        )
+        call_command('archive_users', stdout=StringIO())
+        self.assertTrue(ArchivedUser.objects.exists())
+
+        response = self.client.get(self.url)
+        rows = [
+            json.loads(line)
+            for line in self.get_content(response).decode().splitlines()
+        ]
+        self.assertEqual(len(rows), 4)
+        row = next(row for row in rows if row['email'] == 'exportuser0@gmail.com')
+        self.assertTrue(row['is_archived'])
+        self.assertEqual(row['first_name'], 'Export0')
+        self.assertTrue(row['verification_token_is_active'])
+        self.assertIsNotNone(row['auth_token_created'])
+
+    def test_can_export_gzipped_csv(self):
+        response = self.client.get(self.url, {'type': 'csv', 'gzip': '1'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        lines = gzip.decompress(self.get_content(response)).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[0].startswith('id,email,'))
+
+    def test_export_requires_admin(self):
+        user = get_user_model().objects.get(email='exportuser0@gmail.com')
+        self.client.force_authenticate(user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class GenerateUsersTests(TestCase):
+    def test_can_generate_users(self):
+        call_command(
+            'generate_users',
+            count=30,
+            batch_size=8,
+            verified_ratio=0.5,
+            expired_ratio=0.5,
+            password='generated',
+            seed=1,
+            stdout=StringIO(),
+        )
+        User = get_user_model()
+        self.assertEqual(User.objects.count(), 30)
+        self.assertEqual(VerificationToken.objects.count(), 30)
+
+        tokens = VerificationToken.objects.filter(user__is_verified=False)
+        valid = [token.is_valid() for token in tokens]
+        self.assertIn(True, valid)
+        self.assertIn(False, valid)
+
+        user = User.objects.filter(is_verified=True).first()
+        self.assertIsNotNone(
+            authenticate(username=user.email, password='generated'),
+        )
+
+
+class IdempotencyTests(APITestCase):
+    def setUp(self):
+        self.password = 'testpassword'
+        self.user = create_user({
+            'email': 'idempotentuser@gmail.com',
+            'password': self.password,
+            'first_name': 'Idempotent',
+            'last_name': 'User',
+        })
+        self.token = get_auth_token(self.user)
+
+    def test_signup_retry_replays_response(self):
+        url = reverse('accounts:user-create')
+        data = {
+            'email': 'retrieduser@gmail.com',
+            'password': 'newpassword',
+            'first_name': 'Retried',
+            'last_name': 'User',
+        }
+        first = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='signup-1')
+        retry = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='signup-1')
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data['token'], first.data['token'])
+        self.assertEqual(
+            get_user_model().objects.filter(email=data['email']).count(),
+            1,
+        )
+
+    def test_key_reused_with_different_request_is_rejected(self):
+        url = reverse('accounts:user-create')
+        data = {
+            'email': 'keyreuse@gmail.com',
+            'password': 'newpassword',
+            'first_name': 'Key',
+            'last_name': 'Reuse',
+        }
+        self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='signup-2')
+        data['email'] = 'otheruser@gmail.com'
+        response = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='signup-2')
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+
+    def test_change_password_retry_after_token_rotation(self):
+        url = reverse('accounts:password-change')
+        data = {
+            'current_password': self.password,
+            'new_password': 'newpassword',
+        }
+        headers = {
+            'HTTP_AUTHORIZATION': f'Token {self.token}',
+            'HTTP_IDEMPOTENCY_KEY': 'change-1',
+        }
+        first = self.client.patch(url, data, **headers)
+        password = get_user_model().objects.get(pk=self.user.pk).password
+        retry = self.client.patch(url, data, **headers)
+
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.status_code, status.HTTP_200_OK)
+        self.assertEqual(retry.data['token'], first.data['token'])
+        self.assertEqual(
+            get_user_model().objects.get(pk=self.user.pk).password,
+            password,
+        )
+
+    def test_failed_request_releases_key(self):
+        url = reverse('accounts:password-change')
+        headers = {
+            'HTTP_AUTHORIZATION': f'Token {self.token}',
+            'HTTP_IDEMPOTENCY_KEY': 'change-2',
+        }
+        response = self.client.patch(url, {
+            'current_password': 'wrongpassword',
+            'new_password': 'newpassword',
+        }, **headers)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = self.client.patch(url, {
+            'current_password': self.password,
+            'new_password': 'newpassword',
+        }, **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_retry_takes_over_key_of_dead_request(self):
+        url = reverse('accounts:user-create')
+        data = {
+            'email': 'invalid',
+            'password': 'newpassword',
+            'first_name': 'Dead',
+            'last_name': 'Worker',
+        }
+        # A request whose worker died before storing its response
+        with mock.patch.object(
+            IdempotentMixin,
+            'finalize_response',
+            side_effect=RuntimeError,
+        ):
+            with self.assertRaises(RuntimeError):
+                self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='signup-3')
+        record = IdempotencyKey.objects.get(key='signup-3')
+        self.assertIsNone(record.status_code)
+
+        response = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='signup-3')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        IdempotencyKey.objects.filter(pk=record.pk).update(
+            locked_until=timezone.now(),
+        )
+        response = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='signup-3')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class TokenExpiryTests(APITestCase):
+    def setUp(self):
+        self.password = 'testpassword'
+        self.user = create_user({
+            'email': 'expiringuser@gmail.com',
+            'password': self.password,
+            'first_name': 'Expiring',
+            'last_name': 'User',
+        })
+        self.token = get_auth_token(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    @override_settings(ACCOUNTS_TOKEN_TTL=0)
+    def test_expired_token_is_rejected(self):
+        response = self.client.get(reverse('accounts:user-retrieve'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.data['code'], 4015)
+
+    @override_settings(ACCOUNTS_TOKEN_IDLE_TTL=0)
+    def test_log_in_replaces_expired_token(self):
+        self.client.credentials()
+        response = self.client.post(reverse('accounts:login'), {
+            'email': self.user.email,
+            'password': self.password,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.data['token'], self.token.key)
+
+    def test_sweeper_deletes_only_expired_tokens(self):
+        other = create_user({
+            'email': 'activetokenuser@gmail.com',
+            'password': self.password,
+            'first_name': 'Active',
+            'last_name': 'Token',
+        })
+        Token.objects.filter(user=self.user).update(
+            created=timezone.now() - timedelta(days=365),
+        )
+
+        call_command('sweep_auth_tokens', batch_size=1, stdout=StringIO())
+        self.assertFalse(Token.objects.filter(user=self.user).exists())
+        self.assertTrue(Token.objects.filter(user=other).exists())
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append(json.loads(body))
+        self.send_response(self.server.response_status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class EventOutboxTests(APITestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), WebhookHandler)
+        cls.server.received = []
+        cls.server.response_status = 200
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.endpoint = f'http://127.0.0.1:{cls.server.server_port}/events'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.received.clear()
+        self.server.response_status = 200
+        self.dispatcher = EventDispatcher()
+
+        with self.settings(ACCOUNTS_EVENT_WEBHOOKS=[self.endpoint]):
+            self.user = create_user({
+                'email': 'eventuser@gmail.com',
+                'password': 'testpassword',
+                'first_name': 'Event',
+                'last_name': 'User',
+            })
+        self.token = get_auth_token(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def tearDown(self):
+        self.dispatcher.close()
+
+    def test_events_are_delivered_in_batches(self):
+        with self.settings(ACCOUNTS_EVENT_WEBHOOKS=[self.endpoint]):
+            self.client.patch(
+                reverse('accounts:email-change'),
+                {'email': 'changedevent@gmail.com'},
+            )
+
+        self.assertEqual(self.dispatcher.dispatch(), 2)
+        self.assertEqual(len(self.server.received), 1)
+        self.assertEqual(
+            [event['type'] for event in self.server.received[0]['events']],
+            ['user.created', 'user.email_changed'],
+        )
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_failed_delivery_holds_later_events_of_user(self):
+        with self.settings(ACCOUNTS_EVENT_WEBHOOKS=[self.endpoint]):
+            verification_token = update_or_create_verification_token(self.user)
+            self.client.post(
+                reverse('accounts:verify'),
+                {'verification_token': verification_token.token},
+            )
+
+        self.server.response_status = 500
+        self.dispatcher.batch_size = 1
+        self.assertEqual(self.dispatcher.dispatch(), 0)
+
+        self.server.response_status = 200
+        self.assertEqual(self.dispatcher.dispatch(), 0)
+        self.assertEqual(len(self.server.received), 1)
+        self.assertEqual(OutboxEvent.objects.count(), 2)
+
+    def test_new_events_wait_for_retried_events_of_user(self):
+        self.server.response_status = 500
+        self.assertEqual(self.dispatcher.dispatch(), 0)
+
+        # Recorded after user.created failed, and due at once
+        with self.settings(ACCOUNTS_EVENT_WEBHOOKS=[self.endpoint]):
+            verification_token = update_or_create_verification_token(self.user)
+            self.client.post(
+                reverse('accounts:verify'),
+                {'verification_token': verification_token.token},
+            )
+        self.server.response_status = 200
+        self.assertEqual(self.dispatcher.dispatch(), 0)
+        self.assertEqual(len(self.server.received), 1)
+
+        OutboxEvent.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(self.dispatcher.dispatch(), 2)
+        self.assertEqual(
+            [event['type'] for event in self.server.received[-1]['events']],
+            ['user.created', 'user.verified'],
+        )
+
+    @override_settings(ACCOUNTS_EVENT_MAX_ATTEMPTS=1)
+    def test_undeliverable_events_are_dead_lettered(self):
+        self.server.response_status = 503
+        self.dispatcher.dispatch()
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(
+            DeadLetterEvent.objects.get().event_type,
+            'user.created',
+        )
+
+    def test_events_roll_back_with_the_change(self):
+        with self.settings(ACCOUNTS_EVENT_WEBHOOKS=[self.endpoint]):
+            response = self.client.post(reverse('accounts:user-create'), {
+                'email': self.user.email,
+                'password': 'testpassword',
+                'first_name': 'Duplicate',
+                'last_name': 'User',
+            })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+
+class ProfilingTests(APITestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.user = create_user({
+            'email': 'profileduser@gmail.com',
+            'password': 'testpassword',
+            'first_name': 'Profiled',
+            'last_name': 'User',
+        })
+        self.token = get_auth_token(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+
+    def get_profiles(self):
+        return sorted(os.listdir(self.profile_dir))
+
+    def test_signed_header_requires_staff(self):
+        with self.settings(PROFILING_DIR=self.profile_dir):
+            self.client.get(
+                reverse('accounts:user-retrieve'),
+                HTTP_X_PROFILE=make_profile_header(),
+            )
+            self.assertEqual(self.get_profiles(), [])
+
+            self.user.is_staff = True
+            self.user.save()
+            self.client.get(
+                reverse('accounts:user-retrieve'),
+                HTTP_X_PROFILE=make_profile_header('cprofile'),
+            )
+            self.client.get(
+                reverse('accounts:user-retrieve'),
+                HTTP_X_PROFILE='invalid',
+            )
+
+        profiles = self.get_profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('accounts:user-retrieve__'))
+        self.assertTrue(profiles[0].endswith('.prof'))
+
+    def test_profiles_are_aggregated_per_view(self):
+        with self.settings(
+            PROFILING_DIR=self.profile_dir,
+            PROFILING_ENABLED=True,
+            PROFILING_INTERVAL=0.0001,
+        ):
+            for _ in range(2):
+                self.client.get(reverse('accounts:user-retrieve'))
+
+        output = StringIO()
+        call_command('aggregate_profiles', dir=self.profile_dir, stdout=output)
+        self.assertIn('accounts:user-retrieve: 2 sampled requests', output.getvalue())
+        self.assertIn('accounts:user-retrieve.folded', self.get_profiles())
+
+
+class BulkValidationTests(TestCase):
+    def setUp(self):
+        create_user({
+            'email': 'existinguser@gmail.com',
+            'password': 'testpassword',
+            'first_name': 'Existing',
+            'last_name': 'User',
+        })
+
+    def get_item(self, email):
+        return {
+            'email': email,
+            'password': 'testpassword',
+            'first_name': 'Bulk',
+            'last_name': 'User',
+        }
+
+    def test_choice_field_uses_display_values(self):
+        field = ChoiceField(choices=[(1, 'One'), (2, 'Two'), (3, 'Two')])
+        self.assertEqual(field.to_internal_value('One'), 1)
+        self.assertEqual(field.to_internal_value('Two'), 2)
+        self.assertEqual(field.to_representation(3), 'Two')
+        with self.assertRaises(serializers.ValidationError):
+            field.to_internal_value('Three')
+        with self.assertRaises(serializers.ValidationError):
+            field.to_internal_value(['One'])
+
+        field.choices = [(4, 'Four')]
+        self.assertEqual(field.to_internal_value('Four'), 4)
+
+    def test_bulk_validation_checks_emails_in_one_query(self):
+        serializer = UserSerializer(data=[
+            self.get_item('bulkuser1@gmail.com'),
+            self.get_item('existinguser@gmail.com'),
+            self.get_item('bulkuser2@gmail.com'),
+            self.get_item('bulkuser2@gmail.com'),
+            self.get_item('invalid'),
+        ], many=True)
+
+        with self.assertNumQueries(1):
+            self.assertFalse(serializer.is_valid())
+
+        self.assertEqual(serializer.errors[0], {})
+        self.assertEqual(serializer.errors[1]['email'][0].code, 'unique')
+        self.assertEqual(serializer.errors[2], {})
+        self.assertEqual(serializer.errors[3]['email'][0].code, 'unique')
+        self.assertEqual(serializer.errors[4]['email'][0].code, 'invalid')
+
+    def test_valid_bulk_payload(self):
+        serializer = UserSerializer(data=[
+            self.get_item('bulkuser1@gmail.com'),
+            self.get_item('bulkuser2@gmail.com'),
+        ], many=True)
+        self.assertTrue(serializer.is_valid())
+        self.assertEqual(len(serializer.validated_data), 2)
+
+
+class ConcurrencyLimitTests(TestCase):
+    def setUp(self):
+        self.now = 0
+        self.limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=1,
+            min_limit=1,
+            max_limit=4,
+            latency_target=0.5,
+            clock=lambda: self.now,
+        )
+
+    def test_limit_adapts_to_latency(self):
+        for _ in range(20):
+            self.assertTrue(self.limiter.acquire())
+            self.limiter.release(0.1)
+        self.assertEqual(self.limiter.limit, 4)
+
+        self.limiter.acquire()
+        self.limiter.release(1)
+        self.assertAlmostEqual(self.limiter.limit, 3.6)
+        # Decreases at most once per latency target
+        self.limiter.acquire()
+        self.limiter.release(1)
+        self.assertAlmostEqual(self.limiter.limit, 3.6)
+
+    def test_rejects_when_full(self):
+        self.assertTrue(self.limiter.acquire())
+        self.assertFalse(self.limiter.acquire(timeout=0))
+
+    def test_high_priority_runs_first(self):
+        limiter = AdaptiveConcurrencyLimiter(1, 1, 1, latency_target=0.5)
+        limiter.acquire()
+        order = []
+
+        def wait(priority):
+            if limiter.acquire(priority, timeout=5):
+                order.append(priority)
+                limiter.release(0)
+
+        threads = [
+            threading.Thread(target=wait, args=(priority,))
+            for priority in (PRIORITY_LOW, PRIORITY_HIGH)
+        ]
+        for thread in threads:
+            thread.start()
+        while sum(limiter.waiting.values()) < 2:
+            time.sleep(0.001)
+
+        limiter.release(0)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [PRIORITY_HIGH, PRIORITY_LOW])
+
+    def test_middleware_sheds_load(self):
+        middleware = ConcurrencyLimitMiddleware(lambda request: None)
+        middleware.limiter.inflight = middleware.limiter.max_limit
+        request = RequestFactory().post(reverse('accounts:login'))
+        view_func = resolve(reverse('accounts:login')).func
+
+        response = middleware.process_view(request, view_func, (), {})
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+        self.assertEqual(json.loads(response.content)['code'], '5031')
+        self.assertIn('Retry-After', response)
+
+    def test_view_priorities(self):
+        def get_priority(name):
+            return resolve(reverse(name)).func.cls.concurrency_priority
+
+        self.assertEqual(get_priority('accounts:user-retrieve'), PRIORITY_HIGH)
+        self.assertEqual(get_priority('accounts:login'), PRIORITY_LOW)
+        self.assertEqual(get_priority('accounts:user-create'), PRIORITY_LOW)
+
+
+SLOW_QUERIES = {
+    'postgresql': 'SELECT pg_sleep(5)',
+    'sqlite': (
+        'WITH RECURSIVE numbers(n) AS ('
+        'SELECT 1 UNION ALL SELECT n + 1 FROM numbers WHERE n < 100000000'
+        ') SELECT count(*) FROM numbers'
+    ),
+}
+
+
+def run_slow_query():
+    with connection.cursor() as cursor:
+        cursor.execute(SLOW_QUERIES[connection.vendor])
+
+
+class TimeBudgetTests(APITestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(
+            username='budget@gmail.com',
+            email='budget@gmail.com',
+            password='password',
+        )
+        self.token = update_or_create_auth_token(self.user)
+
+    def test_slow_query_is_cancelled(self):
+        start = time.monotonic()
+        with self.assertRaises(TimeBudgetExceeded):
+            with TimeBudget(0.2):
+                run_slow_query()
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(connection.execute_wrappers, [])
+
+        # The connection is usable and unlimited afterwards
+        self.assertTrue(get_user_model().objects.filter(pk=self.user.pk).exists())
+
+    def test_query_after_deadline_is_not_run(self):
+        with self.assertRaises(TimeBudgetExceeded):
+            with TimeBudget(0):
+                get_user_model().objects.count()
+
+    def test_view_returns_503_when_over_budget(self):
+        def get(view, request, *args, **kwargs):
+            run_slow_query()
+
+        with mock.patch.object(RetrieveUserView, 'time_budget', 0.2, create=True):
+            with mock.patch.object(RetrieveUserView, 'get', get):
+                response = self.client.get(
+                    reverse('accounts:user-retrieve'),
+                    HTTP_AUTHORIZATION=f'Token {self.token}',
+                )
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+        self.assertEqual(response.data['code'], 5032)
+        self.assertEqual(connection.execute_wrappers, [])
+
+    def test_view_within_budget(self):
+        response = self.client.get(
+            reverse('accounts:user-retrieve'),
+            HTTP_AUTHORIZATION=f'Token {self.token}',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(connection.execute_wrappers, [])
+
+
+class ShardingTests(APITestCase):
+    databases = '__all__'
+
+    def create_user(self, email):
+        response = self.client.post(reverse('accounts:user-create'), {
+            'email': email,
+            'password': 'shardpassword',
+            'first_name': 'Shard',
+            'last_name': 'User',
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data
+
+    def test_directory_tracks_users(self):
+        data = self.create_user('directory@gmail.com')
+        entry = UserDirectoryEntry.objects.get(user_id=data['user']['id'])
+        self.assertEqual(entry.email, 'directory@gmail.com')
+        self.assertEqual(entry.token_key, data['token'])
+        self.assertEqual(entry.shard, get_shard_for_user_id(entry.user_id))
+
+        response = self.client.patch(
+            reverse('accounts:email-change'),
+            {'email': 'moved@gmail.com'},
+            HTTP_AUTHORIZATION=f'Token {data["token"]}',
+        )
+        entry.refresh_from_db()
+        self.assertEqual(entry.email, 'moved@gmail.com')
+        self.assertEqual(entry.token_key, response.data['token'])
+
+        user = get_user_model().objects.get_by_email('moved@gmail.com')
+        user.delete()
+        self.assertFalse(UserDirectoryEntry.objects.exists())
+
+    def test_email_is_unique_across_shards(self):
+        self.create_user('unique@gmail.com')
+        response = self.client.post(reverse('accounts:user-create'), {
+            'email': 'unique@gmail.com',
+            'password': 'shardpassword',
+            'first_name': 'Shard',
+            'last_name': 'User',
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('email', response.data['errors'])
+
+    def test_directory_is_written_only_on_changes(self):
+        data = self.create_user('writes@gmail.com')
+        User = get_user_model()
+        user = User.objects.get_by_email('writes@gmail.com')
+        table = UserDirectoryEntry._meta.db_table
+
+        def directory_queries():
+            return [
+                query for query in queries.captured_queries
+                if table in query['sql']
+            ]
+
+        user.first_name = 'Changed'
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        self.assertEqual(directory_queries(), [])
+
+        user.email = 'rewritten@gmail.com'
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        self.assertEqual(len(directory_queries()), 1)
+        entry = UserDirectoryEntry.objects.get(user_id=data['user']['id'])
+        self.assertEqual(entry.email, 'rewritten@gmail.com')
+
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        self.assertEqual(directory_queries(), [])
+
+    def test_rebalance_users_repairs_directory(self):
+        # As left by a directory commit failing after the shard's
+        data = self.create_user('repair@gmail.com')
+        user_id = data['user']['id']
+        UserDirectoryEntry.objects.filter(user_id=user_id).delete()
+        data = self.create_user('stale@gmail.com')
+        UserDirectoryEntry.objects.filter(user_id=data['user']['id']).update(
+            email='old@gmail.com',
+            token_key=None,
+        )
+
+        call_command('rebalance_users', stdout=StringIO())
+        entry = UserDirectoryEntry.objects.get(user_id=user_id)
+        self.assertEqual(entry.email, 'repair@gmail.com')
+        entry = UserDirectoryEntry.objects.get(user_id=data['user']['id'])
+        self.assertEqual(entry.email, 'stale@gmail.com')
+        self.assertEqual(entry.token_key, data['token'])
+
+    @override_settings(ACCOUNTS_SHARDS=['default', 'a', 'b'])
+    def test_adding_a_shard_moves_a_share_of_users(self):
+        user_ids = [uuid.uuid4() for _ in range(3000)]
+        before = [get_shard_for_user_id(user_id) for user_id in user_ids]
+        self.assertEqual(before, [get_shard_for_user_id(i) for i in user_ids])
+
+        with override_settings(ACCOUNTS_SHARDS=['default', 'a', 'b', 'c']):
+            after = [get_shard_for_user_id(user_id) for user_id in user_ids]
+
+        moved = [
+            new for old, new in zip(before, after) if old != new
+        ]
+        self.assertEqual(set(moved), {'c'})
+        self.assertAlmostEqual(len(moved) / len(user_ids), 0.25, delta=0.05)
+
+    @skipUnless(
+        len(settings.ACCOUNTS_SHARDS) > 1,
+        'Set SHARD_DATABASE_URLS to test across shards.',
+    )
+    def test_users_are_served_from_their_shard(self):
+        User = get_user_model()
+        emails = [f'shard{i}@gmail.com' for i in range(12)]
+        for email in emails:
+            self.create_user(email)
+
+        shards = {
+            shard: User.objects.using(shard).count()
+            for shard in settings.ACCOUNTS_SHARDS
+        }
+        self.assertEqual(sum(shards.values()), len(emails))
+        self.assertGreater(min(shards.values()), 0)
+
+        for email in emails:
+            response = self.client.post(reverse('accounts:login'), {
+                'email': email,
+                'password': 'shardpassword',
+            })
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(
+                reverse('accounts:user-retrieve'),
+                HTTP_AUTHORIZATION=f'Token {response.data["token"]}',
+            )
+            self.assertEqual(response.data['user']['email'], email)
+
+        admin = User.objects.db_manager('default').create_superuser(
+            username='shardadmin@gmail.com',
+            email='shardadmin@gmail.com',
+            password='adminpassword',
+        )
+        self.client.force_authenticate(admin)
+        response = self.client.get(reverse('accounts:user-list'), {'limit': 5})
+        users = response.data['users']
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            users.extend(response.data['users'])
+        self.assertEqual(len(users), len(emails) + 1)
+        self.assertEqual(len({user['id'] for user in users}), len(users))
+
+    @skipUnless(
+        len(settings.ACCOUNTS_SHARDS) > 1,
+        'Set SHARD_DATABASE_URLS to test across shards.',
+    )
+    @override_settings(ACCOUNTS_SERVICE_KEYS=['servicekey'])
+    def test_bulk_lookup_across_shards(self):
+        users = [self.create_user(f'bulk{i}@gmail.com')['user'] for i in range(8)]
+        response = self.client.post(reverse('accounts:user-lookup'), {
+            'ids': [user['id'] for user in users[:4]],
+            'emails': [user['email'] for user in users[4:]],
+        }, format='json', HTTP_AUTHORIZATION='Service servicekey')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        found = [*response.data['ids'].values(), *response.data['emails'].values()]
+        self.assertEqual(
+            [user['email'] for user in found],
+            [user['email'] for user in users],
+        )
+
+    @skipUnless(
+        len(settings.ACCOUNTS_SHARDS) > 1,
+        'Set SHARD_DATABASE_URLS to test across shards.',
+    )
+    def test_rebalance_users(self):
+        call_command('generate_users', count=40, seed=2, stdout=StringIO())
+        User = get_user_model()
+        created = dict(Token.objects.values_list('user_id', 'created'))
+        # Staff keep their groups, permissions and log entries on default
+        staff_id = next(
+            user_id for user_id in iter(uuid.uuid4, None)
+            if get_shard_for_user_id(user_id) != 'default'
+        )
+        staff = User.objects.db_manager('default').create_user(
+            id=staff_id,
+            username='staff@gmail.com',
+            email='staff@gmail.com',
+            is_staff=True,
+        )
+        staff.groups.add(Group.objects.create(name='Support'))
+        reconcile()
+
+        call_command('rebalance_users', batch_size=15, stdout=StringIO())
+        self.assertTrue(staff.groups.exists())
+        for shard in settings.ACCOUNTS_SHARDS:
+            users = User.objects.using(shard).exclude(pk=staff_id)
+            for user_id in users.values_list('id', flat=True):
+                self.assertEqual(get_shard_for_user_id(user_id), shard)
+                self.assertEqual(
+                    UserDirectoryEntry.objects.get(user_id=user_id).shard,
+                    shard,
+                )
+            for user_id, token_created in (
+                Token.objects.using(shard).values_list('user_id', 'created')
+            ):
+                self.assertEqual(token_created, created[user_id])
+        self.assertEqual(reconcile(dry_run=True), ({}, set()))
+
+        user = User.objects.get_by_email(
+            UserDirectoryEntry.objects.exclude(shard='default')[0].email,
+        )
+        self.assertIsNotNone(
+            authenticate(username=user.email, password='password'),
+        )
+
+
+class ArchiveTests(APITestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.password = 'archivepassword'
+        self.cold = create_user({
+            'email': 'cold@gmail.com',
+            'password': self.password,
+            'first_name': 'Cold',
+            'last_name': 'User',
+        })
+        self.hot = create_user({
+            'email': 'hot@gmail.com',
+            'password': self.password,
+            'first_name': 'Hot',
+            'last_name': 'User',
+        })
+        User.objects.filter(pk=self.cold.pk).update(
+            date_joined=timezone.now() - timedelta(days=60),
+        )
+
+    def archive(self):
+        out = StringIO()
+        call_command('archive_users', batch_size=1, stdout=out)
+        return out.getvalue()
+
+    def test_archives_cold_users(self):
+        output = self.archive()
+        self.assertIn('archived 1 users', output)
+        self.assertIn('index size', output)
+
+        User = get_user_model()
+        self.assertFalse(User.objects.filter(pk=self.cold.pk).exists())
+        self.assertFalse(Token.objects.filter(user_id=self.cold.pk).exists())
+        self.assertTrue(User.objects.filter(pk=self.hot.pk).exists())
+        self.assertTrue(ArchivedUser.objects.filter(pk=self.cold.pk).exists())
+
+        entry = UserDirectoryEntry.objects.get(user_id=self.cold.pk)
+        self.assertTrue(entry.is_archived)
+        self.assertIsNone(entry.token_key)
+
+    def test_archived_email_stays_taken(self):
+        self.archive()
+        response = self.client.post(reverse('accounts:user-create'), {
+            'email': 'cold@gmail.com',
+            'password': self.password,
+            'first_name': 'Cold',
+            'last_name': 'User',
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_login_restores_user(self):
+        self.archive()
+        response = self.client.post(reverse('accounts:login'), {
+            'email': 'cold@gmail.com',
+            'password': self.password,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['user']['id'], str(self.cold.pk))
+        self.assertFalse(ArchivedUser.objects.exists())
+        self.assertFalse(
+            UserDirectoryEntry.objects.get(user_id=self.cold.pk).is_archived,
+        )
+
+        response = self.client.get(
+            reverse('accounts:user-retrieve'),
+            HTTP_AUTHORIZATION=f'Token {response.data["token"]}',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_wrong_password_keeps_user_archived(self):
+        self.archive()
+        response = self.client.post(reverse('accounts:login'), {
+            'email': 'cold@gmail.com',
+            'password': 'wrongpassword',
+        })
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertTrue(ArchivedUser.objects.filter(pk=self.cold.pk).exists())
+        self.assertFalse(
+            get_user_model().objects.filter(pk=self.cold.pk).exists(),
+        )
+
+    def test_password_reset_restores_user(self):
+        self.archive()
+        response = self.client.post(reverse('accounts:password-forgot'), {
+            'email': 'cold@gmail.com',
+        })
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        archived = ArchivedUser.objects.get(pk=self.cold.pk)
+
+        response = self.client.post(reverse('accounts:password-reset'), {
+            'email': 'cold@gmail.com',
+            'password': 'newarchivepassword',
+            'verification_token': str(uuid.uuid4()),
+        })
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertTrue(ArchivedUser.objects.filter(pk=self.cold.pk).exists())
+
+        token = next(
+            row['fields']['token'] for row in archived.data
+            if row['model'] == 'accounts.verificationtoken'
+        )
+        response = self.client.post(reverse('accounts:password-reset'), {
+            'email': 'cold@gmail.com',
+            'password': 'newarchivepassword',
+            'verification_token': token,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(ArchivedUser.objects.exists())
+
+    def test_restoring_restored_user_returns_user(self):
+        self.archive()
+        shard = get_archive_shard('cold@gmail.com')
+        user = restore_user('cold@gmail.com', shard)
+        self.assertEqual(restore_user('cold@gmail.com', shard), user)
+
+
+class AccountDeletionTests(APITestCase):
+    def setUp(self):
+        self.password = 'deletepassword'
+        self.user = create_user({
+            'email': 'delete@gmail.com',
+            'password': self.password,
+            'first_name': 'Delete',
+            'last_name': 'User',
+        })
+        self.token = get_auth_token(self.user)
+        for i in range(5):
+            LogEntry.objects.log_action(
+                user_id=self.user.pk,
+                content_type_id=None,
+                object_id=None,
+                object_repr=f'Entry {i}',
+                action_flag=ADDITION,
+            )
+        self.url = reverse('accounts:user-delete')
+
+    def request_deletion(self, password):
+        return self.client.delete(
+            self.url,
+            {'password': password},
+            HTTP_AUTHORIZATION=f'Token {self.token}',
+        )
+
+    def test_requires_password(self):
+        response = self.request_deletion('wrongpassword')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertFalse(AccountDeletion.objects.exists())
+
+    @override_settings(ACCOUNTS_EVENT_WEBHOOKS=['http://localhost/'])
+    def test_deletion_deactivates_then_deletes_in_background(self):
+        response = self.request_deletion(self.password)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        User = get_user_model()
+        self.assertFalse(User.objects.get(pk=self.user.pk).is_active)
+        self.assertFalse(Token.objects.filter(user_id=self.user.pk).exists())
+        self.assertTrue(OutboxEvent.objects.filter(
+            user_id=self.user.pk,
+            event_type='user.deleted',
+        ).exists())
+        response = self.client.get(
+            reverse('accounts:user-retrieve'),
+            HTTP_AUTHORIZATION=f'Token {self.token}',
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.post(reverse('accounts:login'), {
+            'email': 'delete@gmail.com',
+            'password': self.password,
+        })
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        deletion = AccountDeletion.objects.get(user_id=self.user.pk)
+        self.assertIsNone(deletion.date_completed)
+
+        call_command('delete_accounts', once=True, batch_size=2, stdout=StringIO())
+        deletion.refresh_from_db()
+        self.assertIsNotNone(deletion.date_completed)
+        # Five log entries, the verification token and the user
+        self.assertEqual(deletion.rows_deleted, 7)
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+        self.assertFalse(LogEntry.objects.exists())
+        self.assertFalse(
+            UserDirectoryEntry.objects.filter(user_id=self.user.pk).exists(),
+        )
+
+    def test_failed_deletion_does_not_block_queue(self):
+        # Queued before the user's, on a shard that is no longer configured
+        failing = AccountDeletion.objects.create(
+            user_id=uuid.uuid4(),
+            shard='removed',
+        )
+        self.request_deletion(self.password)
+
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            call_command('delete_accounts', once=True, stdout=StringIO())
+        self.assertIn(
+            f'Unable to delete account {failing.user_id}',
+            stdout.getvalue(),
+        )
+        deletion = AccountDeletion.objects.get(user_id=self.user.pk)
+        self.assertIsNotNone(deletion.date_completed)
+
+        failing.refresh_from_db()
+        self.assertIsNone(failing.date_completed)
+        self.assertEqual(failing.attempts, 1)
+        self.assertIn('removed', failing.last_error)
+        self.assertGreater(failing.next_attempt_at, timezone.now())
+
+
+@override_settings(ACCOUNTS_SERVICE_KEYS=['servicekey'])
+class UserLookupTests(APITestCase):
+    maxDiff = None
+
+    def setUp(self):
+        cache.clear()
+        self.users = [
+            create_user({
+                'email': f'lookup{i}@gmail.com',
+                'password': 'lookuppassword',
+                'first_name': 'Lookup',
+                'last_name': f'User {i}',
+            })
+            for i in range(3)
+        ]
+        self.url = reverse('accounts:user-lookup')
+        self.client.credentials(HTTP_AUTHORIZATION='Service servicekey')
+
+    def test_requires_service_key(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Service wrongkey')
+        response = self.client.post(self.url, {'ids': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        token = get_auth_token(self.users[0])
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        response = self.client.post(self.url, {'ids': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_looks_up_users_keyed_by_input(self):
+        missing_id = str(uuid.uuid4())
+        data = {
+            'ids': [str(self.users[0].pk), missing_id],
+            'emails': [' LOOKUP1@gmail.com', 'missing@gmail.com'],
+        }
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {
+            'ids': {
+                str(self.users[0].pk): UserSerializer(self.users[0]).data,
+                missing_id: None,
+            },
+            'emails': {
+                ' LOOKUP1@gmail.com': UserSerializer(self.users[1]).data,
+                'missing@gmail.com': None,
+            },
+        })
+
+    def test_validates_input(self):
+        response = self.client.post(
+            self.url,
+            {'ids': ['notanid']},
+            format='json',
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with override_settings(ACCOUNTS_USER_LOOKUP_MAX=2):
+            response = self.client.post(self.url, {
+                'ids': [str(user.pk) for user in self.users],
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(ACCOUNTS_USER_LOOKUP_CACHE_TTL=30)
+    def test_cache_serves_repeat_lookups(self):
+        data = {'ids': [str(self.users[0].pk)], 'emails': ['lookup0@gmail.com']}
+        with self.assertNumQueries(1):
+            first = self.client.post(self.url, data, format='json')
+        with self.assertNumQueries(0):
+            second = self.client.post(self.url, data, format='json')
+        self.assertEqual(first.data, second.data)
+
+        # Only users missing from the cache are queried
+        data['ids'].append(str(self.users[2].pk))
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, data, format='json')
+        self.assertEqual(
+            response.data['ids'][str(self.users[2].pk)]['email'],
+            'lookup2@gmail.com',
+        )
+
+
+class StatisticsTests(APITestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.admin = User.objects.create_superuser(
+            username='admin@gmail.com',
+            email='admin@gmail.com',
+            password='adminpassword',
+        )
+        # The admin was created outside the API
+        reconcile()
+
+    def create_user(self, email):
+        response = self.client.post(reverse('accounts:user-create'), {
+            'email': email,
+            'password': 'statspassword',
+            'first_name': 'Stats',
+            'last_name': 'User',
+        })
+        return response.data
+
+    def assertStatistics(self, total_users, verified_users):
+        statistics = get_statistics()
+        self.assertEqual(statistics['total_users'], total_users)
+        self.assertEqual(statistics['verified_users'], verified_users)
+        self.assertEqual(statistics['signups_per_day'][-1], {
+            'date': timezone.localdate(),
+            'count': total_users,
+        })
+        self.assertEqual(reconcile(dry_run=True), ({}, set()))
+
+    def test_counters_follow_account_changes(self):
+        created = [self.create_user(f'stats{i}@gmail.com') for i in range(3)]
+        self.assertStatistics(total_users=4, verified_users=0)
+
+        user = get_user_model().objects.get(pk=created[0]['user']['id'])
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f'Token {created[0]["token"]}',
+        )
+        self.client.post(reverse('accounts:verify'), {
+            'verification_token': VerificationToken.objects.get(user=user).token,
+        })
+        self.assertStatistics(total_users=4, verified_users=1)
+
+        response = self.client.patch(
+            reverse('accounts:email-change'),
+            {'email': 'changed@gmail.com'},
+        )
+        self.assertStatistics(total_users=4, verified_users=0)
+
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f'Token {response.data["token"]}',
+        )
+        self.client.delete(
+            reverse('accounts:user-delete'),
+            {'password': 'statspassword'},
+        )
+        call_command('delete_accounts', once=True, stdout=StringIO())
+        self.assertStatistics(total_users=3, verified_users=0)
+
+    def test_statistics_endpoint(self):
+        url = reverse('accounts:user-stats')
+        data = self.create_user('statsuser@gmail.com')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {data["token"]}')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.credentials()
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_users'], 2)
+        self.assertEqual(response.data['verified_ratio'], 0)
+        self.assertEqual(
+            len(response.data['signups_per_day']),
+            settings.ACCOUNTS_STATISTICS_DAYS,
+        )
+
+        with self.assertNumQueries(1):
+            get_statistics()
+
+    def test_reconcile_corrects_drift(self):
+        User = get_user_model()
+        for i in range(3):
+            self.create_user(f'drift{i}@gmail.com')
+        cold = User.objects.get(email='drift0@gmail.com')
+        User.objects.filter(pk=cold.pk).update(
+            date_joined=timezone.now() - timedelta(days=60),
+        )
+        User.objects.filter(email='drift1@gmail.com').update(is_verified=True)
+        AccountCounter.objects.update(value=0)
+
+        out = StringIO()
+        call_command('reconcile_statistics', stdout=out)
+        self.assertIn('users: +4', out.getvalue())
+        statistics = get_statistics(days=90)
+        self.assertEqual(statistics['total_users'], 4)
+        self.assertEqual(statistics['verified_users'], 1)
+        self.assertEqual(statistics['signups_per_day'][-1]['count'], 3)
+        self.assertEqual(
+            sum(day['count'] for day in statistics['signups_per_day']),
+            4,
+        )
+
+        # Archived users are still counted
+        call_command('archive_users', stdout=StringIO())
+        self.assertTrue(ArchivedUser.objects.filter(pk=cold.pk).exists())
+        self.assertEqual(reconcile(dry_run=True), ({}, set()))
+
+    def test_reconcile_skips_counters_changed_while_counting(self):
+        AccountCounter.objects.update(value=0)
+        count_accounts = stats.count_accounts
+
+        def count_during_signup():
+            counts = count_accounts()
+            self.create_user('counting@gmail.com')
+            return counts
+
+        with mock.patch.object(
+            stats,
+            'count_accounts',
+            side_effect=count_during_signup,
+        ):
+            corrections, changed = reconcile()
+        self.assertEqual(corrections, {})
+        self.assertEqual(changed, {
+            (stats.USERS, None),
+            (stats.SIGNUPS, timezone.localdate()),
+        })
+
+        corrections, changed = reconcile()
+        self.assertEqual(corrections[stats.USERS, None], 1)
+        self.assertEqual(changed, set())
+        self.assertStatistics(total_users=2, verified_users=0)
+
+    def test_generate_users_updates_counters(self):
+        call_command('generate_users', count=20, stdout=StringIO())
+        self.assertEqual(reconcile(dry_run=True), ({}, set()))
+        self.assertEqual(get_statistics()['total_users'], 21)
+
+
+class OnlineSchemaTests(TransactionTestCase):
+    def setUp(self):
+        for i in range(5):
+            create_user({
+                'email': f'schema{i}@gmail.com',
+                'password': 'schemapassword',
+                'first_name': 'Schema',
+                'last_name': f'User {i}',
+            })
+
+    def get_index_state(self, name):
+        User = get_user_model()
+        return get_index_state(connection, User._meta.db_table, name)
+
+    def test_build_indexes_builds_missing_indexes(self):
+        User = get_user_model()
+        index = User._meta.indexes[0]
+        with connection.schema_editor() as schema_editor:
+            schema_editor.remove_index(User, index)
+        self.assertIsNone(self.get_index_state(index.name))
+
+        out = StringIO()
+        call_command('build_indexes', dry_run=True, stdout=out)
+        self.assertIn(f'building {index.name}', out.getvalue())
+        self.assertIsNone(self.get_index_state(index.name))
+
+        call_command('build_indexes', clean_invalid=True, stdout=StringIO())
+        self.assertEqual(self.get_index_state(index.name), INDEX_VALID)
+
+        out = StringIO()
+        call_command('build_indexes', stdout=out)
+        self.assertEqual(out.getvalue(), '')
+
+    def test_add_index_concurrently_operation(self):
+        operation = AddIndexConcurrently('user', models.Index(
+            fields=['last_seen'],
+            name='accounts_user_seen_test_idx',
+        ))
+        from_state = ProjectState.from_apps(apps)
+        to_state = from_state.clone()
+        operation.state_forwards('accounts', to_state)
+
+        with connection.schema_editor(atomic=False) as schema_editor:
+            operation.database_forwards(
+                'accounts', schema_editor, from_state, to_state,
+            )
+            # Indexes that already exist are kept
+            operation.database_forwards(
+                'accounts', schema_editor, from_state, to_state,
+            )
+        self.assertEqual(
+            self.get_index_state('accounts_user_seen_test_idx'),
+            INDEX_VALID,
+        )
+
+        with connection.schema_editor(atomic=False) as schema_editor:
+            operation.database_backwards(
+                'accounts', schema_editor, to_state, from_state,
+            )
+        self.assertIsNone(self.get_index_state('accounts_user_seen_test_idx'))
+
+    def test_backfill_field_operation(self):
+        User = get_user_model()
+        operation = BackfillField(
+            'user',
+            'last_seen',
+            {'last_seen': F('date_joined')},
+            batch_size=2,
+            sleep=0,
+        )
+        state = ProjectState.from_apps(apps)
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            with connection.schema_editor(atomic=False) as schema_editor:
+                operation.database_forwards(
+                    'accounts', schema_editor, state, state,
+                )
+        self.assertIn('accounts.User: 5/5 rows', stdout.getvalue())
+        self.assertFalse(
+            User.objects.exclude(last_seen=F('date_joined')).exists(),
+        )
+
+    def test_backfill_field_command(self):
+        User = get_user_model()
+        User.objects.update(last_seen=None)
+        User.objects.filter(email='schema1@gmail.com').update(
+            last_seen=timezone.now() - timedelta(days=1),
+        )
+
+        out = StringIO()
+        call_command(
+            'backfill_field',
+            'accounts.User',
+            'last_seen',
+            copy_from='date_joined',
+            batch_size=3,
+            sleep=0,
+            stdout=out,
+        )
+        self.assertIn('accounts.User: 4/4 rows', out.getvalue())
+        self.assertEqual(
+            User.objects.filter(last_seen=F('date_joined')).count(),
+            4,
+        )
+
+        call_command(
+            'backfill_field',
+            'accounts.User',
+            'first_name',
+            value='"Filled"',
+            all=True,
+            stdout=StringIO(),
+        )
+        self.assertEqual(
+            User.objects.filter(first_name='Filled').count(),
+            5,
+        )
@@ -5,6 +5,7 @@ from . import views
 app_name = 'accounts'
 urlpatterns = [
     path('', views.CreateUserView.as_view(), name='user-create'),
+    path('delete/', views.DeleteUserView.as_view(), name='user-delete'),
     path('email/change/', views.ChangeEmailView.as_view(), name='email-change'),
     path('login/', views.LogInView.as_view(), name='login'),
     path('password/', include([
@@ -26,6 +27,24 @@ urlpatterns = [
     ])),
     path('retrieve/', views.RetrieveUserView.as_view(), name='user-retrieve'),
     path('update/', views.UpdateUserView.as_view(), name='user-update'),
+    path('users/', include([
+        path('', views.ListUsersView.as_view(), name='user-list'),
+        path(
+            'export/',
+            views.ExportUsersView.as_view(),
+            name='user-export',
+        ),
+        path(
+            'lookup/',
+            views.LookUpUsersView.as_view(),
+            name='user-lookup',
+        ),
+        path(
+            'stats/',
+            views.UserStatisticsView.as_view(),
+            name='user-stats',
+        ),
+    ])),
     path('verify/', include([
         path(
             '',
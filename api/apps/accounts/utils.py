@@ -3,8 +3,15 @@ import uuid
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
 from ...exceptions import InternalServerError, NotFound, VerificationFailed
+from . import events, stats
+from .authentication import is_token_expired
 from .models import VerificationToken
 from .serializers import UserSerializer
+from .sharding import (
+    atomic_with_directory,
+    get_shard_for_user_id,
+    get_user_db,
+)
 
 
 WEB_BASE_URL = os.environ.get('WEB_BASE_URL')
@@ -12,13 +19,18 @@ WEB_BASE_URL = os.environ.get('WEB_BASE_URL')
 
 def get_auth_token(user):
     """
-    Retrieve an auth_token for the specified user.
+    Retrieve an auth_token for the specified user, replacing it if it has
+    expired or been swept.
     """
     try:
-        token = Token.objects.get(user=user)
-    except (Token.DoesNotExist, Token.MultipleObjectsReturned):
+        token = Token.objects.using(get_user_db(user)).get(user=user)
+    except Token.DoesNotExist:
+        return update_or_create_auth_token(user)
+    except Token.MultipleObjectsReturned:
         raise InternalServerError
     else:
+        if is_token_expired(token.created, user.last_seen):
+            return update_or_create_auth_token(user)
         return token
 
 
@@ -26,14 +38,15 @@ def update_or_create_auth_token(user):
     """
     Update or create an auth_token for the specified user.
     """
+    tokens = Token.objects.using(get_user_db(user))
     try:
-        token, created = Token.objects.get_or_create(user=user)
+        token, created = tokens.get_or_create(user=user)
     except Token.MultipleObjectsReturned:
         raise InternalServerError
     else:
         if not created:
             token.delete()
-            token = Token.objects.create(user=user)
+            token = tokens.create(user=user)
         return token
 
 
@@ -41,7 +54,8 @@ def update_or_create_verification_token(user):
     """
     Update or create a new verification token for a user.
     """
-    verification_token, _ = VerificationToken.objects.update_or_create(
+    verification_tokens = VerificationToken.objects.using(get_user_db(user))
+    verification_token, _ = verification_tokens.update_or_create(
         user=user,
         defaults={'token': uuid.uuid4(), 'is_active': True}
     )
@@ -51,10 +65,15 @@ def update_or_create_verification_token(user):
 def create_user(data):
     serializer = UserSerializer(data=data)
     serializer.is_valid(raise_exception=True)
-    user = serializer.save()
 
-    update_or_create_auth_token(user)
-    update_or_create_verification_token(user)
+    # Pick the id up front to run the transaction on the user's shard
+    user_id = uuid.uuid4()
+    with atomic_with_directory(get_shard_for_user_id(user_id)):
+        user = serializer.save(id=user_id)
+        update_or_create_auth_token(user)
+        update_or_create_verification_token(user)
+        events.record_event(events.USER_CREATED, user, serializer.data)
+        stats.record_users_created([user])
 
     return user
 
@@ -64,7 +83,9 @@ def check_verification_token(submitted_token, user):
     Check that verification token belongs to user and is active.
     """
     try:
-        verification_token = VerificationToken.objects.get(user=user)
+        verification_token = VerificationToken.objects.using(
+            get_user_db(user),
+        ).get(user=user)
     except (
         VerificationToken.DoesNotExist,
         VerificationToken.MultipleObjectsReturned
@@ -1,13 +1,32 @@
 from django.contrib.auth import authenticate, get_user_model
+from django.db.models import Q
+from django.http import StreamingHttpResponse
 from rest_framework import generics, permissions, status, views
 from rest_framework.response import Response
+from ...concurrency import PRIORITY_HIGH, PRIORITY_LOW
 from ...exceptions import (
     AuthenticationFailed,
     NotFound,
-    PermissionDenied
+    PermissionDenied,
+    ValidationError,
 )
 from ...utils import validate_required_fields
-from .serializers import UserSerializer
+from . import events, stats
+from .activity import record_activity
+from .archive import (
+    check_archived_verification_token,
+    get_archive_shard,
+    update_archived_verification_token,
+)
+from .authentication import ServiceAuthentication
+from .deletion import request_account_deletion
+from .export import EXPORT_TYPES, UserExport
+from .idempotency import IdempotentMixin
+from .lookup import lookup_users
+from .pagination import UserKeysetPagination
+from .permissions import IsService
+from .serializers import UserLookupSerializer, UserSerializer
+from .sharding import atomic_with_directory, get_user_db
 from .utils import (
     check_verification_token,
     create_user,
@@ -25,6 +44,7 @@ class LogInView(views.APIView):
     * Requires email and password.
     * Returns user object and token.
     """
+    concurrency_priority = PRIORITY_LOW
     permission_classes = [permissions.AllowAny]
 
     def post(self, request, *args, **kwargs):
@@ -36,19 +56,22 @@ class LogInView(views.APIView):
         if user is None:
             raise AuthenticationFailed
         else:
+            record_activity(user)
             return get_logged_in_user_response(user, status.HTTP_200_OK)
 
 
-class CreateUserView(generics.CreateAPIView):
+class CreateUserView(IdempotentMixin, generics.CreateAPIView):
     """
     View to create a new user and send verification email.
 
     * No authentication.
     * Requires email, password, first_name, last_name.
+    * Supports Idempotency-Key.
     * Returns user object and token.
     """
     User = get_user_model()
     queryset = User.objects.all()
+    concurrency_priority = PRIORITY_LOW
     permission_classes = [permissions.AllowAny]
     serializer_class = UserSerializer
 
@@ -65,6 +88,7 @@ class RetrieveUserView(views.APIView):
     * Authentication required.
     * Returns user object and token.
     """
+    concurrency_priority = PRIORITY_HIGH
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
@@ -90,10 +114,15 @@ class VerifyUserView(views.APIView):
         user = request.user
         verified_token = check_verification_token(submitted_token, user)
 
-        user.is_verified = True
-        user.save()
-        verified_token.is_active = False
-        verified_token.save()
+        with atomic_with_directory(get_user_db(user)):
+            was_verified = stats.lock_is_verified(user)
+            user.is_verified = True
+            user.save(update_fields=['is_verified'])
+            verified_token.is_active = False
+            verified_token.save()
+            events.record_event(events.USER_VERIFIED, user)
+            if not was_verified:
+                stats.record_verification_changed(True)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -119,6 +148,7 @@ class ForgotPasswordView(views.APIView):
 
     * Requires email.
     """
+    time_budget = 2
     permission_classes = [permissions.AllowAny]
 
     def post(self, request, *args, **kwargs):
@@ -127,24 +157,38 @@ class ForgotPasswordView(views.APIView):
         User = get_user_model()
 
         try:
-            user = User.objects.get(email=email)
+            user = User.objects.get_by_email(email)
         except (User.DoesNotExist, User.MultipleObjectsReturned):
-            print('User not found.')
+            # Archived users get a token stored with them and are restored
+            # once it is used
+            verification_token = None
+            shard = get_archive_shard(email)
+            if shard is not None:
+                verification_token = update_archived_verification_token(
+                    email,
+                    shard,
+                )
         else:
             verification_token = update_or_create_verification_token(user)
+
+        if verification_token is None:
+            print('User not found.')
+        else:
             print(verification_token)
             # TODO: Send password reset email
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class ResetPasswordView(views.APIView):
+class ResetPasswordView(IdempotentMixin, views.APIView):
     """
     View to reset a password using a token from email.
 
     * Requires email, password, verification_token.
+    * Supports Idempotency-Key.
     * Returns user object and token.
     """
+    concurrency_priority = PRIORITY_LOW
     permission_classes = [permissions.AllowAny]
 
     def post(self, request, *args, **kwargs):
@@ -160,29 +204,39 @@ class ResetPasswordView(views.APIView):
         User = get_user_model()
 
         try:
-            user = User.objects.get(email=email)
+            user = User.objects.get_by_email(
+                email,
+                restore_if=lambda objects: check_archived_verification_token(
+                    submitted_token,
+                    objects,
+                ),
+            )
         except (User.DoesNotExist, User.MultipleObjectsReturned):
             raise NotFound
         else:
             verified_token = check_verification_token(submitted_token, user)
             user.set_password(password)
-            user.save()
 
-            verified_token.is_active = False
-            verified_token.save()
-            update_or_create_auth_token(user)
+            with atomic_with_directory(get_user_db(user)):
+                user.save(update_fields=['password'])
+                verified_token.is_active = False
+                verified_token.save()
+                update_or_create_auth_token(user)
+                events.record_event(events.USER_PASSWORD_RESET, user)
 
             return get_logged_in_user_response(user, status.HTTP_200_OK)
 
 
-class ChangePasswordView(views.APIView):
+class ChangePasswordView(IdempotentMixin, views.APIView):
     """
     View to change a user's password.
 
     * Authentication required.
     * Requires current_password and new_password.
+    * Supports Idempotency-Key.
     * Returns token.
     """
+    concurrency_priority = PRIORITY_LOW
     permission_classes = [permissions.IsAuthenticated]
 
     def patch(self, request, *args, **kwargs):
@@ -203,7 +257,7 @@ class ChangePasswordView(views.APIView):
             raise PermissionDenied
         else:
             user.set_password(new_password)
-            user.save()
+            user.save(update_fields=['password'])
 
             update_or_create_auth_token(user)
 
@@ -234,13 +288,24 @@ class ChangeEmailView(views.APIView):
         )
         serializer.is_valid(raise_exception=True)
 
-        request.user.email = email
-        request.user.username = email
-        request.user.is_verified = False
-        request.user.save()
-        update_or_create_auth_token(request.user)
+        with atomic_with_directory(get_user_db(request.user)):
+            was_verified = stats.lock_is_verified(request.user)
+            request.user.email = email
+            request.user.username = email
+            request.user.is_verified = False
+            request.user.save(update_fields=['email', 'username', 'is_verified'])
+            update_or_create_auth_token(request.user)
 
-        verification_token = update_or_create_verification_token(request.user)
+            verification_token = update_or_create_verification_token(
+                request.user
+            )
+            events.record_event(
+                events.USER_EMAIL_CHANGED,
+                request.user,
+                {'email': email},
+            )
+            if was_verified:
+                stats.record_verification_changed(False)
         # TODO: email verification
         print(verification_token)
 
@@ -250,6 +315,29 @@ class ChangeEmailView(views.APIView):
         )
 
 
+class DeleteUserView(views.APIView):
+    """
+    View to delete a user's account.
+
+    * Authentication required.
+    * Requires password.
+    * Deactivates the account and revokes its token at once; the account's
+      data is deleted in the background.
+    """
+    concurrency_priority = PRIORITY_LOW
+    permission_classes = [permissions.IsAuthenticated]
+
+    def delete(self, request, *args, **kwargs):
+        password = request.data.get('password')
+        validate_required_fields({'password': password})
+
+        if not request.user.check_password(password):
+            raise AuthenticationFailed
+
+        request_account_deletion(request.user)
+        return Response(status=status.HTTP_202_ACCEPTED)
+
+
 class UpdateUserView(views.APIView):
     """
     View to update a user's profile.
@@ -271,3 +359,139 @@ class UpdateUserView(views.APIView):
             request.user,
             status=status.HTTP_200_OK,
         )
+
+
+class ListUsersView(generics.ListAPIView):
+    """
+    View to page through and search users.
+
+    * Admin authentication required.
+    * Optional search (prefix of email, first_name or last_name), fields
+      (comma separated subset of user fields), cursor and limit.
+    * Returns a page of user objects and the link to the next page.
+    * Archived users are not listed; the export includes them.
+    """
+    time_budget = 10
+    permission_classes = [permissions.IsAdminUser]
+    pagination_class = UserKeysetPagination
+    serializer_class = UserSerializer
+
+    # Model fields needed to serialize each user field
+    model_fields = {
+        'id': ['id'],
+        'email': ['email'],
+        'first_name': ['first_name'],
+        'last_name': ['last_name'],
+        'full_name': ['first_name', 'last_name'],
+        'is_verified': ['is_verified'],
+    }
+
+    def get_fields(self):
+        fields = self.request.query_params.get('fields')
+        if not fields:
+            return list(self.model_fields)
+
+        fields = [field.strip() for field in fields.split(',')]
+        invalid = [field for field in fields if field not in self.model_fields]
+        if invalid:
+            raise ValidationError(errors={
+                'fields': [f'Invalid field: {field}.' for field in invalid],
+            })
+        return fields
+
+    def get_queryset(self):
+        User = get_user_model()
+        queryset = User.objects.all()
+
+        search = self.request.query_params.get('search', '').strip()
+        if search:
+            queryset = queryset.filter(
+                Q(email__startswith=search.lower())
+                | Q(first_name__istartswith=search)
+                | Q(last_name__istartswith=search)
+            )
+
+        # Only load the columns needed for the response and the cursor
+        columns = {'id', 'date_joined'}
+        for field in self.get_fields():
+            columns.update(self.model_fields[field])
+        return queryset.only(*columns)
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_fields())
+        return super().get_serializer(*args, **kwargs)
+
+
+class LookUpUsersView(views.APIView):
+    """
+    View for internal services to look up many users at once.
+
+    * Service authentication required.
+    * Optional ids and emails, lists of at most ACCOUNTS_USER_LOOKUP_MAX
+      values in total.
+    * Returns user objects keyed by the given ids and emails, null for users
+      not found.
+    """
+    authentication_classes = [ServiceAuthentication]
+    permission_classes = [IsService]
+
+    def post(self, request, *args, **kwargs):
+        serializer = UserLookupSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        return Response(
+            lookup_users(**serializer.validated_data),
+            status=status.HTTP_200_OK,
+        )
+
+
+class UserStatisticsView(views.APIView):
+    """
+    View to retrieve account statistics.
+
+    * Admin authentication required.
+    * Returns total and verified users, the verified ratio and signups per
+      day for the last ACCOUNTS_STATISTICS_DAYS days.
+    """
+    concurrency_priority = PRIORITY_LOW
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(stats.get_statistics(), status=status.HTTP_200_OK)
+
+
+class ExportUsersView(views.APIView):
+    """
+    View to stream an export of all users, archived users included.
+
+    * Admin authentication required.
+    * Optional type (ndjson or csv) and gzip.
+    * Returns a file attachment streamed in chunks.
+    """
+    time_budget = None
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in EXPORT_TYPES:
+            raise ValidationError(errors={
+                'type': [f'Must be one of: {", ".join(EXPORT_TYPES)}.'],
+            })
+        compress = request.query_params.get('gzip') in ('1', 'true')
+        export = UserExport(export_type, compress=compress)
+
+        def stream():
+            yield from export
+            print(
+                f'Exported {export.rows} users in {export.elapsed:.2f}s '
+                f'({export.rows_per_second:.0f} rows/sec)'
+            )
+
+        response = StreamingHttpResponse(
+            stream(),
+            content_type=export.content_type,
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="{export.filename}"'
+        )
+        return response
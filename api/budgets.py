@@ -0,0 +1,116 @@
+import time
+from django.conf import settings
+from django.db import DatabaseError, connections
+from .exceptions import TimeBudgetExceeded
+
+
+class TimeBudget:
+    """
+    Cancel database queries that would run past a deadline.
+
+    While active, every query on every database connection gets the remaining
+    budget as its timeout: PostgreSQL through statement_timeout, SQLite
+    through a progress handler that interrupts the query. A query that fails
+    once the budget has run out, or that starts after it ran out, raises
+    TimeBudgetExceeded.
+    """
+
+    # statement_timeout is only set again once the remaining budget is this
+    # many seconds shorter than the last timeout set, saving a round trip
+    # for queries in quick succession
+    resolution = 0.05
+
+    def __init__(self, seconds, clock=time.monotonic):
+        self.clock = clock
+        self.deadline = clock() + seconds
+        self.connections = []
+        self.timeouts_set_at = {}
+
+    def __enter__(self):
+        self.connections = list(connections.all())
+        for connection in self.connections:
+            connection.execute_wrappers.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for connection in self.connections:
+            connection.execute_wrappers.remove(self)
+            self.reset(connection)
+        self.timeouts_set_at = {}
+
+    def get_remaining(self):
+        return self.deadline - self.clock()
+
+    def apply(self, connection, remaining):
+        if connection.vendor == 'postgresql':
+            set_at = self.timeouts_set_at.get(connection.alias)
+            if set_at is not None and self.clock() - set_at < self.resolution:
+                return
+            with connection.connection.cursor() as cursor:
+                cursor.execute(
+                    f'SET statement_timeout = {max(1, int(remaining * 1000))}'
+                )
+            self.timeouts_set_at[connection.alias] = self.clock()
+        elif connection.vendor == 'sqlite':
+            if connection.alias not in self.timeouts_set_at:
+                connection.connection.set_progress_handler(
+                    lambda: self.clock() >= self.deadline,
+                    1000,
+                )
+                self.timeouts_set_at[connection.alias] = self.clock()
+
+    def reset(self, connection):
+        if connection.alias not in self.timeouts_set_at:
+            return
+        if connection.vendor == 'postgresql':
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SET statement_timeout = DEFAULT')
+            except DatabaseError:
+                # The connection is closed at the end of the request once
+                # it is found unusable
+                pass
+        elif connection.vendor == 'sqlite':
+            connection.connection.set_progress_handler(None, 0)
+
+    def __call__(self, execute, sql, params, many, context):
+        remaining = self.get_remaining()
+        if remaining <= 0:
+            raise TimeBudgetExceeded
+
+        self.apply(context['connection'], remaining)
+        try:
+            return execute(sql, params, many, context)
+        except DatabaseError as exc:
+            if self.get_remaining() <= 0:
+                raise TimeBudgetExceeded from exc
+            raise
+
+
+class TimeBudgetMiddleware:
+    """
+    Run each view within its time budget.
+
+    Views declare a `time_budget` in seconds, or None to disable it, and
+    default to VIEW_TIME_BUDGET. The budget starts when the view is called
+    and covers authentication and the queries of the view. Queries made
+    while streaming a response body run after the view returned and are
+    not covered.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            budget = getattr(request, '_time_budget', None)
+            if budget is not None:
+                budget.__exit__(None, None, None)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'cls', None)
+        seconds = getattr(view_class, 'time_budget', settings.VIEW_TIME_BUDGET)
+        if seconds is not None:
+            request._time_budget = TimeBudget(seconds).__enter__()
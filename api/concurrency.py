@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.http import JsonResponse
+from .exceptions import ExternalServiceUnavailable
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Per-process concurrency limit adjusted from observed latency (AIMD).
+
+    Every request that completes under the latency target raises the limit
+    by 1 / limit, so the limit grows by about one per limit's worth of
+    requests. A request over the target cuts the limit by the backoff
+    factor, at most once per target interval. Waiting requests are admitted
+    strictly by priority: a request only runs while no request of a higher
+    priority is waiting.
+    """
+
+    def __init__(
+        self,
+        initial_limit,
+        min_limit,
+        max_limit,
+        latency_target,
+        backoff=0.9,
+        clock=time.monotonic,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.clock = clock
+        self.inflight = 0
+        self.waiting = Counter()
+        self.last_decrease = None
+        self.condition = threading.Condition()
+
+    def can_run(self, priority):
+        if self.inflight >= max(int(self.limit), self.min_limit):
+            return False
+        return not any(
+            count for waiting_priority, count in self.waiting.items()
+            if waiting_priority < priority
+        )
+
+    def acquire(self, priority=PRIORITY_NORMAL, timeout=0):
+        """
+        Wait up to timeout seconds for a slot and return whether one was
+        acquired.
+        """
+        deadline = self.clock() + timeout
+        with self.condition:
+            if self.can_run(priority):
+                self.inflight += 1
+                return True
+
+            self.waiting[priority] += 1
+            try:
+                while not self.can_run(priority):
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.inflight += 1
+                return True
+            finally:
+                self.waiting[priority] -= 1
+                # Lower priorities may be able to run now
+                self.condition.notify_all()
+
+    def release(self, latency):
+        with self.condition:
+            self.inflight -= 1
+            now = self.clock()
+            if latency > self.latency_target:
+                if (
+                    self.last_decrease is None
+                    or now - self.last_decrease >= self.latency_target
+                ):
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class ConcurrencyLimitMiddleware:
+    """
+    Shed load when views slow down instead of letting requests pile up.
+
+    Views declare a `concurrency_priority` (PRIORITY_HIGH, PRIORITY_NORMAL
+    or PRIORITY_LOW). Requests wait for a slot for up to the queue timeout of
+    their priority and are rejected with ExternalServiceUnavailable (503)
+    when none frees up in time.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=settings.CONCURRENCY_INITIAL_LIMIT,
+            min_limit=settings.CONCURRENCY_MIN_LIMIT,
+            max_limit=settings.CONCURRENCY_MAX_LIMIT,
+            latency_target=settings.CONCURRENCY_LATENCY_TARGET,
+        )
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            start = getattr(request, '_concurrency_start', None)
+            if start is not None:
+                self.limiter.release(time.monotonic() - start)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'cls', None)
+        priority = getattr(view_class, 'concurrency_priority', PRIORITY_NORMAL)
+        timeout = settings.CONCURRENCY_QUEUE_TIMEOUTS[priority]
+
+        if not self.limiter.acquire(priority, timeout):
+            return self.get_overloaded_response()
+        request._concurrency_start = time.monotonic()
+
+    def get_overloaded_response(self):
+        exc = ExternalServiceUnavailable('Service overloaded. Try again later.')
+        response = JsonResponse(
+            {'detail': exc.detail, 'code': exc.detail.code},
+            status=exc.status_code,
+        )
+        response['Retry-After'] = '1'
+        return response
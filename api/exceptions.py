@@ -15,6 +15,12 @@ def custom_exception_handler(exc, context):
                 exc = ValidationError(errors=exc.detail)
             elif entry['exception'] == exceptions.MethodNotAllowed:
                 exc = MethodNotAllowed(detail=exc.detail)
+            elif (
+                entry['exception'] == Exception
+                and isinstance(exc, exceptions.APIException)
+            ):
+                # Project API exceptions are already in the custom format
+                pass
             else:
                 exc = entry['custom_exception']()
             break
@@ -72,6 +78,12 @@ class NotVerified(exceptions.APIException):
     default_code = 4014
 
 
+class TokenExpired(exceptions.APIException):
+    status_code = status.HTTP_401_UNAUTHORIZED
+    default_detail = 'Token expired.'
+    default_code = 4015
+
+
 class PermissionDenied(exceptions.PermissionDenied):
     default_code = 4031
 
@@ -80,6 +92,18 @@ class NotFound(exceptions.NotFound):
     default_code = 4041
 
 
+class IdempotencyConflict(exceptions.APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'A request with this Idempotency-Key is in progress.'
+    default_code = 4091
+
+
+class IdempotencyKeyMismatch(exceptions.APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'Idempotency-Key was used with a different request.'
+    default_code = 4221
+
+
 class MethodNotAllowed(exceptions.APIException):
     status_code = status.HTTP_405_METHOD_NOT_ALLOWED
 
@@ -106,6 +130,12 @@ class ExternalServiceUnavailable(exceptions.APIException):
     default_code = '5031'
 
 
+class TimeBudgetExceeded(exceptions.APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Request took too long. Try again later.'
+    default_code = 5032
+
+
 exceptions_map = [
     {
         'exception': serializers.ValidationError,
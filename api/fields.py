@@ -2,6 +2,17 @@ from rest_framework import serializers
 
 
 class ChoiceField(serializers.ChoiceField):
+    def _set_choices(self, choices):
+        super()._set_choices(choices)
+
+        # Index keys by display value once so conversion is a dict lookup.
+        # The first key wins when display values repeat.
+        self._choice_keys = {}
+        for key, val in self._choices.items():
+            self._choice_keys.setdefault(val, key)
+
+    choices = property(serializers.ChoiceField._get_choices, _set_choices)
+
     def to_representation(self, value):
         return value if value in ('', None) else self._choices[value]
 
@@ -9,8 +20,7 @@ class ChoiceField(serializers.ChoiceField):
         if data == '' and self.allow_blank:
             return None if self.allow_null else ''
 
-        for key, val in self._choices.items():
-            if val == data:
-                return key
-
-        self.fail('invalid_choice', input=data)
+        try:
+            return self._choice_keys[data]
+        except (KeyError, TypeError):
+            self.fail('invalid_choice', input=data)
@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.handlers.exception import convert_exception_to_response
+from django.utils.module_loading import import_string
+
+
+class MiddlewareProfile:
+    """
+    A chain of middleware built around the rest of the request handler.
+    """
+
+    def __init__(self, middleware_paths, get_response):
+        self.view_middleware = []
+        self.template_response_middleware = []
+        self.exception_middleware = []
+
+        handler = convert_exception_to_response(get_response)
+        for middleware_path in reversed(middleware_paths):
+            middleware = import_string(middleware_path)
+            try:
+                mw_instance = middleware(handler)
+            except MiddlewareNotUsed:
+                continue
+
+            if mw_instance is None:
+                raise ImproperlyConfigured(
+                    f'Middleware factory {middleware_path} returned None.'
+                )
+
+            if hasattr(mw_instance, 'process_view'):
+                self.view_middleware.insert(0, mw_instance.process_view)
+            if hasattr(mw_instance, 'process_template_response'):
+                self.template_response_middleware.append(
+                    mw_instance.process_template_response
+                )
+            if hasattr(mw_instance, 'process_exception'):
+                self.exception_middleware.append(
+                    mw_instance.process_exception
+                )
+
+            handler = convert_exception_to_response(mw_instance)
+
+        self.chain = handler
+
+
+class RouteScopedMiddleware:
+    """
+    Run a different middleware stack depending on the URL prefix.
+
+    Profiles are declared in `MIDDLEWARE_PROFILES` and mapped to URL prefixes
+    in `MIDDLEWARE_ROUTES`. Requests that match no prefix use the `default`
+    profile. The hooks of the selected profile (process_view,
+    process_exception, process_template_response) run as if the profile's
+    middleware were listed directly in `MIDDLEWARE`.
+    """
+    sync_capable = True
+    async_capable = False
+
+    def __init__(self, get_response):
+        self.profiles = {
+            name: MiddlewareProfile(middleware_paths, get_response)
+            for name, middleware_paths in settings.MIDDLEWARE_PROFILES.items()
+        }
+        if 'default' not in self.profiles:
+            raise ImproperlyConfigured(
+                "MIDDLEWARE_PROFILES must define a 'default' profile."
+            )
+
+        # Longest prefix first so nested routes win
+        self.routes = sorted(
+            settings.MIDDLEWARE_ROUTES.items(),
+            key=lambda route: len(route[0]),
+            reverse=True,
+        )
+        for prefix, name in self.routes:
+            if name not in self.profiles:
+                raise ImproperlyConfigured(
+                    f'Route {prefix} uses unknown middleware profile {name}.'
+                )
+
+    def get_profile(self, request):
+        for prefix, name in self.routes:
+            if request.path_info.startswith(prefix):
+                return self.profiles[name]
+        return self.profiles['default']
+
+    def __call__(self, request):
+        return self.get_profile(request).chain(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        for process_view in self.get_profile(request).view_middleware:
+            response = process_view(request, view_func, view_args, view_kwargs)
+            if response:
+                return response
+
+    def process_template_response(self, request, response):
+        profile = self.get_profile(request)
+        for process_template_response in profile.template_response_middleware:
+            response = process_template_response(request, response)
+        return response
+
+    def process_exception(self, request, exception):
+        for process_exception in self.get_profile(request).exception_middleware:
+            response = process_exception(request, exception)
+            if response:
+                return response
+
+
+@register(Tags.admin)
+def check_admin_middleware(app_configs, **kwargs):
+    """
+    Replace admin.E408-E410, which only look at MIDDLEWARE, with the same
+    checks against the default middleware profile that serves the admin.
+    """
+    default = settings.MIDDLEWARE_PROFILES.get('default', [])
+    required = [
+        ('api.E001', 'django.contrib.auth.middleware.AuthenticationMiddleware'),
+        ('api.E002', 'django.contrib.messages.middleware.MessageMiddleware'),
+        ('api.E003', 'django.contrib.sessions.middleware.SessionMiddleware'),
+    ]
+    return [
+        Error(
+            f"'{middleware_path}' must be in the default middleware profile "
+            "in order to use the admin application.",
+            id=check_id,
+        )
+        for check_id, middleware_path in required
+        if middleware_path not in default
+    ]
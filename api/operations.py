@@ -0,0 +1,298 @@
+import sys
+import time
+from django.contrib.postgres import operations as postgres_operations
+from django.db import connections, router
+from django.db.migrations.operations.base import Operation
+
+
+INDEX_VALID = 'valid'
+INDEX_INVALID = 'invalid'
+INDEX_BUILDING = 'building'
+
+# Concurrent index builds of other sessions, whose indexes are invalid until
+# they finish. pg_stat_progress_create_index exists from PostgreSQL 12.
+BUILDING_INDEXES_SQL = 'SELECT index_relid FROM pg_stat_progress_create_index'
+
+
+def get_index_state(connection, table, name):
+    """
+    Return whether an index exists and is usable: INDEX_VALID, INDEX_INVALID
+    for an index left behind by a failed concurrent build, INDEX_BUILDING
+    while another session builds it, or None if there is no such index.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor != 'postgresql':
+            constraints = connection.introspection.get_constraints(
+                cursor,
+                table,
+            )
+            return INDEX_VALID if name in constraints else None
+
+        cursor.execute(
+            'SELECT x.indisvalid, x.indexrelid IN '
+            f'({BUILDING_INDEXES_SQL}) '
+            'FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid '
+            'WHERE i.relname = %s AND pg_table_is_visible(i.oid)',
+            [name],
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    is_valid, is_building = row
+    if is_valid:
+        return INDEX_VALID
+    return INDEX_BUILDING if is_building else INDEX_INVALID
+
+
+def get_invalid_indexes(connection):
+    """
+    Return the (table, index) names of the indexes left invalid by failed
+    concurrent builds. Indexes other sessions are still building are left
+    out.
+    """
+    if connection.vendor != 'postgresql':
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT t.relname, i.relname FROM pg_index x '
+            'JOIN pg_class i ON i.oid = x.indexrelid '
+            'JOIN pg_class t ON t.oid = x.indrelid '
+            'WHERE NOT x.indisvalid AND pg_table_is_visible(i.oid) '
+            f'AND x.indexrelid NOT IN ({BUILDING_INDEXES_SQL}) '
+            'ORDER BY t.relname, i.relname'
+        )
+        return cursor.fetchall()
+
+
+def drop_index_concurrently(connection, name):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DROP INDEX CONCURRENTLY IF EXISTS '
+            f'{connection.ops.quote_name(name)}'
+        )
+
+
+def get_model_indexes(model, connection):
+    """
+    Return the indexes of a model on a database: its Meta.indexes and, on
+    PostgreSQL, its postgres_indexes, which use PostgreSQL-only syntax.
+    """
+    indexes = list(model._meta.indexes)
+    if connection.vendor == 'postgresql':
+        indexes.extend(getattr(model, 'postgres_indexes', []))
+    return indexes
+
+
+def build_postgres_indexes(sender, app_config, using, **kwargs):
+    """
+    post_migrate receiver that builds the missing postgres_indexes of an
+    app's models on PostgreSQL, without blocking writes.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    for model in app_config.get_models():
+        if not router.allow_migrate_model(using, model):
+            continue
+        for index in getattr(model, 'postgres_indexes', []):
+            with connection.schema_editor(atomic=False) as schema_editor:
+                add_index_concurrently(schema_editor, model, index)
+
+
+def add_index_concurrently(schema_editor, model, index):
+    """
+    Build an index without blocking writes to the table, and return whether
+    it had to be built.
+
+    On PostgreSQL the index is built with CREATE INDEX CONCURRENTLY, which
+    must run outside a transaction. An invalid index left by an earlier
+    failed build is dropped and built again, and a valid one is kept. Other
+    databases build the index normally.
+    """
+    connection = schema_editor.connection
+    state = get_index_state(connection, model._meta.db_table, index.name)
+    if state == INDEX_VALID:
+        return False
+    if state == INDEX_BUILDING:
+        raise RuntimeError(
+            f'Index {index.name} is being built by another session.'
+        )
+
+    if connection.vendor != 'postgresql':
+        schema_editor.add_index(model, index)
+        return True
+    if state == INDEX_INVALID:
+        drop_index_concurrently(connection, index.name)
+    schema_editor.add_index(model, index, concurrently=True)
+    return True
+
+
+def remove_index_concurrently(schema_editor, model, index):
+    """
+    Drop an index without blocking reads and writes of the table, if it
+    exists.
+    """
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        drop_index_concurrently(connection, index.name)
+    elif get_index_state(connection, model._meta.db_table, index.name):
+        schema_editor.remove_index(model, index)
+
+
+def backfill(queryset, values, batch_size=1000, sleep=0, stdout=None):
+    """
+    Update the rows of a queryset with values, given as field names mapped
+    to values or expressions, in batches of primary keys, and return how
+    many rows were updated.
+
+    Outside a transaction each batch commits on its own, so row locks are
+    held for one batch at a time. Pausing `sleep` seconds between batches
+    leaves room for other writes and for replicas to catch up. Progress is
+    written to `stdout`.
+    """
+    stdout = stdout or sys.stdout
+    model = queryset.model
+    total = queryset.count()
+    updated = 0
+    last_pk = None
+    start = time.perf_counter()
+    while True:
+        batch = queryset.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        pks = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return updated
+        last_pk = pks[-1]
+
+        updated += model._base_manager.using(queryset.db).filter(
+            pk__in=pks,
+        ).update(**values)
+        elapsed = time.perf_counter() - start
+        stdout.write(
+            f'  {model._meta.label}: {updated}/{total} rows '
+            f'({updated / elapsed:.0f} rows/sec)\n'
+        )
+        if sleep:
+            time.sleep(sleep)
+
+
+class AddIndexConcurrently(postgres_operations.AddIndexConcurrently):
+    """
+    Create an index without blocking writes, replacing an invalid index left
+    by a failed earlier attempt and skipping one that is already built, for
+    example by build_indexes.
+
+    Use in migrations with atomic = False in place of AddIndex. Databases
+    other than PostgreSQL build the index normally.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            self._ensure_not_in_transaction(schema_editor)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            add_index_concurrently(schema_editor, model, self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            self._ensure_not_in_transaction(schema_editor)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            remove_index_concurrently(schema_editor, model, self.index)
+
+
+class RemoveIndexConcurrently(postgres_operations.RemoveIndexConcurrently):
+    """
+    Drop an index without blocking reads and writes, if it exists.
+
+    Use in migrations with atomic = False in place of RemoveIndex. Databases
+    other than PostgreSQL drop the index normally.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            self._ensure_not_in_transaction(schema_editor)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            model_state = from_state.models[app_label, self.model_name_lower]
+            index = model_state.get_index_by_name(self.name)
+            remove_index_concurrently(schema_editor, model, index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            self._ensure_not_in_transaction(schema_editor)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            model_state = to_state.models[app_label, self.model_name_lower]
+            index = model_state.get_index_by_name(self.name)
+            add_index_concurrently(schema_editor, model, index)
+
+
+class BackfillField(Operation):
+    """
+    Fill a field of existing rows in throttled batches, each committed on its
+    own, reporting progress as it goes.
+
+    Use in migrations with atomic = False, after adding the field as
+    nullable or with a database default and before making it required.
+    `values` maps field names to values or expressions, and `filter` selects
+    the rows to fill, by default those where the field is null. Backwards it
+    does nothing.
+    """
+    reversible = True
+    reduces_to_sql = False
+    atomic = False
+
+    def __init__(
+        self,
+        model_name,
+        name,
+        values,
+        filter=None,
+        batch_size=1000,
+        sleep=0.1,
+    ):
+        self.model_name = model_name
+        self.name = name
+        self.values = values
+        self.filter = filter
+        self.batch_size = batch_size
+        self.sleep = sleep
+
+    def deconstruct(self):
+        kwargs = {
+            'model_name': self.model_name,
+            'name': self.name,
+            'values': self.values,
+        }
+        if self.filter is not None:
+            kwargs['filter'] = self.filter
+        if self.batch_size != 1000:
+            kwargs['batch_size'] = self.batch_size
+        if self.sleep != 0.1:
+            kwargs['sleep'] = self.sleep
+        return self.__class__.__name__, [], kwargs
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        using = schema_editor.connection.alias
+        if not self.allow_migrate_model(using, model):
+            return
+        queryset = model._base_manager.using(using).filter(
+            **(self.filter or {f'{self.name}__isnull': True}),
+        )
+        backfill(queryset, self.values, self.batch_size, self.sleep)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        pass
+
+    def describe(self):
+        return f'Backfill {self.name} of model {self.model_name}'
+
+    @property
+    def migration_name_fragment(self):
+        return f'backfill_{self.model_name.lower()}_{self.name.lower()}'
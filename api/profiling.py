@@ -0,0 +1,178 @@
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from django.conf import settings
+from django.core import signing
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_MODES = ('sample', 'cprofile')
+SIGNING_SALT = 'api.profiling'
+
+
+def make_profile_header(mode='sample'):
+    """
+    Create a signed X-Profile header value requesting a profile.
+    """
+    return signing.dumps({'mode': mode}, salt=SIGNING_SALT)
+
+
+def collapse_stack(frame):
+    """
+    Collapse a frame and its callers into a folded stack line, root first.
+    """
+    names = []
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '?')
+        names.append(f'{module}:{frame.f_code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """
+    Sample the stack of one thread from a background thread.
+
+    Only the profiled thread pays for the sampling, through the GIL, at a
+    cost proportional to the sampling rate rather than to the number of
+    function calls.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or settings.PROFILING_INTERVAL
+        self.thread_id = threading.get_ident()
+        self.counts = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[collapse_stack(frame)] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as output:
+            for stack, count in self.counts.items():
+                output.write(f'{stack} {count}\n')
+
+
+class CProfiler:
+    """
+    Deterministic profile of every function call with cProfile.
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+PROFILERS = {
+    'sample': (StackSampler, 'folded'),
+    'cprofile': (CProfiler, 'prof'),
+}
+
+
+def get_profile_path(view_name, extension):
+    filename = (
+        f'{view_name}__{time.strftime("%Y%m%dT%H%M%S")}'
+        f'-{os.getpid()}-{uuid.uuid4().hex[:8]}.{extension}'
+    )
+    return os.path.join(settings.PROFILING_DIR, filename)
+
+
+class ProfilingMiddleware:
+    """
+    Profile requests and write one profile file per request.
+
+    A request is profiled when PROFILING_ENABLED is set, at random with
+    probability PROFILING_SAMPLE_RATE, or when it carries a valid signed
+    X-Profile header (see make_profile_header) and authenticates as a staff
+    user. Files are named after the URL name of the view, e.g.
+    `accounts:login__<time>-<pid>-<id>.folded`, and can be aggregated
+    with the aggregate_profiles command.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def get_mode(self, request):
+        header = request.headers.get(PROFILE_HEADER)
+        if header:
+            mode = self.get_header_mode(request, header)
+            if mode:
+                return mode
+
+        if settings.PROFILING_ENABLED:
+            return settings.PROFILING_MODE
+        if random.random() < settings.PROFILING_SAMPLE_RATE:
+            return settings.PROFILING_MODE
+        return None
+
+    def get_header_mode(self, request, header):
+        try:
+            data = signing.loads(
+                header,
+                salt=SIGNING_SALT,
+                max_age=settings.PROFILING_HEADER_MAX_AGE,
+            )
+        except signing.BadSignature:
+            return None
+
+        mode = data.get('mode')
+        if mode not in PROFILE_MODES or not self.is_staff(request):
+            return None
+        return mode
+
+    def is_staff(self, request):
+        drf_request = Request(request)
+        for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+            try:
+                result = authentication_class().authenticate(drf_request)
+            except exceptions.APIException:
+                return False
+            if result is not None:
+                return result[0].is_staff
+        return False
+
+    def __call__(self, request):
+        mode = self.get_mode(request)
+        if mode is None:
+            return self.get_response(request)
+
+        profiler_class, extension = PROFILERS[mode]
+        profiler = profiler_class()
+        profiler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.stop()
+
+        match = request.resolver_match
+        view_name = match.view_name if match else 'unresolved'
+        os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+        profiler.write(get_profile_path(view_name, extension))
+        return response
@@ -51,6 +51,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'corsheaders',
     'rest_framework',
     'rest_framework.authtoken',
@@ -60,15 +61,38 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
-    'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'api.middleware.RouteScopedMiddleware',
 ]
 
+# Middleware run after MIDDLEWARE, selected per URL prefix by
+# api.middleware.RouteScopedMiddleware. Admin and static files use the
+# default profile. The token-authenticated JSON API needs no session, CSRF,
+# messages or clickjacking handling; DRF authenticates it in the view.
+MIDDLEWARE_PROFILES = {
+    'default': [
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.middleware.common.CommonMiddleware',
+        'django.middleware.csrf.CsrfViewMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
+        'django.middleware.clickjacking.XFrameOptionsMiddleware',
+        'whitenoise.middleware.WhiteNoiseMiddleware',
+    ],
+    'api': [
+        'api.concurrency.ConcurrencyLimitMiddleware',
+        'api.budgets.TimeBudgetMiddleware',
+        'api.profiling.ProfilingMiddleware',
+    ],
+}
+
+MIDDLEWARE_ROUTES = {
+    '/accounts/': 'api',
+}
+
+# The admin middleware checks only inspect MIDDLEWARE; equivalent checks on
+# the default profile are registered in api.middleware.
+SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
+
 ROOT_URLCONF = 'api.urls'
 
 TEMPLATES = [
@@ -111,6 +135,30 @@ DATABASES = {
     'default': default_db
 }
 
+# Users are sharded across the default database and one more database per
+# URL in SHARD_DATABASE_URLS. Run migrate with --database for each shard.
+# See api.apps.accounts.sharding.
+# Users created before the user directory existed have no entry in it. Run
+# rebalance_users once after deploying the directory, and before adding a
+# shard: with more than one shard, users without an entry can't log in and
+# their emails aren't checked for uniqueness.
+ACCOUNTS_SHARDS = ['default']
+if os.environ.get('SHARD_DATABASE_URLS'):
+    import dj_database_url
+    for number, url in enumerate(
+        os.environ['SHARD_DATABASE_URLS'].split(','),
+        start=1,
+    ):
+        DATABASES[f'shard_{number}'] = dj_database_url.parse(
+            url,
+            conn_max_age=600,
+        )
+        ACCOUNTS_SHARDS.append(f'shard_{number}')
+
+DATABASE_ROUTERS = ['api.apps.accounts.sharding.ShardRouter']
+
+AUTHENTICATION_BACKENDS = ['api.apps.accounts.sharding.ShardedModelBackend']
+
 
 AUTH_USER_MODEL = 'accounts.User'
 
@@ -175,14 +223,112 @@ elif ENV == 'prod':
     CORS_ALLOWED_ORIGINS = []
 
 
+# Concurrency settings
+# Per-process limit on concurrent API views, adjusted between the minimum and
+# maximum from view latency. Requests wait up to the queue timeout of their
+# priority (high, normal, low) for a slot. See api.concurrency.
+# The limit only applies to requests served by threads of the same process,
+# so the web process runs gunicorn's gthread workers with WEB_THREADS threads
+# each (see Procfile). A sync worker serves one request at a time and never
+# queues or sheds any. The limit starts at the thread count and is capped by
+# it.
+# Every thread keeps its own connection to each database for CONN_MAX_AGE
+# seconds, so a dyno holds up to WEB_CONCURRENCY (gunicorn workers) *
+# WEB_THREADS connections to the default database and to each shard, e.g.
+# 2 * 10 = 20. Keep that times the number of dynos, plus the worker
+# processes, under the database plan's connection limit.
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 10))
+
+CONCURRENCY_INITIAL_LIMIT = WEB_THREADS
+CONCURRENCY_MIN_LIMIT = 1
+CONCURRENCY_MAX_LIMIT = WEB_THREADS
+CONCURRENCY_LATENCY_TARGET = 0.5
+CONCURRENCY_QUEUE_TIMEOUTS = [2.0, 0.5, 0.1]
+
+
+# Seconds a view may run before its queries are cancelled, unless the view
+# declares its own time_budget. See api.budgets.
+VIEW_TIME_BUDGET = 5
+
+
+# Profiling settings
+# Requests are profiled when enabled, at the sample rate, or with a signed
+# X-Profile header from a staff user. See api.profiling.
+
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED') == 'true'
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+PROFILING_MODE = 'sample'
+PROFILING_INTERVAL = 0.005
+PROFILING_HEADER_MAX_AGE = 60 * 60
+PROFILING_DIR = os.environ.get(
+    'PROFILING_DIR',
+    os.path.join(BASE_DIR, 'profiles'),
+)
+
+
 # DRF project settings
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication'
+        'api.apps.accounts.authentication.TokenAuthentication'
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
     'EXCEPTION_HANDLER': 'api.exceptions.custom_exception_handler',
 }
+
+
+# Accounts settings
+
+# Seconds between bulk writes of buffered user activity (User.last_seen)
+ACCOUNTS_ACTIVITY_FLUSH_INTERVAL = 60
+
+# Seconds an auth token is valid after creation, and without activity.
+# None disables either limit.
+ACCOUNTS_TOKEN_TTL = 30 * 24 * 60 * 60
+ACCOUNTS_TOKEN_IDLE_TTL = 7 * 24 * 60 * 60
+
+# Seconds after which unverified users, and any users, that have not been
+# seen are moved to the archive by archive_users
+ACCOUNTS_ARCHIVE_UNVERIFIED_AFTER = 30 * 24 * 60 * 60
+ACCOUNTS_ARCHIVE_INACTIVE_AFTER = 365 * 24 * 60 * 60
+
+# Rows deleted per statement when deleting an account in the background, and
+# seconds before a failed deletion is retried, doubling per attempt up to the
+# maximum
+ACCOUNTS_DELETION_BATCH_SIZE = 500
+ACCOUNTS_DELETION_RETRY_DELAY = 60
+ACCOUNTS_DELETION_MAX_RETRY_DELAY = 60 * 60
+
+# Rows each account statistics counter is spread over, so that concurrent
+# updates rarely wait on each other, and days of signups the stats endpoint
+# returns
+ACCOUNTS_STATISTICS_SLOTS = 16
+ACCOUNTS_STATISTICS_DAYS = 30
+
+# Seconds a stored Idempotency-Key response can be replayed, and seconds a
+# request holds its key before a retry may take it over, which must outlast
+# the longest request (gunicorn kills workers after 30 seconds)
+ACCOUNTS_IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+ACCOUNTS_IDEMPOTENCY_LOCK_TIMEOUT = 60
+
+# Keys internal services authenticate with, as "Authorization: Service <key>"
+ACCOUNTS_SERVICE_KEYS = [
+    key for key in os.environ.get('SERVICE_KEYS', '').split(',') if key
+]
+
+# Most ids and emails in one bulk user lookup, and seconds looked up users
+# are cached for. None disables the cache.
+ACCOUNTS_USER_LOOKUP_MAX = 1000
+ACCOUNTS_USER_LOOKUP_CACHE_TTL = None
+
+# Webhook endpoints that receive account events, and delivery settings
+ACCOUNTS_EVENT_WEBHOOKS = [
+    url for url in os.environ.get('EVENT_WEBHOOK_URLS', '').split(',') if url
+]
+ACCOUNTS_EVENT_BATCH_SIZE = 100
+ACCOUNTS_EVENT_MAX_ATTEMPTS = 10
+ACCOUNTS_EVENT_RETRY_DELAY = 5
+ACCOUNTS_EVENT_MAX_RETRY_DELAY = 60 * 60
+ACCOUNTS_EVENT_TIMEOUT = 10